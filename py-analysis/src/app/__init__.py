@@ -3,3 +3,4 @@ from .econometrics import *
 from .io import *
 from .percentiles import *
 from .plotting import *
+from .localdb import *
@@ -1,12 +1,18 @@
+from collections import OrderedDict
 import ConfigParser
+from cStringIO import StringIO
 import os
 
+import numpy as np
+import pandas
 import psycopg2.extensions
 
 from sqlalchemy import *
 from sqlalchemy.orm import *
 
 from sqlalchemy.ext.declarative import declarative_base
+
+from .io import DictColumn
 Base = declarative_base()
 
 # ============
@@ -56,3 +62,227 @@ def getSession():
     if (session==None):
         session = Session()
     return session
+
+# ===============
+# = Bulk writes =
+# ===============
+
+# Postgres column types with a fixed-width binary COPY representation.
+PG_BINARY_TYPES = {
+  'smallint': '>i2',
+  'integer': '>i4',
+  'bigint': '>i8',
+  'real': '>f4',
+  'double precision': '>f8',
+  'boolean': '>u1',
+}
+
+# Postgres column types that are sent as UTF-8 text in binary COPY.
+# Enums show up as 'USER-DEFINED'.
+PG_BINARY_TEXT_TYPES = ['text', 'character varying', 'character', 'USER-DEFINED']
+
+# Binary COPY timestamps: microseconds since 2000-01-01.
+PG_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+
+PGCOPY_HEADER = 'PGCOPY\n\xff\r\n\0' + '\0\0\0\0' + '\0\0\0\0'
+PGCOPY_TRAILER = '\xff\xff'
+
+# Returns a dict: column name -> Postgres data type
+def get_column_types(session, table):
+  if '.' in table:
+    (schema, name) = table.split('.', 1)
+    schema_filter = "'%s'" % schema
+  else:
+    name = table
+    schema_filter = "current_schema()"
+  result = session.execute("""SELECT column_name, data_type 
+    FROM information_schema.columns
+    WHERE table_schema=%s AND table_name='%s'""" % (schema_filter, name))
+  return dict([(row['column_name'], row['data_type']) for row in result])
+
+# data: a pandas DataFrame, or a dict of column name -> array
+# Returns an OrderedDict of column name -> numpy array
+def _to_columns(data):
+  columns = OrderedDict()
+  for name in data.keys():
+    values = data[name]
+    if isinstance(values, DictColumn):
+      values = values.decode()
+    elif isinstance(values, pandas.Series):
+      values = values.values
+    columns[name] = np.asarray(values)
+  return columns
+
+def _isnull(values):
+  if values.dtype.kind in 'iub':
+    return np.zeros(len(values), dtype=bool)
+  return np.asarray(pandas.isnull(values), dtype=bool)
+
+def _encode_text(v):
+  if isinstance(v, unicode):
+    return v.encode('utf-8')
+  return str(v)
+
+# COPY text format: tab-separated, \N for NULL, backslash escapes.
+def _text_column(values):
+  isnull = _isnull(values)
+  if values.dtype.kind in 'iu':
+    out = values.astype(str).astype(object)
+  elif values.dtype.kind=='b':
+    out = np.where(values, 't', 'f').astype(object)
+  elif values.dtype.kind=='f':
+    out = np.array([repr(v) for v in values.tolist()], dtype=object)
+  elif values.dtype.kind=='M':
+    out = values.astype('datetime64[us]').astype(str).astype(object)
+  else:
+    out = np.array([_encode_text(v)
+      .replace('\\', '\\\\').replace('\t', '\\t')
+      .replace('\n', '\\n').replace('\r', '\\r') 
+      if not null else None for (v, null) in zip(values, isnull)], dtype=object)
+  out[isnull] = '\\N'
+  return out
+
+def _text_copy_data(columns):
+  cols = [_text_column(values) for values in columns.values()]
+  return ''.join(['\t'.join(row) + '\n' for row in zip(*cols)])
+
+# COPY binary format, assembled with array operations.
+# Each row: int16 number of fields, then per field an int32 length (-1 for NULL)
+# followed by the field data.
+def _binary_copy_data(columns, column_types):
+  num_rows = len(columns.values()[0])
+  fields = [] # list of (lengths, kind, payload)
+  for name in columns.keys():
+    values = columns[name]
+    pgtype = column_types[name]
+    isnull = _isnull(values)
+    if pgtype in PG_BINARY_TYPES or pgtype.startswith('timestamp without'):
+      if pgtype in PG_BINARY_TYPES:
+        dtype = np.dtype(PG_BINARY_TYPES[pgtype])
+      else:
+        dtype = np.dtype('>i8')
+        values = (values.astype('datetime64[us]') - PG_EPOCH).astype(np.int64)
+      arr = np.zeros(num_rows, dtype=dtype)
+      arr[~isnull] = values[~isnull]
+      lengths = np.where(isnull, -1, dtype.itemsize)
+      fields.append((lengths, 'fixed', arr.view(np.uint8).reshape((num_rows, dtype.itemsize))))
+    elif pgtype in PG_BINARY_TEXT_TYPES:
+      encoded = [_encode_text(v) for v in values[~isnull]]
+      lengths = np.zeros(num_rows, dtype=np.int64) - 1
+      lengths[~isnull] = [len(v) for v in encoded]
+      fields.append((lengths, 'var', np.frombuffer(''.join(encoded), dtype=np.uint8)))
+    else:
+      raise Exception("Binary COPY does not support column '%s' of type '%s', use format='text'" % (name, pgtype))
+
+  row_lengths = 2 + sum([4 + np.maximum(lengths, 0) for (lengths, kind, payload) in fields])
+  total = len(PGCOPY_HEADER) + int(np.sum(row_lengths)) + len(PGCOPY_TRAILER)
+  buf = np.zeros(total, dtype=np.uint8)
+  buf[:len(PGCOPY_HEADER)] = np.frombuffer(PGCOPY_HEADER, dtype=np.uint8)
+  buf[-len(PGCOPY_TRAILER):] = np.frombuffer(PGCOPY_TRAILER, dtype=np.uint8)
+
+  pos = len(PGCOPY_HEADER) + np.cumsum(row_lengths) - row_lengths
+  buf[pos[:,None] + np.arange(2)] = np.frombuffer(np.array(len(fields), dtype='>i2').tostring(), dtype=np.uint8)
+  pos = pos + 2
+  for (lengths, kind, payload) in fields:
+    buf[pos[:,None] + np.arange(4)] = lengths.astype('>i4').view(np.uint8).reshape((num_rows, 4))
+    pos = pos + 4
+    valid = lengths>=0
+    if kind=='fixed':
+      buf[pos[valid,None] + np.arange(payload.shape[1])] = payload[valid]
+    else:
+      n = lengths[valid]
+      starts = np.cumsum(n) - n
+      buf[np.repeat(pos[valid], n) + np.arange(len(payload)) - np.repeat(starts, n)] = payload
+    pos = pos + np.maximum(lengths, 0)
+  return buf.tostring()
+
+def _quote(name):
+  return '"%s"' % name.replace('"', '""')
+
+# Bulk-write rows to a table with COPY FROM STDIN.
+#
+# session: a SQLAlchemy session on a Postgres DB
+# table: the target table, optionally schema-qualified
+# data: a pandas DataFrame, or a dict of column name -> array (or list).
+#   Columns that aren't provided take their default values.
+# format: 'text' or 'binary'. Binary COPY supports integer, float, boolean,
+#   timestamp, text and enum columns.
+# batch_size: number of rows per COPY statement
+# commit_batches: commit after every batch. By default nothing is committed, 
+#   and the caller decides when to commit the transaction.
+# staging: COPY into a temporary staging table first, then insert the rows
+#   into the target table
+# merge_keys: (implies staging) key columns of the target table. Staged rows
+#   update target rows with the same keys; all other rows are inserted.
+#
+# Returns the number of rows written.
+def bulk_write(session, table, data, format='text', batch_size=100000,
+  commit_batches=False, staging=False, merge_keys=None):
+
+  columns = _to_columns(data)
+  names = columns.keys()
+  num_rows = len(columns[names[0]]) if len(names)>0 else 0
+  if merge_keys:
+    staging = True
+
+  column_types = None
+  if format=='binary':
+    column_types = get_column_types(session, table)
+  elif format!='text':
+    raise Exception("Unknown COPY format: %s" % format)
+
+  colnames = ', '.join([_quote(name) for name in names])
+  staging_table = 'bulk_staging_%s' % table.replace('.', '_')
+  copy_table = staging_table if staging else table
+
+  copy_sql = "COPY %s (%s) FROM STDIN" % (copy_table, colnames)
+  if format=='binary':
+    copy_sql += " WITH BINARY"
+
+  if merge_keys:
+    key_match = ' AND '.join(["t.%s=s.%s" % (_quote(k), _quote(k)) for k in merge_keys])
+    value_names = [name for name in names if name not in merge_keys]
+    update_sql = None
+    if len(value_names) > 0:
+      update_sql = "UPDATE %s t SET %s FROM %s s WHERE %s" % (table,
+        ', '.join(["%s=s.%s" % (_quote(name), _quote(name)) for name in value_names]),
+        staging_table, key_match)
+    insert_sql = """INSERT INTO %s (%s) SELECT %s FROM %s s
+      WHERE NOT EXISTS (SELECT 1 FROM %s t WHERE %s)""" % (table, colnames,
+        ', '.join(["s.%s" % _quote(name) for name in names]), staging_table,
+        table, key_match)
+  elif staging:
+    update_sql = None
+    insert_sql = "INSERT INTO %s (%s) SELECT %s FROM %s" % (table, colnames,
+      colnames, staging_table)
+
+  staging_ready = False
+  for start in range(0, num_rows, batch_size):
+    batch = OrderedDict([(name, columns[name][start:start+batch_size]) for name in names])
+
+    if staging:
+      if staging_ready:
+        session.execute("TRUNCATE %s" % staging_table)
+      else:
+        session.execute("DROP TABLE IF EXISTS %s" % staging_table)
+        session.execute("""CREATE TEMP TABLE %s (LIKE %s INCLUDING DEFAULTS) 
+          ON COMMIT DROP""" % (staging_table, table))
+        staging_ready = not commit_batches
+
+    if format=='binary':
+      payload = _binary_copy_data(batch, column_types)
+    else:
+      payload = _text_copy_data(batch)
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert(copy_sql, StringIO(payload))
+    cursor.close()
+
+    if staging:
+      if update_sql:
+        session.execute(update_sql)
+      session.execute(insert_sql)
+
+    if commit_batches:
+      session.commit()
+
+  return num_rows
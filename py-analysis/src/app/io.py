@@ -1,5 +1,15 @@
+from collections import OrderedDict
 import csv
+from decimal import Decimal
+import hashlib
+import inspect
+import json
 import os, errno
+import shutil
+import tempfile
+
+import numpy as np
+import pandas
 
 # ============
 # = File I/O =
@@ -28,3 +38,419 @@ def save_text(text, filename):
   outfile.write(text)
   outfile.close()
 
+# Identifies the current state of a set of files: a list of [path, size, mtime]
+# entries. Used to detect when cached derivatives have gone stale.
+def file_signature(filenames):
+  sig = []
+  for filename in filenames:
+    st = os.stat(filename)
+    sig.append([os.path.abspath(filename), st.st_size, int(st.st_mtime)])
+  return sig
+
+# ==================
+# = Column storage =
+# ==================
+
+# A dictionary-encoded string column: integer codes into a sorted vocabulary.
+# Missing values are encoded as -1.
+# Since the vocabulary is sorted, code order matches string order: min/max and
+# sorting can be computed on the codes.
+class DictColumn(object):
+  def __init__(self, codes, vocab):
+    self.codes = codes
+    self.vocab = vocab
+
+  def __len__(self):
+    return len(self.codes)
+
+  def take(self, idx):
+    return DictColumn(self.codes[idx], self.vocab)
+
+  # Returns an object array of strings, with None for missing values.
+  def decode(self):
+    if len(self.vocab)==0:
+      return np.array([None] * len(self.codes), dtype=object)
+    values = self.vocab.take(np.maximum(self.codes, 0))
+    values[np.asarray(self.codes) < 0] = None
+    return values
+
+# values: a sequence of strings, None/NaN for missing values
+# Returns a DictColumn.
+def dict_encode(values):
+  values = np.asarray(values, dtype=object)
+  isnull = np.asarray(pandas.isnull(values), dtype=bool)
+  codes = np.empty(len(values), dtype=np.int32)
+  codes[isnull] = -1
+  if isnull.all():
+    return DictColumn(codes, np.array([], dtype=object))
+  vocab, inverse = np.unique(values[~isnull], return_inverse=True)
+  codes[~isnull] = inverse
+  return DictColumn(codes, vocab.astype(object))
+
+# Strings are stored as a single UTF-8 buffer plus an array of offsets, which
+# avoids pickled object arrays.
+def _save_vocab(vocab, filename_base):
+  is_unicode = any(isinstance(v, unicode) for v in vocab)
+  encoded = [v.encode('utf-8') if isinstance(v, unicode) else str(v) for v in vocab]
+  offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(v) for v in encoded])
+  np.save(filename_base + '.offsets.npy', offsets)
+  outfile = open(filename_base + '.vocab', 'wb')
+  outfile.write(''.join(encoded))
+  outfile.close()
+  return is_unicode
+
+def _load_vocab(filename_base, is_unicode):
+  offsets = np.load(filename_base + '.offsets.npy')
+  infile = open(filename_base + '.vocab', 'rb')
+  buf = infile.read()
+  infile.close()
+  vocab = [buf[offsets[idx]:offsets[idx+1]] for idx in range(len(offsets)-1)]
+  if is_unicode:
+    vocab = [v.decode('utf-8') for v in vocab]
+  return np.array(vocab, dtype=object)
+
+# Write a dict of columns to a directory, one .npy file per column.
+# String columns (DictColumn instances or object arrays) are dictionary-encoded.
+# columns: a dict (or OrderedDict) of column name -> array or DictColumn
+# signature: an optional JSON-serialisable value that identifies the source data,
+#   cf. file_signature(...)
+# The columns are written to a temporary directory next to dirname, which is then
+# renamed into place. Concurrent readers never see a partially written directory.
+def save_columns(columns, dirname, signature=None):
+  parent = os.path.dirname(os.path.abspath(dirname))
+  mkdir_p(parent)
+  tmpdir = tempfile.mkdtemp(prefix=os.path.basename(dirname) + '.tmp', dir=parent)
+  try:
+    _write_columns(columns, tmpdir, signature)
+    _replace_dir(tmpdir, dirname)
+  finally:
+    if os.path.exists(tmpdir):
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+# Renames srcdir to dstdir, replacing any existing dstdir. The old directory is
+# moved aside first, since rename can't replace a non-empty directory. If a 
+# concurrent writer replaces dstdir first, its (equivalent) result is kept.
+def _replace_dir(srcdir, dstdir):
+  olddir = None
+  if os.path.exists(dstdir):
+    olddir = tempfile.mkdtemp(prefix=os.path.basename(dstdir) + '.old', 
+      dir=os.path.dirname(os.path.abspath(dstdir)))
+    try:
+      os.rename(dstdir, os.path.join(olddir, 'columns'))
+    except OSError:
+      pass
+  try:
+    os.rename(srcdir, dstdir)
+  except OSError:
+    pass
+  if olddir!=None:
+    shutil.rmtree(olddir, ignore_errors=True)
+
+def _write_columns(columns, dirname, signature):
+  index_filename = os.path.join(dirname, 'columns.json')
+  index = {'signature': signature, 'columns': []}
+  for idx, name in enumerate(columns.keys()):
+    col = columns[name]
+    filename_base = os.path.join(dirname, 'col_%d' % idx)
+    if not isinstance(col, DictColumn) and np.asarray(col).dtype==object:
+      col = dict_encode(col)
+    if isinstance(col, DictColumn):
+      np.save(filename_base + '.npy', np.asarray(col.codes))
+      is_unicode = _save_vocab(col.vocab, filename_base)
+      index['columns'].append({'name': name, 'type': 'dict', 'unicode': is_unicode})
+    else:
+      np.save(filename_base + '.npy', np.asarray(col))
+      index['columns'].append({'name': name, 'type': 'array'})
+  outfile = open(index_filename, 'wb')
+  json.dump(index, outfile)
+  outfile.close()
+
+# Load columns written by save_columns(...).
+# Returns a dict of column name -> array or DictColumn, in storage order, or
+# None if there is no stored data, its signature does not match, or it can't 
+# be read (e.g. because it was replaced while loading).
+# Arrays are memory-mapped, unless mmap_mode is None.
+def load_columns(dirname, signature=None, mmap_mode='r'):
+  index_filename = os.path.join(dirname, 'columns.json')
+  if not os.path.exists(index_filename):
+    return None
+  try:
+    infile = open(index_filename, 'rb')
+    index = json.load(infile)
+    infile.close()
+    if signature!=None and index['signature']!=json.loads(json.dumps(signature)):
+      return None
+    columns = OrderedDict()
+    for idx, spec in enumerate(index['columns']):
+      filename_base = os.path.join(dirname, 'col_%d' % idx)
+      data = np.load(filename_base + '.npy', mmap_mode=mmap_mode)
+      if spec['type']=='dict':
+        columns[spec['name']] = DictColumn(data, _load_vocab(filename_base, spec['unicode']))
+      else:
+        columns[spec['name']] = data
+    return columns
+  except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+    print "Could not read column cache %s: %s" % (dirname, e)
+    return None
+
+# ===============
+# = TSV caching =
+# ===============
+
+def _is_cacheable(df):
+  for name in df.columns:
+    values = df[name].values
+    if values.dtype==object:
+      notnull = values[~np.asarray(pandas.isnull(values), dtype=bool)]
+      if not all(isinstance(v, basestring) for v in notnull):
+        return False
+  return True
+
+# Drop-in replacement for pandas.read_csv(filename, sep="\t", ...) with a
+# transparent binary cache.
+# On first read the parsed columns are stored in a sidecar directory next to the
+# TSV file (<filename>.columns), with dictionary-encoded string columns. Later
+# reads memory-map the sidecar, as long as the file's path, size and mtime and the
+# parsing options are unchanged.
+# usecols: columns to parse and return. Reads with different usecols have 
+#   separate caches (<filename>.<hash>.columns).
+# index_col: the name or position of a column to use as index. The index is 
+#   set after reading, so it can be cached like the other columns.
+# use_cache: set to False to always parse the TSV file.
+# kwargs is passed on to pandas.read_csv(...), and must be JSON-serialisable for 
+# caching.
+# Returns a pandas DataFrame.
+def read_tsv(filename, usecols=None, index_col=None, use_cache=True, **kwargs):
+  try:
+    options = json.loads(json.dumps(kwargs, sort_keys=True))
+    cols_key = None if usecols==None else json.dumps(sorted(usecols))
+  except TypeError:
+    use_cache = False
+  if not use_cache:
+    return pandas.read_csv(filename, sep="\t", usecols=usecols, index_col=index_col, 
+      **kwargs)
+
+  dirname = filename + '.columns'
+  if cols_key!=None:
+    dirname = '%s.%s.columns' % (filename, hashlib.sha1(cols_key).hexdigest()[:12])
+  signature = {'files': file_signature([filename]), 'options': options, 
+    'usecols': cols_key}
+  columns = load_columns(dirname, signature)
+  if columns==None:
+    df = pandas.read_csv(filename, sep="\t", usecols=usecols, **kwargs)
+    if _is_cacheable(df):
+      try:
+        save_columns(OrderedDict([(name, df[name].values) for name in df.columns]), 
+          dirname, signature)
+      except (IOError, OSError) as e:
+        print "Could not write TSV cache %s: %s" % (dirname, e)
+  else:
+    data = OrderedDict()
+    for name in columns.keys():
+      values = columns[name]
+      if isinstance(values, DictColumn):
+        isnull = (np.asarray(values.codes) < 0)
+        values = values.decode()
+        values[isnull] = np.nan
+      # read_csv only returns unicode column names when decoding the file
+      if kwargs.get('encoding')==None:
+        name = name.encode('utf-8')
+      data[name] = values
+    df = pandas.DataFrame(data, columns=data.keys())
+
+  if index_col!=None:
+    if isinstance(index_col, (int, long)):
+      index_col = df.columns[index_col]
+    df = df.set_index(index_col)
+  return df
+
+# ===================
+# = Output manifest =
+# ===================
+
+# Plot functions draw through these modules, so their outputs also depend on 
+# the source of these files.
+HASHED_SOURCES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plotting.py')]
+
+# filename -> sha1 hex digest of the file, or None if it can't be read
+_source_hashes = dict()
+
+def _source_hash(filename):
+  if filename.endswith('.pyc') or filename.endswith('.pyo'):
+    filename = filename[:-1]
+  if filename not in _source_hashes:
+    try:
+      with open(filename, 'rb') as f:
+        _source_hashes[filename] = hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+      _source_hashes[filename] = None
+  return _source_hashes[filename]
+
+# Bytecode and constants (literals, nested functions) of a code object.
+def _update_code_hash(h, code):
+  h.update(code.co_code)
+  for const in code.co_consts:
+    if inspect.iscode(const):
+      _update_code_hash(h, const)
+    else:
+      _update_hash(h, const)
+
+def _update_hash(h, obj):
+  if obj is None or isinstance(obj, (bool, int, long, float, Decimal, basestring)):
+    h.update('%s:%r;' % (type(obj).__name__, obj))
+  elif isinstance(obj, np.generic):
+    _update_hash(h, obj.item())
+  elif isinstance(obj, np.ndarray):
+    h.update('ndarray:%s:%r;' % (obj.dtype, obj.shape))
+    if obj.dtype==object:
+      for value in obj.flat:
+        _update_hash(h, value)
+    else:
+      h.update(np.ascontiguousarray(obj).tobytes())
+  elif isinstance(obj, (pandas.DataFrame, pandas.Series)):
+    h.update('%s:%r;' % (type(obj).__name__, list(getattr(obj, 'columns', [obj.name]))))
+    _update_hash(h, pandas.util.hash_pandas_object(obj, index=True).values)
+  elif isinstance(obj, dict):
+    h.update('dict:%d;' % len(obj))
+    for (key, value) in sorted(obj.items(), key=lambda item: repr(item[0])):
+      _update_hash(h, key)
+      _update_hash(h, value)
+  elif isinstance(obj, (list, tuple)):
+    h.update('%s:%d;' % (type(obj).__name__, len(obj)))
+    for value in obj:
+      _update_hash(h, value)
+  elif isinstance(obj, (set, frozenset)):
+    _update_hash(h, sorted(obj, key=repr))
+  elif inspect.isfunction(obj) or inspect.ismethod(obj):
+    # the function's name, code and constants, and the source of its module 
+    # and of app.plotting: edits to a plot function or the helpers it calls 
+    # invalidate its outputs
+    code = getattr(obj, '__code__', getattr(obj, 'func_code', None))
+    h.update('function:%s.%s;' % (obj.__module__, obj.__name__))
+    _update_code_hash(h, code)
+    for filename in [code.co_filename] + HASHED_SOURCES:
+      _update_hash(h, _source_hash(filename))
+  elif inspect.isclass(obj) or inspect.isbuiltin(obj):
+    h.update('%s:%s.%s;' % (type(obj).__name__, obj.__module__, obj.__name__))
+  elif hasattr(obj, '__dict__'):
+    h.update('object:%s;' % type(obj).__name__)
+    _update_hash(h, vars(obj))
+  else:
+    h.update('%s:%r;' % (type(obj).__name__, obj))
+
+# A content hash of nested data structures: dicts, lists, numpy arrays, pandas 
+# objects, numbers, strings, functions, and plain objects. Dicts and sets are 
+# hashed in sorted key order, so the hash is stable across runs.
+# Returns a hex digest string.
+def content_hash(*objs):
+  h = hashlib.sha1()
+  for obj in objs:
+    _update_hash(h, obj)
+  return h.hexdigest()
+
+# Records a content hash of the inputs of every output file in a directory, so
+# that outputs whose inputs haven't changed can be skipped in later runs.
+#
+# Outputs are identified by the (outdir, filename_base) arguments that all our
+# report and plot functions take; an output comprises all files named 
+# <filename_base>.<extension>. The manifest is stored in <outdir>/.manifest.json.
+#
+# Usage:
+#   manifest = OutputManifest(args.outdir, force=args.force)
+#   manifest.run(groupstat_report, data, 'country', stats, args.outdir, 'stats')
+#
+# In worker processes, use autosave=False: outputs are then only recorded in 
+# memory, and the parent process can merge the worker's manifest.updated 
+# entries with update(...).
+#
+# force: regenerate all outputs, even if their inputs haven't changed
+# autosave: write the manifest file whenever an output is recorded?
+class OutputManifest(object):
+  def __init__(self, outdir, force=False, autosave=True):
+    self.outdir = outdir
+    self.force = force
+    self.autosave = autosave
+    self.filename = os.path.join(outdir, '.manifest.json')
+    # dict: output name -> dict of 'hash', 'files'
+    self.entries = dict()
+    if os.path.isfile(self.filename):
+      with open(self.filename) as f:
+        self.entries = json.load(f)
+    # dict: output name -> hash, for outputs that are being generated
+    self.pending = dict()
+    # dict: output name -> entry, for outputs recorded by this instance
+    self.updated = dict()
+
+  # Returns the output name for a report or plot function call, or None if the 
+  # function doesn't take (outdir, filename_base) arguments.
+  def get_name(self, fn, *args, **kwargs):
+    try:
+      callargs = inspect.getcallargs(fn, *args, **kwargs)
+    except TypeError:
+      return None
+    if 'outdir' not in callargs or 'filename_base' not in callargs:
+      return None
+    return os.path.relpath(os.path.join(callargs['outdir'], callargs['filename_base']), 
+      self.outdir)
+
+  def get_files(self, name):
+    path = os.path.join(self.outdir, name)
+    (dirname, prefix) = (os.path.dirname(path), os.path.basename(path) + '.')
+    if not os.path.isdir(dirname):
+      return []
+    return sorted([os.path.relpath(os.path.join(dirname, filename), self.outdir) 
+      for filename in os.listdir(dirname) if filename.startswith(prefix)])
+
+  # Is an output up to date? Remembers the inputs hash, for a subsequent 
+  # call to record(name).
+  # inputs: any data that determines the output; see content_hash(...)
+  def is_current(self, name, *inputs):
+    self.pending[name] = content_hash(*inputs)
+    if self.force or name not in self.entries:
+      return False
+    entry = self.entries[name]
+    if entry['hash']!=self.pending[name]:
+      return False
+    for filename in entry['files']:
+      if not os.path.isfile(os.path.join(self.outdir, filename)):
+        return False
+    return True
+
+  # Records that an output has been generated from the inputs of the last 
+  # is_current(name, ...) call.
+  def record(self, name):
+    self.entries[name] = {
+      'hash': self.pending.pop(name),
+      'files': self.get_files(name)
+    }
+    self.updated[name] = self.entries[name]
+    if self.autosave:
+      self.save()
+
+  # Adds the recorded outputs of another manifest for the same directory, 
+  # e.g. the updated entries of a worker process.
+  def update(self, entries):
+    self.entries.update(entries)
+    self.updated.update(entries)
+    self.save()
+
+  def save(self):
+    mkdir_p(self.outdir)
+    with open(self.filename, 'wb') as f:
+      json.dump(self.entries, f, sort_keys=True, indent=2)
+
+  # Calls a report or plot function, unless its output is up to date.
+  # Functions without (outdir, filename_base) arguments are always called.
+  # Returns True if the function was called.
+  def run(self, fn, *args, **kwargs):
+    name = self.get_name(fn, *args, **kwargs)
+    if name==None:
+      fn(*args, **kwargs)
+      return True
+    if self.is_current(name, fn, args, kwargs):
+      print "Skipping %s: unchanged" % name
+      return False
+    fn(*args, **kwargs)
+    self.record(name)
+    return True
@@ -0,0 +1,415 @@
+from collections import OrderedDict
+import csv
+import os
+
+import numpy as np
+import pandas
+
+from .db import getConfig
+from .io import *
+
+# ===============
+# = TSV Schemas =
+# ===============
+
+# An in-process replacement for the Postgres tables in etl/src/sql/schema.sql,
+# loaded from the TSV partition layout in etl/data/tsv/*. Tables are plain dicts
+# of column arrays; parsed columns are cached as memory-mapped .npy files.
+#
+# Column types:
+# - 'int': int64; NULL is encoded as NULL_ID
+# - 'float': float64
+# - 'timestamp': int64 seconds since the epoch
+# - 'str': a dictionary-encoded DictColumn
+# - 'action': a DictColumn with the fixed vocabulary of the 'action' enum
+
+NULL_ID = -1
+
+# The 'action' enum. This list is sorted, so it doubles as a DictColumn vocabulary.
+ACTIONS = ['add', 'remove', 'update']
+
+# Column names and types in TSV column order, as in etl/src/sql/schema.sql.
+TSV_SCHEMA = {
+  'poi': [('id', 'int'), ('version', 'int'), ('changeset', 'int'),
+    ('timestamp', 'timestamp'), ('uid', 'int'), ('username', 'str'),
+    ('latitude', 'float'), ('longitude', 'float')],
+  'poi_tag': [('poi_id', 'int'), ('version', 'int'), ('key', 'str'), ('value', 'str')],
+  'poi_sequence': [('poi_id', 'int'), ('version', 'int'),
+    ('prev_version', 'int'), ('next_version', 'int')],
+  'poi_tag_edit_action': [('poi_id', 'int'), ('version', 'int'),
+    ('key', 'str'), ('value', 'str'), ('action', 'action')],
+  'shared_poi': [('poi_id', 'int'), ('creator', 'int'), ('first_shared_version', 'int')],
+}
+
+LOCAL_TABLES = ['poi', 'poi_tag', 'poi_sequence', 'poi_tag_edit_action', 'shared_poi']
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# ===========
+# = Loading =
+# ===========
+
+# The partition files of a table, following the conventions of etl/bin/load_tsv.sh.
+# Hadoop outputs with sidecar directories (e.g. shared_poi/shared_poi/part-*) are
+# read from the sub-directory of the same name.
+# Returns (partition directory, list of files), or (None, []) if the table is absent.
+def get_partition_files(datadir, tablename):
+  path = os.path.join(datadir, tablename)
+  if not os.path.isdir(path):
+    return (None, [])
+  nested = os.path.join(path, tablename)
+  if os.path.isdir(nested):
+    path = nested
+  files = []
+  for filename in sorted(os.listdir(path)):
+    if filename.startswith('.') or filename.startswith('_'):
+      continue
+    if filename.endswith('.skip') or filename.endswith('.index') or filename.endswith('.crc'):
+      continue
+    if os.path.isfile(os.path.join(path, filename)):
+      files.append(os.path.join(path, filename))
+  return (path, files)
+
+def _read_partition(filename, colnames):
+  compression = None
+  if filename.endswith('.gz'):
+    compression = 'gzip'
+  elif filename.endswith('.bz2'):
+    compression = 'bz2'
+  elif filename.endswith('.lzo'):
+    raise Exception("LZO partitions are not supported, decompress with lzop first: %s" % filename)
+  # Postgres COPY semantics: tab-separated, no quoting, empty fields are NULL
+  return pandas.read_csv(filename, sep='\t', header=None, names=colnames,
+    quoting=csv.QUOTE_NONE, keep_default_na=False, na_values=[''],
+    compression=compression, dtype=object)
+
+def _to_int_column(values):
+  values = pandas.Series(values)
+  isnull = values.isnull().values
+  col = np.empty(len(values), dtype=np.int64)
+  col[isnull] = NULL_ID
+  col[~isnull] = values[~isnull].astype(np.int64).values
+  return col
+
+def _to_timestamp_column(values):
+  ts = pandas.to_datetime(pandas.Series(values).str.rstrip('Z'))
+  return ts.values.astype('datetime64[s]').astype(np.int64)
+
+def _to_action_column(values):
+  values = np.asarray(values, dtype=object)
+  codes = np.searchsorted(ACTIONS, values).astype(np.int32)
+  codes = np.minimum(codes, len(ACTIONS)-1)
+  unknown = np.array(ACTIONS, dtype=object)[codes]!=values
+  if unknown.any():
+    raise Exception("Unknown action value: %s" % values[unknown][0])
+  return DictColumn(codes, np.array(ACTIONS, dtype=object))
+
+# Parse the TSV partitions of a table into a dict of columns.
+def parse_tsv_table(files, schema):
+  colnames = [name for (name, coltype) in schema]
+  frames = [_read_partition(filename, colnames) for filename in files]
+  if len(frames)==0:
+    df = pandas.DataFrame(columns=colnames)
+  else:
+    df = pandas.concat(frames, ignore_index=True)
+  columns = OrderedDict()
+  for (name, coltype) in schema:
+    values = df[name].values
+    if coltype=='int':
+      columns[name] = _to_int_column(values)
+    elif coltype=='float':
+      columns[name] = values.astype(np.float64)
+    elif coltype=='timestamp':
+      columns[name] = _to_timestamp_column(values)
+    elif coltype=='action':
+      columns[name] = _to_action_column(values)
+    else:
+      columns[name] = dict_encode(values)
+  return columns
+
+# Load a table from the TSV partition layout.
+# On first load the parsed columns are stored in a ".columns" directory next to
+# the partition files; later loads memory-map them, until the partitions change.
+# Returns a dict of columns, or None if the table has no data directory.
+def load_tsv_table(datadir, tablename, use_cache=True):
+  (path, files) = get_partition_files(datadir, tablename)
+  if path==None:
+    return None
+  cachedir = os.path.join(path, '.columns')
+  signature = file_signature(files)
+  if use_cache:
+    columns = load_columns(cachedir, signature=signature)
+    if columns!=None:
+      return columns
+  columns = parse_tsv_table(files, TSV_SCHEMA[tablename])
+  if use_cache:
+    save_columns(columns, cachedir, signature=signature)
+  return columns
+
+# Load all available tables of a TSV data directory.
+# Returns a dict: tablename -> dict of columns
+def load_tsv_db(datadir, tablenames=LOCAL_TABLES, use_cache=True):
+  db = dict()
+  for tablename in tablenames:
+    table = load_tsv_table(datadir, tablename, use_cache=use_cache)
+    if table!=None:
+      db[tablename] = table
+  return db
+
+# Regions file format, as in etl/data/regions:
+# name, [further labels...], minlat, minlon, maxlat, maxlon
+# A region may be described by several bounding boxes (one per line).
+# Returns a dict of columns with one entry per bounding box:
+# gid, name, minlat, minlon, maxlat, maxlon
+def load_regions(filename):
+  names = []
+  boxes = []
+  infile = open(filename, 'rb')
+  for line in infile:
+    fields = line.rstrip('\r\n').split('\t')
+    if len(fields) < 5:
+      continue
+    names.append(fields[0])
+    boxes.append([float(v) for v in fields[-4:]])
+  infile.close()
+  boxes = np.array(boxes, dtype=np.float64).reshape((len(boxes), 4))
+  vocab, gids = np.unique(np.array(names, dtype=object), return_inverse=True)
+  return OrderedDict([
+    ('gid', gids.astype(np.int64) + 1),
+    ('name', np.array(names, dtype=object)),
+    ('minlat', boxes[:,0]), ('minlon', boxes[:,1]),
+    ('maxlat', boxes[:,2]), ('maxlon', boxes[:,3])])
+
+# The equivalent of the world_borders table for a regions file: gid, name, iso2.
+# The region name doubles as ISO2 code.
+def get_world_borders(regions):
+  (gids, idx) = np.unique(regions['gid'], return_index=True)
+  names = regions['name'][idx]
+  return OrderedDict([('gid', gids), ('name', names), ('iso2', names)])
+
+# =========
+# = Tools =
+# =========
+
+# Combines two non-negative integer key columns into a single int64 key.
+# All key pairs that are to be compared need to share the same base.
+def _pair_key(a, b, base):
+  return np.asarray(a, dtype=np.int64) * base + np.asarray(b, dtype=np.int64)
+
+def _pair_base(*columns):
+  return max([int(np.max(c)) if len(c)>0 else 0 for c in columns]) + 1
+
+# For every entry in keys: the index of the same key in sorted_keys, or -1.
+def _lookup(sorted_keys, keys):
+  if len(sorted_keys)==0:
+    return np.zeros(len(keys), dtype=np.int64) - 1
+  idx = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys)-1)
+  return np.where(sorted_keys[idx]==keys, idx, -1)
+
+# Number of distinct values per group.
+# group_idx: group index per row, in [0..num_groups)
+def _count_distinct(group_idx, values, num_groups):
+  if len(group_idx)==0:
+    return np.zeros(num_groups, dtype=np.int64)
+  order = np.lexsort((values, group_idx))
+  g = group_idx[order]
+  v = values[order]
+  is_new = np.ones(len(g), dtype=bool)
+  is_new[1:] = (g[1:]!=g[:-1]) | (v[1:]!=v[:-1])
+  return np.bincount(g[is_new], minlength=num_groups)
+
+# Per-group reduction, e.g. with np.minimum or np.maximum.
+# Every group needs at least one row.
+def _group_reduce(ufunc, group_idx, values, num_groups):
+  order = np.argsort(group_idx, kind='mergesort')
+  starts = np.searchsorted(group_idx[order], np.arange(num_groups))
+  return ufunc.reduceat(values[order], starts)
+
+# =========
+# = Views =
+# =========
+
+# Mirrors etl/src/sql/world_borders_poi.sql: the regions that contain the
+# latest version of each POI. Uses region bounding boxes in place of PostGIS
+# polygons.
+# Returns a dict of columns: country_gid, poi_id
+def view_world_borders_poi_latest(poi, regions):
+  order = np.lexsort((poi['version'], poi['id']))
+  ids = poi['id'][order]
+  is_latest = np.ones(len(ids), dtype=bool)
+  is_latest[:-1] = ids[1:]!=ids[:-1]
+  latest = order[is_latest]
+  lat = poi['latitude'][latest]
+  lon = poi['longitude'][latest]
+  poi_ids = poi['id'][latest]
+
+  gids = []
+  matches = []
+  for idx in range(len(regions['gid'])):
+    inside = np.flatnonzero(
+      (regions['minlat'][idx] <= lat) & (lat <= regions['maxlat'][idx]) &
+      (regions['minlon'][idx] <= lon) & (lon <= regions['maxlon'][idx]))
+    gids.append(np.zeros(len(inside), dtype=np.int64) + regions['gid'][idx])
+    matches.append(poi_ids[inside])
+
+  if len(gids)==0:
+    return OrderedDict([('country_gid', np.array([], dtype=np.int64)),
+      ('poi_id', np.array([], dtype=np.int64))])
+
+  gids = np.concatenate(gids)
+  matches = np.concatenate(matches)
+  # GROUP BY w.gid, p.id
+  base = _pair_base(matches)
+  keys = np.unique(_pair_key(gids, matches, base))
+  return OrderedDict([('country_gid', keys // base), ('poi_id', keys % base)])
+
+# Mirrors view_shared_poi in etl/src/sql/schema.sql: POI with more than one
+# editor, and the first version that was edited by someone other than the creator.
+# Returns a dict of columns: poi_id, creator, first_shared_version
+def view_shared_poi(poi):
+  first = (poi['version']==1) & (poi['uid']!=NULL_ID)
+  first_ids = poi['id'][first]
+  first_uids = poi['uid'][first]
+  order = np.argsort(first_ids)
+  first_ids = first_ids[order]
+  first_uids = first_uids[order]
+
+  later = np.flatnonzero((poi['version']>1) & (poi['uid']!=NULL_ID))
+  idx = _lookup(first_ids, poi['id'][later])
+  shared = idx>=0
+  later = later[shared]
+  creators = first_uids[idx[shared]]
+  later = later[poi['uid'][later]!=creators]
+
+  # MIN(p2.version) per POI
+  ids = poi['id'][later]
+  versions = poi['version'][later]
+  order = np.lexsort((versions, ids))
+  ids = ids[order]
+  versions = versions[order]
+  is_first = np.ones(len(ids), dtype=bool)
+  is_first[1:] = ids[1:]!=ids[:-1]
+  ids = ids[is_first]
+  return OrderedDict([
+    ('poi_id', ids),
+    ('creator', first_uids[_lookup(first_ids, ids)]),
+    ('first_shared_version', versions[is_first])])
+
+# Mirrors etl/src/sql/user_edit_stats.sql: per-user tag edit statistics for
+# each country.
+# poi, poi_tag_edit_action, shared_poi, world_borders_poi_latest: dicts of columns
+# Returns a dict of columns, one row per (country_gid, uid).
+def view_user_edit_stats(poi, poi_tag_edit_action, shared_poi, world_borders_poi_latest):
+  pt = poi_tag_edit_action
+  wp = world_borders_poi_latest
+
+  # JOIN poi_tag_edit_action pt ON (p.id=pt.poi_id AND p.version=pt.version)
+  base = _pair_base(poi['version'], pt['version'])
+  poi_keys = _pair_key(poi['id'], poi['version'], base)
+  poi_order = np.argsort(poi_keys)
+  idx = _lookup(poi_keys[poi_order], _pair_key(pt['poi_id'], pt['version'], base))
+  edit_rows = np.flatnonzero(idx>=0)
+  poi_rows = poi_order[idx[edit_rows]]
+  # WHERE uid IS NOT NULL
+  has_uid = poi['uid'][poi_rows]!=NULL_ID
+  edit_rows = edit_rows[has_uid]
+  poi_rows = poi_rows[has_uid]
+
+  # JOIN world_borders_poi_latest wp ON (p.id=wp.poi_id)
+  # A POI may fall into several regions: edits are repeated once per region.
+  wp_order = np.argsort(wp['poi_id'], kind='mergesort')
+  wp_poi_ids = wp['poi_id'][wp_order]
+  edit_poi_ids = poi['id'][poi_rows]
+  lo = np.searchsorted(wp_poi_ids, edit_poi_ids, side='left')
+  hi = np.searchsorted(wp_poi_ids, edit_poi_ids, side='right')
+  counts = hi - lo
+  edit_rows = np.repeat(edit_rows, counts)
+  poi_rows = np.repeat(poi_rows, counts)
+  offsets = np.arange(len(edit_rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+  country_gids = wp['country_gid'][wp_order[np.repeat(lo, counts) + offsets]]
+
+  # GROUP BY country_gid, uid
+  uids = poi['uid'][poi_rows]
+  group_base = _pair_base(uids)
+  group_keys, group_idx = np.unique(
+    _pair_key(country_gids, uids, group_base), return_inverse=True)
+  num_groups = len(group_keys)
+
+  actions = pt['action'].codes[edit_rows]
+  is_add = actions==ACTIONS.index('add')
+  is_update = actions==ACTIONS.index('update')
+  is_remove = actions==ACTIONS.index('remove')
+
+  # JOIN shared_poi sp ON (p.id=sp.poi_id AND p.version>=sp.first_shared_version)
+  sp_order = np.argsort(shared_poi['poi_id'])
+  sp_idx = _lookup(shared_poi['poi_id'][sp_order], poi['id'][poi_rows])
+  is_coll = sp_idx>=0
+  is_coll[is_coll] = poi['version'][poi_rows[is_coll]] >= \
+    shared_poi['first_shared_version'][sp_order[sp_idx[is_coll]]]
+
+  count = lambda weights=None: np.bincount(group_idx, weights=weights,
+    minlength=num_groups).astype(np.int64)
+  timestamps = poi['timestamp'][poi_rows]
+
+  stats = OrderedDict()
+  stats['country_gid'] = group_keys // group_base
+  stats['uid'] = group_keys % group_base
+  # MAX(username): vocabularies are sorted, so the max code is the max string
+  stats['username'] = DictColumn(
+    _group_reduce(np.maximum, group_idx, poi['username'].codes[poi_rows], num_groups),
+    poi['username'].vocab)
+  stats['num_poi'] = _count_distinct(group_idx, poi['id'][poi_rows], num_groups)
+  stats['num_edits'] = count()
+  stats['num_tag_add'] = count(is_add)
+  stats['num_tag_update'] = count(is_update)
+  stats['num_tag_remove'] = count(is_remove)
+  stats['num_coll_edits'] = count(is_coll)
+  stats['num_coll_tag_add'] = count(is_coll & is_add)
+  stats['num_coll_tag_update'] = count(is_coll & is_update)
+  stats['num_coll_tag_remove'] = count(is_coll & is_remove)
+  num_edits = stats['num_edits'].astype(np.float64)
+  stats['p_coll_edit'] = stats['num_coll_edits'] / num_edits
+  stats['p_coll_tag_add'] = stats['num_coll_tag_add'] / num_edits
+  stats['p_coll_tag_update'] = stats['num_coll_tag_update'] / num_edits
+  stats['p_coll_tag_remove'] = stats['num_coll_tag_remove'] / num_edits
+  # count(distinct key) ignores NULL keys, which have code -1
+  key_codes = pt['key'].codes[edit_rows]
+  has_key = key_codes>=0
+  stats['num_tag_keys'] = _count_distinct(group_idx[has_key], key_codes[has_key], num_groups)
+  stats['days_active'] = _count_distinct(group_idx, timestamps // SECONDS_PER_DAY, num_groups)
+  stats['activity_period_days'] = (
+    _group_reduce(np.maximum, group_idx, timestamps, num_groups) -
+    _group_reduce(np.minimum, group_idx, timestamps, num_groups)) // SECONDS_PER_DAY
+  return stats
+
+# Computes the derived tables of a TSV data directory, in the order of the ETL
+# scripts: shared_poi (if not provided as partitions), world_borders_poi_latest,
+# world_borders, user_edit_stats.
+# Returns a dict: tablename -> dict of columns
+def build_local_db(datadir, regions_file, use_cache=True):
+  db = load_tsv_db(datadir, use_cache=use_cache)
+  if 'shared_poi' not in db:
+    db['shared_poi'] = view_shared_poi(db['poi'])
+  regions = load_regions(regions_file)
+  db['world_borders'] = get_world_borders(regions)
+  db['world_borders_poi_latest'] = view_world_borders_poi_latest(db['poi'], regions)
+  db['user_edit_stats'] = view_user_edit_stats(db['poi'], db['poi_tag_edit_action'],
+    db['shared_poi'], db['world_borders_poi_latest'])
+  return db
+
+# ============
+# = Local DB =
+# ============
+
+localdb = None
+
+# The local DB, as configured in the [local] section of the settings file:
+# datadir: a TSV data directory, e.g. etl/data/tsv/test-poi
+# regions: a regions file, e.g. etl/data/tsv/test-poi/regions/test-regions.txt
+def getLocalDb():
+  global localdb
+  if (localdb==None):
+    localdb = build_local_db(
+      getConfig().get('local', 'datadir'),
+      getConfig().get('local', 'regions'))
+  return localdb
@@ -40,6 +40,24 @@ def percentile_range(values, from_pc, to_pc, descending=False):
   to_idx = get_percentile_index(length, to_pc)
   return values[from_idx:to_idx]
 
+# Population sizes and shares of equal-sized percentile bands of entries, 
+# computed from a single sort. Band boundaries are placed as in percentile_range.
+# Band sums are differences of one cumulative sum rather than sums of each band,
+# so for float values they can differ from percentile_range_sum in the last 
+# digits.
+#
+# values: array of numbers
+# num_bands: the number of bands, in ascending order of values
+# Returns a tuple of numpy arrays with one entry per band: (population sizes, shares)
+def percentile_band_shares(values, num_bands):
+  values = np.sort(values)
+  length = len(values)
+  edges = np.array([get_percentile_index(length, Decimal(band) / num_bands * 100)
+    for band in range(num_bands + 1)])
+  cumsum = np.concatenate([[0], np.cumsum(values)])
+  band_sums = cumsum[edges[1:]] - cumsum[edges[:-1]]
+  return (np.diff(edges), band_sums / float(cumsum[-1]))
+
 # What is the sum of a percentile segment of entries?
 #
 # values: array of numbers
@@ -1,6 +1,16 @@
 from collections import defaultdict
+import csv
+import gc
+import multiprocessing
+import os
+import resource
+import time
+import traceback
 
+from matplotlib import rcParams
+from matplotlib.colors import LinearSegmentedColormap, LogNorm, colorConverter
 import matplotlib.pyplot as plt
+from matplotlib.transforms import Affine2D, Bbox
 import numpy
 
 # ==================
@@ -76,8 +86,38 @@ def autoscale_axes_ylim(axes):
   for ax1 in axes:
     ax1.set_ylim(bottom, top)
 
+# The figure size and subplot spacing of a plot_matrix(...) grid. Layouts only
+# depend on the grid shape and cell dimensions, so they are computed once and 
+# shared by all figures of the same shape, see get_matrix_layout(...).
+class MatrixLayout(object):
+  def __init__(self, ncols, nrows, cellwidth=3, cellheight=3, hspace=0.2, wspace=0.2):
+    self.ncols = ncols
+    self.nrows = nrows
+    self.figsize = (cellwidth*ncols, cellheight*nrows)
+    self.gridspec_kw = dict(hspace=hspace, wspace=wspace)
+
+  # Creates a new figure with the full grid of axes, in a single call.
+  # Returns a tuple (figure, numpy array of axes with shape (nrows, ncols))
+  def create_figure(self):
+    (fig, axarr) = plt.subplots(self.nrows, self.ncols, figsize=self.figsize, 
+      squeeze=False, gridspec_kw=self.gridspec_kw)
+    fig.patch.set_facecolor('white')
+    return (fig, axarr)
+
+# dict: (ncols, nrows, cellwidth, cellheight, hspace, wspace) -> MatrixLayout
+MATRIX_LAYOUTS = {}
+
+def get_matrix_layout(ncols, nrows, cellwidth=3, cellheight=3, hspace=0.2, wspace=0.2):
+  key = (ncols, nrows, cellwidth, cellheight, hspace, wspace)
+  if key not in MATRIX_LAYOUTS:
+    MATRIX_LAYOUTS[key] = MatrixLayout(*key)
+  return MATRIX_LAYOUTS[key]
+
 # A generator that prepares a matrix layout of subplots and yields a tuple for each cell.
 # This iterates over rows first -- i.e., the fist tuples returned are for the top row of cells.
+# All axes are created up front. Each cell's axes is made the current axes 
+# before it is yielded, so plt.* calls draw into the cell. Shared scales are 
+# applied after all cells are drawn: the union of the cells' autoscaled limits.
 # 
 # Expected parameters:
 # - columns: list of column names for this matrix
@@ -88,54 +128,648 @@ def autoscale_axes_ylim(axes):
 # - cellheight:
 # - shared_xscale: maintain x-axis range along cells in the same column?
 # - xgroups: a nested list of column names, this can be used to link related columns that should have the same x-axis range: ['a', 'b', ['c', 'd']]
-# - shared_xscale: maintain y-axis range along cells in the same row?
+# - shared_yscale: maintain y-axis range along cells in the same row?
 # - autofmt_xdate: call fig.autofmt_xdate() after plotting?
+# - rasterized: render each cell as a bitmap in vector formats (PDF), e.g. for
+#   grids with thousands of cells
 # 
 # The tuple yielded per cell contains the values:
 # - col: the column name for this cell
 # - row: the row name
 # - ax1: a matplotlib subplot handle
 def plot_matrix(columns, rows, cellwidth=3, cellheight=3, shared_xscale=False, 
-  xgroups=None, shared_yscale=False, hspace=0.2, wspace=0.2, autofmt_xdate=False):
+  xgroups=None, shared_yscale=False, hspace=0.2, wspace=0.2, autofmt_xdate=False,
+  rasterized=False):
   
   ncols = len(columns)
   nrows = len(rows)
 
-  fig = plt.figure(figsize=(cellwidth*ncols, cellheight*nrows))
-  plt.subplots_adjust(hspace=hspace, wspace=wspace)
-  fig.patch.set_facecolor('white')
-
-  # dict: row -> column -> ax1
-  axes = defaultdict(dict)
-  n = 1
-  for row in rows:
-    for column in columns:
+  layout = get_matrix_layout(ncols, nrows, cellwidth=cellwidth, 
+    cellheight=cellheight, hspace=hspace, wspace=wspace)
+  (fig, axarr) = layout.create_figure()
 
-      if n <= ncols: # first row
-        ax1 = plt.subplot(nrows, ncols, n, title=column)
-      else:
-        ax1 = plt.subplot(nrows, ncols, n)
-      axes[row][column] = ax1
-      
-      if (n % ncols == 1): # first column
-        plt.ylabel(row)
-      
+  for (rowidx, row) in enumerate(rows):
+    for (colidx, column) in enumerate(columns):
+      ax1 = axarr[rowidx, colidx]
+      if rowidx==0:
+        ax1.set_title(column)
+      if colidx==0:
+        ax1.set_ylabel(row)
+      if rasterized:
+        ax1.set_rasterized(True)
+      fig.sca(ax1)
       yield (column, row, ax1)
-      n += 1
 
-    if shared_yscale: # for every row: shared scale across columns?
-      autoscale_axes_ylim(axes[row].values())
+  if shared_yscale: # for every row: shared scale across columns
+    for rowidx in range(nrows):
+      autoscale_axes_ylim(axarr[rowidx, :])
 
-  if shared_xscale: # for every column: shared scale across rows?
+  if shared_xscale: # for every column: shared scale across rows
+    column_index = dict([(column, idx) for (idx, column) in enumerate(columns)])
     if xgroups==None:
       xgroups = columns
     for xgroup in xgroups:
       if isinstance(xgroup, list) or isinstance(xgroup, numpy.ndarray):
-        group_axes = [axes[row][col] for row in axes.keys() for col in xgroup]
-        autoscale_axes_xlim(group_axes)
+        autoscale_axes_xlim(axarr[:, [column_index[col] for col in xgroup]].ravel())
       else:
-        group_axes = [axes[row][xgroup] for row in axes.keys()]
-        autoscale_axes_xlim(group_axes)
+        autoscale_axes_xlim(axarr[:, column_index[xgroup]])
   
   if autofmt_xdate:
     fig.autofmt_xdate()
+
+# ===================
+# = Density scatter =
+# ===================
+
+# Above this number of points, scatter_points(...) draws a density raster by default.
+DENSITY_THRESHOLD = 20000
+
+# Bin edges for a density grid.
+# scale: 'linear' or 'log'; log edges require positive values.
+def get_density_bins(values, bins, scale='linear'):
+  (minval, maxval) = (numpy.min(values), numpy.max(values))
+  if scale=='log':
+    (minval, maxval) = (numpy.log10(minval), numpy.log10(maxval))
+  if minval==maxval:
+    (minval, maxval) = (minval - 0.5, maxval + 0.5)
+  if scale=='log':
+    return numpy.logspace(minval, maxval, bins + 1)
+  return numpy.linspace(minval, maxval, bins + 1)
+
+# Draws a set of points as a scatter plot or, for large point sets, as a shaded
+# density raster: points are binned on a 2D grid, and cells are shaded by the 
+# log of their point count.
+#
+# ax1: matplotlib axes
+# x, y: lists or arrays of coordinates
+# density: True to draw a density raster, False for a scatter plot, or None to 
+#   pick a density raster when there are more than DENSITY_THRESHOLD points.
+# scale: 'linear' or 'log' binning, matching the axis scale. With log scale, 
+#   points with non-positive coordinates are not shown in density rasters.
+# bins: the number of grid cells along each axis
+# outliers: in density mode, also draw the points of grid cells with at most 
+#   this many points as a regular scatter plot
+# color: the colour of points, and of the densest raster cells. Density rasters
+#   default to QUALITATIVE_DARK[0].
+# kwargs is passed on to ax1.scatter(...).
+def scatter_points(ax1, x, y, density=None, scale='linear', bins=200, outliers=0,
+  color=None, **kwargs):
+
+  if density==None:
+    density = (len(x) > DENSITY_THRESHOLD)
+  if not density:
+    if color!=None:
+      kwargs['color'] = color
+    return ax1.scatter(x, y, **kwargs)
+  if color==None:
+    color = QUALITATIVE_DARK[0]
+
+  x = numpy.asarray(x, dtype=float)
+  y = numpy.asarray(y, dtype=float)
+  valid = numpy.isfinite(x) & numpy.isfinite(y)
+  if scale=='log':
+    valid &= (x>0) & (y>0)
+  (x, y) = (x[valid], y[valid])
+  if len(x)==0:
+    return None
+
+  xbins = get_density_bins(x, bins, scale)
+  ybins = get_density_bins(y, bins, scale)
+  (counts, xbins, ybins) = numpy.histogram2d(x, y, bins=[xbins, ybins])
+
+  # sparse cells are translucent, dense cells are darker shades of the colour
+  rgb = colorConverter.to_rgb(color)
+  dark = tuple([v * 0.4 for v in rgb])
+  cmap = LinearSegmentedColormap.from_list('density', 
+    [rgb + (0.2,), rgb + (1.0,), dark + (1.0,)])
+  mesh = ax1.pcolormesh(xbins, ybins, numpy.ma.masked_equal(counts.T, 0), 
+    cmap=cmap, norm=LogNorm(vmin=1, vmax=max(counts.max(), 2)), 
+    edgecolors='none', rasterized=True)
+
+  if outliers > 0:
+    xidx = numpy.clip(numpy.searchsorted(xbins, x, side='right') - 1, 0, bins - 1)
+    yidx = numpy.clip(numpy.searchsorted(ybins, y, side='right') - 1, 0, bins - 1)
+    sparse = (counts[xidx, yidx] <= outliers)
+    ax1.scatter(x[sparse], y[sparse], color=color, **kwargs)
+  return mesh
+
+# =============
+# = Box plots =
+# =============
+
+# Above this number of fliers per box, draw_boxplots(...) shows an evenly spaced 
+# subset of them, which always includes the most extreme values.
+MAX_FLIERS = 1000
+
+# ax1.bxp(...) style properties that default to rcParams['boxplot.<name>.<prop>']
+BOXPLOT_PROPS = {
+  'boxprops': ['color', 'linewidth', 'linestyle'],
+  'whiskerprops': ['color', 'linewidth', 'linestyle'],
+  'capprops': ['color', 'linewidth', 'linestyle'],
+  'medianprops': ['color', 'linewidth', 'linestyle'],
+  'meanprops': ['color', 'linewidth', 'linestyle'],
+  'flierprops': ['color', 'marker', 'markerfacecolor', 'markeredgecolor',
+    'markersize', 'linestyle', 'linewidth'],
+}
+
+# ax1.bxp(...) flag -> rcParams key of its default
+BOXPLOT_FLAGS = {
+  'vert': 'boxplot.vertical',
+  'patch_artist': 'boxplot.patchartist',
+  'shownotches': 'boxplot.notch',
+  'meanline': 'boxplot.meanline',
+  'showmeans': 'boxplot.showmeans',
+  'showcaps': 'boxplot.showcaps',
+  'showbox': 'boxplot.showbox',
+  'showfliers': 'boxplot.showfliers',
+}
+
+# Linearly interpolated percentiles of an unsorted array, as computed by 
+# numpy.percentile(...), but based on a partial sort.
+def partition_percentiles(values, percentiles):
+  positions = [(len(values) - 1) * perc / 100.0 for perc in percentiles]
+  below = [int(numpy.floor(pos)) for pos in positions]
+  above = [int(numpy.ceil(pos)) for pos in positions]
+  part = numpy.partition(values, sorted(set(below + above)))
+  return [part[lo] * (1 - (pos - lo)) + part[hi] * (pos - lo)
+    for (pos, lo, hi) in zip(positions, below, above)]
+
+# Every n-th of the given values in sorted order, including the first and last.
+def sample_sorted(values, num_samples):
+  if len(values) <= num_samples:
+    return values
+  idx = numpy.unique(numpy.round(numpy.linspace(0, len(values) - 1, num_samples)).astype(int))
+  return numpy.partition(values, idx)[idx]
+
+# Box plot statistics, in the format used by ax1.bxp(...). The results match
+# ax1.boxplot(...), but are computed with partial sorts, and the set of fliers 
+# can be capped. The result is small and picklable, so it can be computed 
+# in a worker process, e.g. with multiprocessing.Pool.map(...).
+#
+# values: list or array of numbers
+# whis: whisker reach, as a multiple of the interquartile range
+# max_fliers: maximum number of fliers, or None to keep all. Use 0 to skip fliers.
+# label: box label
+#
+# Returns a dict with the keys: med, q1, q3, iqr, whislo, whishi, fliers, mean,
+# cilo, cihi, min, max, count, label
+def boxplot_stats(values, whis=1.5, max_fliers=None, label=None):
+  x = numpy.asarray(values, dtype=float).ravel()
+  stats = {'count': len(x), 'fliers': numpy.array([])}
+  if label!=None:
+    stats['label'] = label
+  if len(x)==0:
+    for key in ['med', 'q1', 'q3', 'iqr', 'whislo', 'whishi', 'mean', 
+      'cilo', 'cihi', 'min', 'max']:
+      stats[key] = numpy.nan
+    return stats
+
+  (q1, med, q3) = partition_percentiles(x, [25, 50, 75])
+  iqr = q3 - q1
+  stats.update({'q1': q1, 'med': med, 'q3': q3, 'iqr': iqr, 
+    'mean': numpy.mean(x), 'min': numpy.min(x), 'max': numpy.max(x),
+    'cilo': med - 1.57 * iqr / numpy.sqrt(len(x)),
+    'cihi': med + 1.57 * iqr / numpy.sqrt(len(x))})
+
+  # whiskers reach the most extreme values within whis*IQR of the box
+  wisklo = x[x >= q1 - whis * iqr]
+  wiskhi = x[x <= q3 + whis * iqr]
+  stats['whislo'] = q1 if (len(wisklo)==0 or numpy.min(wisklo) > q1) else numpy.min(wisklo)
+  stats['whishi'] = q3 if (len(wiskhi)==0 or numpy.max(wiskhi) < q3) else numpy.max(wiskhi)
+
+  if max_fliers!=0:
+    fliers = numpy.concatenate([x[x < stats['whislo']], x[x > stats['whishi']]])
+    if max_fliers!=None:
+      fliers = sample_sorted(fliers, max_fliers)
+    stats['fliers'] = fliers
+  return stats
+
+# Approximate box plot statistics from a quantile sketch, or any other summary 
+# that can estimate quantiles without keeping all values. Whiskers reach to 
+# whis*IQR, or to the min/max value; only the min/max values are shown as fliers.
+#
+# quantile: function that maps a probability [0..1] to a value
+# count, minval, maxval: the number of values, and their range
+# mean: the mean value, if known
+# Returns a dict, see boxplot_stats(...)
+def sketch_boxplot_stats(quantile, count, minval, maxval, mean=None, whis=1.5, 
+  label=None):
+  (q1, med, q3) = (quantile(0.25), quantile(0.5), quantile(0.75))
+  iqr = q3 - q1
+  stats = {'count': count, 'q1': q1, 'med': med, 'q3': q3, 
+    'iqr': iqr, 'min': minval, 'max': maxval,
+    'mean': numpy.nan if mean==None else mean,
+    'cilo': med - 1.57 * iqr / numpy.sqrt(count),
+    'cihi': med + 1.57 * iqr / numpy.sqrt(count),
+    'whislo': max(minval, q1 - whis * iqr),
+    'whishi': min(maxval, q3 + whis * iqr)}
+  stats['fliers'] = numpy.array([v for v in [minval, maxval] 
+    if v < stats['whislo'] or v > stats['whishi']])
+  if label!=None:
+    stats['label'] = label
+  return stats
+
+# Draws box plots with ax1.bxp(...), from values or precomputed statistics.
+#
+# ax1: matplotlib axes
+# celldata: a list with one entry per box: either a list of values, or a dict 
+#   of statistics as produced by boxplot_stats(...) or sketch_boxplot_stats(...)
+# positions: box positions, default: 1..n
+# whis, max_fliers: see boxplot_stats(...)
+# sym: flier marker, as for ax1.boxplot(...). An empty string hides fliers.
+# kwargs is passed on to ax1.bxp(...).
+#
+# Returns a tuple: (the list of box statistics, the dict of artists from ax1.bxp(...))
+def draw_boxplots(ax1, celldata, positions=None, whis=1.5, max_fliers=MAX_FLIERS, 
+  sym=None, **kwargs):
+  
+  # the rcParams defaults that ax1.boxplot(...) applies
+  for (name, props) in BOXPLOT_PROPS.items():
+    kwargs[name] = dict(kwargs.get(name) or {})
+    for prop in props:
+      kwargs[name].setdefault(prop, rcParams['boxplot.%s.%s' % (name, prop)])
+  for (name, key) in BOXPLOT_FLAGS.items():
+    kwargs.setdefault(name, rcParams[key])
+  if kwargs['patch_artist']:
+    kwargs['boxprops']['linestyle'] = 'solid'
+    kwargs['boxprops']['edgecolor'] = kwargs['boxprops'].pop('color')
+
+  if sym=='':
+    kwargs['flierprops'] = dict(linestyle='none', marker='', color='none')
+    kwargs['showfliers'] = False
+    max_fliers = 0
+  elif sym!=None:
+    kwargs['flierprops']['marker'] = sym
+
+  stats = [cell if isinstance(cell, dict) else 
+    boxplot_stats(cell, whis=whis, max_fliers=max_fliers) for cell in celldata]
+  if positions==None:
+    positions = range(1, len(stats) + 1)
+  return (stats, ax1.bxp(stats, positions=positions, **kwargs))
+
+# =============
+# = Q-Q plots =
+# =============
+
+# The default number of quantiles drawn per Q-Q plot.
+QQ_QUANTILES = 1000
+
+# Positions in a sorted array of n values at which Q-Q plots take quantiles.
+# Half of the positions are evenly spaced, the other half are log-spaced 
+# towards both ends, where they fall on individual observations. The first 
+# and last positions are the minimum and maximum.
+# 
+# n: the number of values
+# num_quantiles: the approximate number of positions, or None for all values
+# Returns a float numpy array of positions in [0, n-1], in ascending order.
+def qq_positions(n, num_quantiles=QQ_QUANTILES):
+  if num_quantiles==None or n <= num_quantiles:
+    return numpy.arange(n, dtype=float)
+  num_tail = num_quantiles // 4
+  tail = numpy.round(numpy.logspace(0, numpy.log10((n - 1) / 2.0), num_tail))
+  linear = numpy.linspace(0, n - 1, num_quantiles - 2 * num_tail)
+  return numpy.unique(numpy.concatenate([linear, tail, (n - 1) - tail]))
+
+# Quantiles of every column of a matrix, for Q-Q plots. Quantiles are linearly
+# interpolated between adjacent values, as by numpy.percentile(...).
+#
+# values: numpy array of values, one column per variable; or a 1D array
+# num_quantiles: see qq_positions(...)
+# is_sorted: are the columns already sorted in ascending order?
+# Returns a tuple (probabilities, quantiles): a 1D array of probabilities in
+# [0..1], and an array with one row of quantiles per probability, and one column
+# per variable. The matching quantiles of a reference distribution can be 
+# computed from the probabilities, e.g. with scipy.stats.norm.ppf(probabilities).
+def qq_quantiles(values, num_quantiles=QQ_QUANTILES, is_sorted=False):
+  values = numpy.asarray(values, dtype=float)
+  if not is_sorted:
+    values = numpy.sort(values, axis=0)
+  n = values.shape[0]
+  pos = qq_positions(n, num_quantiles)
+  lo = numpy.floor(pos).astype(int)
+  hi = numpy.minimum(lo + 1, n - 1)
+  weight = (pos - lo).reshape((-1,) + (1,) * (values.ndim - 1))
+  quantiles = values[lo] * (1 - weight) + values[hi] * weight
+  return (pos / max(n - 1, 1), quantiles)
+
+# ==================
+# = Saving figures =
+# ==================
+
+# File formats written by save_figure(...), e.g. ['png'] for quick drafts.
+# Can be set per run with the FIGURE_FORMATS environment variable, as a 
+# comma-separated list: FIGURE_FORMATS=png python ...
+FIGURE_FORMATS = os.environ.get('FIGURE_FORMATS', 'pdf,png').split(',')
+
+def set_figure_formats(formats):
+  global FIGURE_FORMATS
+  FIGURE_FORMATS = list(formats)
+
+# The tight bounding box of a figure in inches, as computed by 
+# savefig(..., bbox_inches='tight'), but from a single draw of the figure.
+def get_tight_bbox(fig, pad_inches=None):
+  fig.canvas.draw()
+  renderer = fig._cachedRenderer
+  bbox_inches = fig.get_tightbbox(renderer)
+
+  bbox_filtered = []
+  for a in fig.get_default_bbox_extra_artists():
+    bbox = a.get_window_extent(renderer)
+    if a.get_clip_on():
+      clip_box = a.get_clip_box()
+      if clip_box is not None:
+        bbox = Bbox.intersection(bbox, clip_box)
+      clip_path = a.get_clip_path()
+      if clip_path is not None and bbox is not None:
+        bbox = Bbox.intersection(bbox, 
+          clip_path.get_fully_transformed_path().get_extents())
+    if bbox is not None and (bbox.width!=0 or bbox.height!=0):
+      bbox_filtered.append(bbox)
+  if len(bbox_filtered) > 0:
+    bbox_extra = Bbox.union(bbox_filtered).transformed(
+      Affine2D().scale(1.0 / fig.dpi))
+    bbox_inches = Bbox.union([bbox_inches, bbox_extra])
+
+  if pad_inches==None:
+    pad_inches = rcParams['savefig.pad_inches']
+  return bbox_inches.padded(pad_inches)
+
+# Saves a figure in all configured formats, as <outdir>/<filename_base>.<format>.
+# The tight layout is computed once and reused for every format, rather than 
+# re-drawing the figure to find its bounding box for every file.
+# fig: the figure to save; by default the current figure
+# formats: list of file formats; by default FIGURE_FORMATS
+# kwargs is passed on to fig.savefig(...).
+def save_figure(outdir, filename_base, fig=None, formats=None, **kwargs):
+  if fig==None:
+    fig = plt.gcf()
+  if formats==None:
+    formats = FIGURE_FORMATS
+  bbox_inches = get_tight_bbox(fig)
+  for format in formats:
+    fig.savefig("%s/%s.%s" % (outdir, filename_base, format), 
+      bbox_inches=bbox_inches, **kwargs)
+
+# =====================
+# = Memory accounting =
+# =====================
+
+# Peak resident set size of this process since it started, in MB.
+def get_peak_rss_mb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# Current resident set size of this process, in MB. Falls back to the peak RSS
+# on systems without /proc.
+def get_rss_mb():
+  try:
+    with open('/proc/self/statm') as f:
+      pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / (1024.0 * 1024.0)
+  except (IOError, OSError):
+    return get_peak_rss_mb()
+
+# The kernel's RSS high-water mark (VmHWM) in MB, or None if unavailable.
+def _get_hwm_mb():
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) / 1024.0
+  except (IOError, OSError):
+    pass
+  return None
+
+# Resets the RSS high-water mark to the current RSS (Linux 4.0+).
+# Returns False if this isn't supported.
+def _reset_hwm():
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return _get_hwm_mb()!=None
+  except (IOError, OSError):
+    return False
+
+# The PeakRSS instances that are currently measuring, innermost last.
+_active_peaks = []
+
+# Measures the peak RSS of a section of code, rather than of the whole process:
+# the kernel's high-water mark is reset when measuring starts. Measurements can 
+# be nested. Where the high-water mark can't be reset, the process-wide peak 
+# (get_peak_rss_mb) is reported instead.
+#
+# Usage:
+#   peak = PeakRSS().start()
+#   ...
+#   peak.stop()
+#   print peak.rss_mb, peak.peak_mb
+class PeakRSS(object):
+  def start(self):
+    self.rss_mb = get_rss_mb()
+    self.peak_mb = self.rss_mb
+    # outer measurements keep the peak reached so far
+    hwm = _get_hwm_mb()
+    if hwm!=None:
+      for outer in _active_peaks:
+        outer.peak_mb = max(outer.peak_mb, hwm)
+    self.is_exact = _reset_hwm()
+    _active_peaks.append(self)
+    return self
+
+  def stop(self):
+    if self.is_exact:
+      self.peak_mb = max(self.peak_mb, _get_hwm_mb())
+    else:
+      self.peak_mb = get_peak_rss_mb()
+    if self in _active_peaks:
+      _active_peaks.remove(self)
+    return self
+
+  # The growth of the peak RSS over the RSS at the start, in MB.
+  def growth_mb(self):
+    return self.peak_mb - self.rss_mb
+
+# ===================
+# = Figure sessions =
+# ===================
+
+# The maximum number of open figures, or None for no limit. When a 
+# FigureSession starts with this many figures open, the oldest are closed.
+# Can be set per run with the MAX_LIVE_FIGURES environment variable.
+MAX_LIVE_FIGURES = int(os.environ['MAX_LIVE_FIGURES']) if os.environ.get('MAX_LIVE_FIGURES') else None
+
+def set_max_live_figures(max_live):
+  global MAX_LIVE_FIGURES
+  MAX_LIVE_FIGURES = max_live
+
+# Memory use of all figures rendered in this process, in order: a list of 
+# dicts with the keys: label, seconds, rss_mb (before the figure was drawn), 
+# peak_rss_mb (the peak RSS while the figure was drawn, see PeakRSS), 
+# growth_mb (peak RSS growth while drawing), retained_mb (RSS growth that 
+# remains after the figure was closed).
+# Figures rendered by a FigureQueue's workers are collected here by join().
+FIGURE_MEMORY = []
+
+FIGURE_MEMORY_COLUMNS = ['label', 'seconds', 'rss_mb', 'peak_rss_mb', 
+  'growth_mb', 'retained_mb']
+
+# A context manager for drawing a figure. On exit, every figure that was opened
+# within the session is closed and garbage is collected, even if drawing failed,
+# and the figure's memory use is appended to FIGURE_MEMORY.
+#
+# Usage:
+#   with FigureSession(filename_base):
+#     for (col, row, ax1) in plot_matrix(...):
+#       ...
+#     save_figure(outdir, filename_base)
+#
+# label: a name for the figure in FIGURE_MEMORY
+# max_live: the maximum number of open figures; by default MAX_LIVE_FIGURES
+class FigureSession(object):
+  def __init__(self, label=None, max_live=None):
+    self.label = label
+    self.max_live = max_live if max_live!=None else MAX_LIVE_FIGURES
+
+  def __enter__(self):
+    fignums = sorted(plt.get_fignums())
+    if self.max_live!=None and len(fignums) >= self.max_live:
+      stale = fignums[:len(fignums) - self.max_live + 1]
+      print "Closing %d open figures: limit of %d live figures reached" % (
+        len(stale), self.max_live)
+      for num in stale:
+        plt.close(num)
+    self.fignums = set(plt.get_fignums())
+    self.start = time.time()
+    self.peak = PeakRSS().start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    self.peak.stop()
+    for num in set(plt.get_fignums()) - self.fignums:
+      plt.close(num)
+    gc.collect()
+    FIGURE_MEMORY.append({
+      'label': self.label, 
+      'seconds': time.time() - self.start,
+      'rss_mb': self.peak.rss_mb, 
+      'peak_rss_mb': self.peak.peak_mb,
+      'growth_mb': self.peak.growth_mb(),
+      'retained_mb': get_rss_mb() - self.peak.rss_mb})
+    return False
+
+# Removes and returns the FIGURE_MEMORY records from index start onwards, e.g. 
+# to send the records of a worker process back to its parent.
+def pop_figure_memory(start=0):
+  records = FIGURE_MEMORY[start:]
+  del FIGURE_MEMORY[start:]
+  return records
+
+# Writes FIGURE_MEMORY to <outdir>/<filename_base>.txt, one figure per row.
+def write_figure_memory(outdir, filename_base='figure_memory'):
+  outfile = open("%s/%s.txt" % (outdir, filename_base), 'wb')
+  outcsv = csv.writer(outfile, dialect='excel-tab')
+  outcsv.writerow(FIGURE_MEMORY_COLUMNS)
+  for rec in FIGURE_MEMORY:
+    outcsv.writerow([rec[col] for col in FIGURE_MEMORY_COLUMNS])
+  outfile.close()
+
+# ====================
+# = Figure rendering =
+# ====================
+
+def init_figure_worker():
+  plt.switch_backend('Agg')
+
+# Renders a single figure job, and closes all figures afterwards.
+# job: a tuple (plot function, args, kwargs)
+# Returns a tuple (error message or None if the figure was rendered, list of 
+# FIGURE_MEMORY records of the job). The records are removed from this 
+# process's FIGURE_MEMORY; FigureQueue.join() adds them back in order.
+def render_figure(job):
+  (plot_fn, args, kwargs) = job
+  start = len(FIGURE_MEMORY)
+  error = None
+  try:
+    plot_fn(*args, **kwargs)
+  except Exception:
+    error = traceback.format_exc()
+  finally:
+    plt.close('all')
+  return (error, pop_figure_memory(start))
+
+# A queue of figure jobs that are rendered by a pool of worker processes with 
+# the Agg backend. A job is a plot function that saves its own figure, and its 
+# arguments. Jobs are sent to the workers by pickling, so plot functions need to
+# be defined at module level, and arguments can't contain lambdas (e.g. 
+# defaultdict factories).
+#
+# Figures are rendered in-process when workers<=1, or when the queue is created 
+# in a daemonic process such as a multiprocessing.Pool worker, which can't have
+# child processes.
+#
+# With an app.io.OutputManifest, figures whose plot function, arguments and 
+# output formats are unchanged since the last run are skipped.
+#
+# Usage:
+#   figures = FigureQueue(workers=4)
+#   figures.submit(plot_fn, data, outdir, filename_base, **kwargs)
+#   ...
+#   figures.join()
+#
+# workers: the number of worker processes, or None for the number of CPUs
+# manifest: an OutputManifest, or None to render all figures
+class FigureQueue(object):
+  def __init__(self, workers=None, manifest=None):
+    if workers==None:
+      workers = multiprocessing.cpu_count()
+    if multiprocessing.current_process().daemon:
+      workers = 1
+    self.pool = None
+    if workers > 1:
+      self.pool = multiprocessing.Pool(workers, initializer=init_figure_worker)
+    self.manifest = manifest
+    # list of (job label, output name, render_figure result or AsyncResult)
+    self.jobs = []
+
+  def submit(self, plot_fn, *args, **kwargs):
+    name = None
+    if self.manifest!=None:
+      name = self.manifest.get_name(plot_fn, *args, **kwargs)
+      if name!=None and self.manifest.is_current(name, plot_fn, args, kwargs, FIGURE_FORMATS):
+        print "Skipping %s: unchanged" % name
+        return
+    label = name or "%s #%d" % (plot_fn.__name__, len(self.jobs) + 1)
+    job = (plot_fn, args, kwargs)
+    if self.pool==None:
+      self.jobs.append((label, name, render_figure(job)))
+    else:
+      self.jobs.append((label, name, self.pool.apply_async(render_figure, (job,))))
+
+  # Waits for all submitted jobs, then reports failed jobs in submission order.
+  # The figures' memory use is appended to FIGURE_MEMORY in submission order.
+  # Raises an Exception if any of the jobs failed.
+  def join(self):
+    errors = []
+    for (label, name, result) in self.jobs:
+      if self.pool!=None:
+        try:
+          result = result.get()
+        except Exception:
+          result = (traceback.format_exc(), [])
+      (error, memory) = result
+      FIGURE_MEMORY.extend(memory)
+      if error!=None:
+        errors.append((label, error))
+      elif name!=None:
+        self.manifest.record(name)
+    self.jobs = []
+    if self.pool!=None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+
+    for (label, error) in errors:
+      print "Error rendering figure %s:" % label
+      print error
+    if len(errors) > 0:
+      raise Exception("Failed to render %d figures: %s" % (
+        len(errors), ", ".join([label for (label, error) in errors])))
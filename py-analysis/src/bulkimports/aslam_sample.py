@@ -12,7 +12,10 @@ from collections import defaultdict
 import random
 import sys
 
+import numpy as np
+
 from app import *
+from metrics import *
 
 # ===========
 # = Reports =
@@ -54,6 +57,43 @@ def aslamSample(ranked_items, count):
     ) for b in sorted(bucket_sample_count.keys())]
   # flatten this nested list and return
   return [item for sublist in samples for item in sublist]
+
+# Bucket allocation for aslamSample, drawn as a single multinomial.
+# num_items: population size
+# count: number of items to sample; this is also the bucket size.
+# Returns a tuple of numpy arrays: (bucket sizes, number of samples per bucket).
+def aslam_allocation(num_items, count):
+  num_buckets = int(np.ceil(num_items / count))
+  bucket_sizes = np.minimum(count, num_items - np.arange(num_buckets) * count)
+  bucket_samples = np.random.multinomial(count, np.ones(num_buckets) / num_buckets)
+  return (bucket_sizes, np.minimum(bucket_samples, bucket_sizes))
+
+# Streaming variant of aslamSample, with the same sampling design.
+# Sample positions are drawn up front per bucket, then the items are consumed in
+# a single pass, so only the sampled items are held in memory.
+# ranked_items: iterable, in descending order of sampling weight.
+# num_items: number of items in ranked_items
+# count: number of items to sample.
+# Returns a list of (item, bucket index, inclusion probability) tuples, in input order.
+def aslam_sample_stream(ranked_items, num_items, count):
+  (bucket_sizes, bucket_samples) = aslam_allocation(num_items, count)
+  probs = aslam_inclusion_probabilities(bucket_sizes, count)
+  positions = [b * count + np.sort(np.random.permutation(size)[:k])
+    for (b, (size, k)) in enumerate(zip(bucket_sizes, bucket_samples)) if k>0]
+  positions = np.concatenate(positions).tolist()
+
+  samples = []
+  if len(positions)==0:
+    return samples
+  next_idx = 0
+  for (pos, item) in enumerate(ranked_items):
+    if pos==positions[next_idx]:
+      bucket = pos // count
+      samples.append((item, bucket, float(probs[bucket])))
+      next_idx += 1
+      if next_idx==len(positions):
+        break
+  return samples
   
 
 # ========
@@ -99,32 +139,17 @@ if __name__ == "__main__":
   if args.min_edits:
     edits_filter = 'HAVING sum(num_edits)>=%d' % (args.min_edits)
   
-  result = session.execute("""SELECT uid, MAX(username) as username, %s
+  query = """SELECT uid, MAX(username) as username, %s
     FROM %s ue %s %s
     GROUP BY uid
-    %s
-    ORDER BY num_edits DESC""" % (
+    %s""" % (
       ', '.join(metrics_select), 
       args.stats_table, country_join, country_filter, 
-      edits_filter))
+      edits_filter)
 
-  # uid -> {map: uid, username, num_edits, ...}
-  items = dict()
-  # ranked list of uids
-  ranked_ids = []
-  
-  num_records = 0
-  for row in result:
-    uid = row['uid']
-    record = defaultdict(str)
-    for field in fields:
-      record[field] = row[field]
-    if uid in items.keys():
-      print "already an entry for %d" % uid
-    items[uid] = record
-    ranked_ids.append(uid)
-    num_records += 1
-  print "Loaded %d records." % (num_records)
+  num_records = session.execute(
+    "SELECT count(*) as total FROM (%s) q" % (query)).fetchone()['total']
+  print "Found %d records." % (num_records)
   
   if num_records==0:
     print "No records to sample from!"
@@ -134,8 +159,24 @@ if __name__ == "__main__":
   # Sample
   #
   
-  sampled_ids = aslamSample(ranked_ids, args.num_samples)
-  samples = [items[s] for s in sampled_ids]
+  # server-side cursor: rows are consumed while sampling
+  result = session.connection().execution_options(stream_results=True).execute(
+    text(query + " ORDER BY num_edits DESC"))
+
+  def records(result):
+    for row in result:
+      record = defaultdict(str)
+      for field in fields:
+        record[field] = row[field]
+      yield record
+
+  samples = []
+  for (record, bucket, prob) in aslam_sample_stream(records(result), num_records, args.num_samples):
+    record['bucket'] = bucket
+    record['inclusion_prob'] = prob
+    samples.append(record)
+  result.close()
+  fields += ['bucket', 'inclusion_prob']
 
   mkdir_p(os.path.dirname(args.csvfile))
   save_csv(args.cohort, samples, fields, args.csvfile)
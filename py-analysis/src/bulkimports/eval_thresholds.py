@@ -12,8 +12,10 @@ import random
 import sys
 
 import numpy as np
+import pandas
 
 from app import *
+from metrics import *
 
 # ===========
 # = Reports =
@@ -38,85 +40,174 @@ def eval_report(data, colnames, outdir, filename_base):
 # = DB =
 # ======
 
-# Global only for now.
+# Loads all per-(country, uid) edit counts in a single query.
 # stats_table: table with user edit stats
-# abs_threshold: min. number of edits
-# countries: list of iso2 country codes
-# Returns a set of uids
-def get_uids_above_abs_threshold(session, stats_table, abs_threshold, countries=None):
-  country_filter = ''
-  if countries:
-    country_filter = "WHERE w.iso2 IN ('%s')" % ("', '".join(countries))
-  result = session.execute("""SELECT uid 
+# Returns a dict of numpy arrays: iso2, uid, num_edits (one entry per table row)
+def load_edit_counts(session, stats_table):
+  result = session.execute("""SELECT iso2, uid, num_edits
     FROM %s ue 
-    JOIN world_borders w ON (w.gid=ue.country_gid)
-    %s
-    GROUP BY uid
-    HAVING sum(num_edits)>=%d""" % (stats_table, country_filter, abs_threshold))
-  uids = set()
+    JOIN world_borders w ON (w.gid=ue.country_gid)""" % (stats_table))
+  iso2 = []
+  uids = []
+  num_edits = []
   for row in result:
-    uids.add(row['uid'])
-  return uids
-  
-# Global only for now.
-# stats_table: table with user edit stats
-# percentile: [0..100] inclusive
+    iso2.append(row['iso2'])
+    uids.append(row['uid'])
+    num_edits.append(row['num_edits'])
+  return {
+    'iso2': np.array(iso2, dtype=object),
+    'uid': np.array(uids, dtype=np.int64),
+    'num_edits': np.array(num_edits, dtype=np.int64)
+  }
+
+# edit_counts: result of load_edit_counts(...)
 # countries: list of iso2 country codes
-# Returns an absolute threshold
-def get_threshold_for_percentile(session, stats_table, percentile, countries=None):
-  country_filter = ''
-  if countries:
-    country_filter = "WHERE w.iso2 IN ('%s')" % ("', '".join(countries))
-  result = session.execute("""SELECT num_edits 
-    FROM %s ue
-    JOIN world_borders w ON (w.gid=ue.country_gid)
-    %s
-    ORDER BY num_edits ASC""" % (stats_table, country_filter))
-  ranking = []
-  for row in result:
-    ranking.append(row['num_edits'])
-  return round(np.percentile(ranking, percentile))
-  
+# Returns a boolean row mask, or None if there is no country filter.
+def get_country_mask(edit_counts, countries=None):
+  if not countries:
+    return None
+  return np.in1d(edit_counts['iso2'], countries)
+
 # =========
 # = Tools =
 # =========
 
-def f_score(precision, recall, beta=1):
-  return (1 + beta*beta) * (precision*recall) / (beta*beta*precision + recall)
-
-def eval_summary(cohort, filter_type, filter_param, abs_threshold, relevant, retrieved):
+# Summary record for a single threshold; F is F2.
+def eval_summary(cohort, filter_type, filter_param, abs_threshold, 
+  num_relevant, num_retrieved, num_relevant_retrieved):
   rec = defaultdict(lambda: None)
   rec['cohort'] = cohort
   rec['filter_type'] = filter_type
   rec['filter_param'] = filter_param
   rec['abs_threshold'] = abs_threshold
-  rec['num_relevant'] = len(relevant)
-  rec['num_retrieved'] = len(retrieved)
-  rec['num_relevant_retrieved'] = len(relevant.intersection(retrieved))
+  rec['num_relevant'] = num_relevant
+  rec['num_retrieved'] = num_retrieved
+  rec['num_relevant_retrieved'] = num_relevant_retrieved
   if rec['num_relevant_retrieved']>0:
     rec['precision'] = float(rec['num_relevant_retrieved']) / rec['num_retrieved']
     rec['recall'] = float(rec['num_relevant_retrieved']) / rec['num_relevant']
     rec['F'] = f_score(rec['precision'], rec['recall'], 2)
   return rec
 
-def abs_eval_summary(cohort, threshold, labelled_uids, session, stats_table, countries=None):
-  relevant = labelled_uids['bulkimport'] # .union(labelled_uids['unknown'])
-  retrieved = get_uids_above_abs_threshold(session, stats_table, threshold, countries)
-  retrieved.discard(labelled_uids['unknown'])
-
-  return eval_summary(cohort, 
-    'absolute', threshold, threshold, 
-    relevant, retrieved)
-
-def rel_eval_summary(cohort, percentile, labelled_uids, session, stats_table, countries=None):
-  relevant = labelled_uids['bulkimport'] # .union(labelled_uids['unknown'])
-  threshold = get_threshold_for_percentile(session, stats_table, percentile, countries)
-  retrieved = get_uids_above_abs_threshold(session, stats_table, threshold, countries)
-  retrieved.discard(labelled_uids['unknown'])
-  
-  return eval_summary(cohort, 
-    'relative', percentile, threshold, 
-    relevant, retrieved)
+# Sums up edits per user.
+# Returns a tuple of numpy arrays: (uids, totals), ordered by uid
+def get_user_totals(uids, num_edits):
+  (unique_uids, idx) = np.unique(uids, return_inverse=True)
+  totals = np.zeros(len(unique_uids), dtype=np.int64)
+  np.add.at(totals, idx, num_edits)
+  return (unique_uids, totals)
+
+# Returns a tuple of numpy arrays: (uids, per-user totals, label codes)
+def get_cohort_totals(labelled_uids, edit_counts, row_mask=None):
+  uids = edit_counts['uid']
+  num_edits = edit_counts['num_edits']
+  if row_mask is not None:
+    uids = uids[row_mask]
+    num_edits = num_edits[row_mask]
+  (user_ids, totals) = get_user_totals(uids, num_edits)
+  (label_uids, label_codes) = encode_labels(labelled_uids)
+  labels = get_label_codes(user_ids, label_uids, label_codes)
+  return (user_ids, totals, labels)
+
+# Evaluates all thresholds in one pass. Users labelled 'unknown' are not counted.
+# filter_type: 'absolute' or 'relative'
+# filter_params: list of parameters, as reported
+# thresholds: list of absolute thresholds, one per filter parameter
+# Returns a list of eval_summary(...) records.
+def sweep_eval_summaries(cohort, filter_type, filter_params, thresholds, 
+  labelled_uids, edit_counts, row_mask=None):
+
+  (user_ids, totals, labels) = get_cohort_totals(labelled_uids, edit_counts, row_mask)
+  counts = confusion_counts(totals, labels, [int(threshold) for threshold in thresholds])
+
+  return [eval_summary(cohort, 
+      filter_type, filter_param, threshold, 
+      int(counts['num_relevant'][idx]), int(counts['num_retrieved'][idx]), 
+      int(counts['num_relevant_retrieved'][idx]))
+    for (idx, (filter_param, threshold)) in enumerate(zip(filter_params, thresholds))]
+
+def abs_eval_summaries(cohort, thresholds, labelled_uids, edit_counts, countries=None):
+  return sweep_eval_summaries(cohort, 'absolute', thresholds, thresholds, 
+    labelled_uids, edit_counts, get_country_mask(edit_counts, countries))
+
+def rel_eval_summaries(cohort, percentiles, labelled_uids, edit_counts, countries=None):
+  row_mask = get_country_mask(edit_counts, countries)
+  ranking = edit_counts['num_edits']
+  if row_mask is not None:
+    ranking = ranking[row_mask]
+  thresholds = [round(v) for v in np.percentile(ranking, percentiles)]
+  return sweep_eval_summaries(cohort, 'relative', percentiles, thresholds, 
+    labelled_uids, edit_counts, row_mask)
+
+# Area under the precision/recall curve over all distinct edit totals.
+def cohort_pr_auc(labelled_uids, edit_counts, countries=None):
+  (user_ids, totals, labels) = get_cohort_totals(labelled_uids, edit_counts, 
+    get_country_mask(edit_counts, countries))
+  return pr_auc(totals, labels)
+
+# ===================
+# = Country matrices =
+# ===================
+
+# stats: dict of iso2 -> list of eval_summary(...) records, all with the same filter parameters
+# countries: list of iso2 codes, determines the row order
+# num_thresholds: the number of records per country
+# Returns a countries x thresholds numpy array of the given metric, NaN where it is undefined.
+def get_stats_matrix(stats, countries, num_thresholds, metric):
+  return np.array([
+    [np.nan if s[metric]==None else s[metric] for s in stats[iso2]]
+      for iso2 in countries], dtype=float).reshape((len(countries), num_thresholds))
+
+# F: countries x thresholds matrix of F-scores
+# Returns a tuple of numpy arrays: 
+# - has_F: countries with at least one defined F-score
+# - peak_cols: column of each country's peak F-score (the first one if there are several)
+def get_peak_columns(F):
+  has_F = ~np.all(np.isnan(F), axis=1)
+  peak_cols = np.argmax(np.where(np.isnan(F), -np.inf, F), axis=1)
+  return (has_F, peak_cols)
+
+# Returns the defined F-scores in a column, as numpy array.
+def get_column_values(F, col):
+  values = F[:, col]
+  return values[~np.isnan(values)]
+
+# For every country, select the threshold with the highest mean F-score across all 
+# other countries. Undefined F-scores count as zero.
+# F: countries x thresholds matrix of F-scores
+# Returns a numpy array of columns, one per country.
+def get_leave_one_out_columns(F):
+  F = np.nan_to_num(F)
+  num_countries = F.shape[0]
+  mean_F = (F.sum(axis=0)[np.newaxis,:] - F) / (num_countries - 1)
+  return np.argmax(mean_F, axis=1)
+
+# ===================
+# = Adaptive search =
+# ===================
+
+# Finds the absolute threshold with the highest F-score.
+# F only changes where the threshold crosses a per-user total, so the candidates
+# are the distinct totals. All of them are scored in a single confusion_counts(...)
+# pass, so the result is the exact optimum; ties go to the lowest threshold.
+# Returns a tuple: (eval_summary record of the best threshold, number of evaluations)
+def adaptive_eval_summary(cohort, labelled_uids, edit_counts, countries=None):
+  (user_ids, totals, labels) = get_cohort_totals(labelled_uids, edit_counts, 
+    get_country_mask(edit_counts, countries))
+  candidates = np.unique(totals)
+  if len(candidates)==0:
+    return (None, 0)
+
+  counts = confusion_counts(totals, labels, candidates)
+  F = precision_recall_f(counts, beta=2)['F']
+  if np.all(np.isnan(F)):
+    return (None, len(candidates))
+  best = np.argmax(np.where(np.isnan(F), -np.inf, F))
+  threshold = int(candidates[best])
+  rec = eval_summary(cohort, 'adaptive', threshold, threshold, 
+    int(counts['num_relevant'][best]), int(counts['num_retrieved'][best]), 
+    int(counts['num_relevant_retrieved'][best]))
+  return (rec, len(candidates))
 
 # =========
 # = Plots =
@@ -128,41 +219,41 @@ def rel_eval_summary(cohort, percentile, labelled_uids, session, stats_table, co
 def eval_plot(x_labels, measures, metric_names, outdir, filename_base, 
   colors=QUALITATIVE_DARK, max_labels=20, legend_loc='upper right', **kwargs):
   
-  fig = plt.figure(figsize=(4, 3))
-  fig.patch.set_facecolor('white')
+  with FigureSession(filename_base):
+    fig = plt.figure(figsize=(4, 3))
+    fig.patch.set_facecolor('white')
   
-  # x-axis labels
-  if len(x_labels) < max_labels:
-    x = range(len(x_labels))
-    plt.xticks(x, x_labels)
-  else:
-    x = [int(v*len(x_labels)/max_labels) for v in range(len(x_labels))]
-    # skip = int(len(x_labels) / max_labels) + 1
-    # x = range(0, max_labels, skip)
-    labels = [x_labels[x1] for x1 in x if x1<len(x_labels)]
-    while len(labels) < len(x_labels):
-      labels.append('')
-    plt.xticks(x, labels)
+    # x-axis labels
+    if len(x_labels) < max_labels:
+      x = range(len(x_labels))
+      plt.xticks(x, x_labels)
+    else:
+      x = [int(v*len(x_labels)/max_labels) for v in range(len(x_labels))]
+      # skip = int(len(x_labels) / max_labels) + 1
+      # x = range(0, max_labels, skip)
+      labels = [x_labels[x1] for x1 in x if x1<len(x_labels)]
+      while len(labels) < len(x_labels):
+        labels.append('')
+      plt.xticks(x, labels)
   
-  # plot
-  colgen = looping_generator(colors)
-  for metric_name in metric_names:
-    y = measures[metric_name]
-    plt.plot(range(len(x_labels)), y, label=metric_name, color=next(colgen), **kwargs)
-
-  plt.legend(loc=legend_loc, prop={'size':'xx-small'})
-    # , bbox_to_anchor=(1, 0.5), 
+    # plot
+    colgen = looping_generator(colors)
+    for metric_name in metric_names:
+      y = measures[metric_name]
+      plt.plot(range(len(x_labels)), y, label=metric_name, color=next(colgen), **kwargs)
+
+    plt.legend(loc=legend_loc, prop={'size':'xx-small'})
+      # , bbox_to_anchor=(1, 0.5), 
   
-  # rotate labels
-  locs, labels = plt.xticks()
-  plt.setp(labels, rotation=90)
+    # rotate labels
+    locs, labels = plt.xticks()
+    plt.setp(labels, rotation=90)
 
-  plt.margins(0.1, 0.1)
-  plt.tick_params(axis='both', which='major', labelsize='xx-small')
-  # plt.tick_params(axis='both', which='minor', labelsize='xx-small')
+    plt.margins(0.1, 0.1)
+    plt.tick_params(axis='both', which='major', labelsize='xx-small')
+    # plt.tick_params(axis='both', which='minor', labelsize='xx-small')
 
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # stats: ordered list of eval_summary(...) results
 # xlabel_formatter: function for x-axis label format
@@ -194,6 +285,10 @@ if __name__ == "__main__":
   parser.add_argument('outdir', help='Directory for output files')
   parser.add_argument('--stats-table', help='Name of DB table with user edit stats', 
     dest='stats_table', action='store', type=str, default='user_edit_stats')
+  parser.add_argument('--adaptive', help='Also find the best absolute threshold per country, evaluated at every distinct per-user edit total', 
+    dest='adaptive', action='store_true', default=False)
+  parser.add_argument('--aslam-sample', help='Optional CSV file produced by aslam_sample.py, for sample-weighted estimates of the absolute threshold evaluation', 
+    dest='aslam_sample', action='store', type=str, default=None)
   parser.add_argument('--countries', help='Optional list of ISO2 country codes', 
     dest='countries', nargs='+', action='store', type=str, default=None)
   args = parser.parse_args()
@@ -272,15 +367,11 @@ if __name__ == "__main__":
     'num_relevant', 'num_retrieved', 'num_relevant_retrieved', 'precision', 
     'recall', 'F']
 
-  abs_stats = []
-  for threshold in abs_thresholds:
-    abs_stats.append(abs_eval_summary('global', threshold, all_users, 
-      session, args.stats_table))
-  
-  rel_stats = []
-  for percentile in rel_thresholds:
-    rel_stats.append(rel_eval_summary('global', percentile, all_users, 
-      session, args.stats_table))
+  edit_counts = load_edit_counts(session, args.stats_table)
+  print "Loaded %d edit count records." % (len(edit_counts['uid']))
+
+  abs_stats = abs_eval_summaries('global', abs_thresholds, all_users, edit_counts)
+  rel_stats = rel_eval_summaries('global', rel_thresholds, all_users, edit_counts)
 
   mkdir_p(args.outdir)
 
@@ -295,69 +386,103 @@ if __name__ == "__main__":
   rel_country_stats = defaultdict(list)
 
   for iso2 in countries:
-    for threshold in abs_thresholds:
-      abs_country_stats[iso2].append(
-        abs_eval_summary(iso2, threshold, users_by_country[iso2], 
-          session, args.stats_table, countries=[iso2]))
+    abs_country_stats[iso2] = abs_eval_summaries(iso2, abs_thresholds, 
+      users_by_country[iso2], edit_counts, countries=[iso2])
 
     eval_report(abs_country_stats[iso2], colnames, args.outdir, 
       '%s_eval_absolute' % iso2)
   
   for iso2 in countries:
-    for percentile in rel_thresholds:
-      rel_country_stats[iso2].append(
-        rel_eval_summary(iso2, percentile, users_by_country[iso2], 
-          session, args.stats_table, countries=[iso2]))
+    rel_country_stats[iso2] = rel_eval_summaries(iso2, rel_thresholds, 
+      users_by_country[iso2], edit_counts, countries=[iso2])
 
     eval_report(rel_country_stats[iso2], colnames, args.outdir, 
       '%s_eval_relative' % iso2)
   
+  #
+  # Precision/recall AUC
+  #
+
+  auc_stats = [{'cohort': 'global', 'pr_auc': cohort_pr_auc(all_users, edit_counts)}]
+  for iso2 in countries:
+    auc_stats.append({'cohort': iso2, 
+      'pr_auc': cohort_pr_auc(users_by_country[iso2], edit_counts, countries=[iso2])})
+
+  eval_report(auc_stats, ['cohort', 'pr_auc'], args.outdir, 'countries_pr_auc')
+
+  #
+  # Aslam estimates: weighted by the sample's inclusion probabilities
+  #
+  
+  if args.aslam_sample:
+    sample = pandas.read_csv(args.aslam_sample)
+    (user_ids, totals, labels) = get_cohort_totals(all_users, edit_counts)
+    idx = np.searchsorted(user_ids, sample['uid'].values)
+    idx = np.minimum(idx, len(user_ids)-1)
+    found = (user_ids[idx]==sample['uid'].values)
+    print "Loaded %d sampled users, %d with edit counts." % (len(sample), np.sum(found))
+
+    counts = confusion_counts(totals, labels, abs_thresholds)
+    estimates = aslam_estimates(totals[idx[found]], labels[idx[found]], 
+      sample['inclusion_prob'].values[found], abs_thresholds, 
+      num_retrieved=counts['num_retrieved'], beta=2)
+
+    aslam_stats = []
+    for (n, threshold) in enumerate(abs_thresholds):
+      rec = defaultdict(lambda: None)
+      rec['cohort'] = 'aslam'
+      rec['filter_type'] = 'absolute'
+      rec['filter_param'] = threshold
+      rec['abs_threshold'] = threshold
+      for measure in ['num_relevant', 'num_retrieved', 'num_relevant_retrieved', 
+        'precision', 'recall', 'F']:
+        if not np.isnan(estimates[measure][n]):
+          rec[measure] = float(estimates[measure][n])
+      aslam_stats.append(rec)
+
+    eval_report(aslam_stats, colnames, args.outdir, 'global_eval_absolute_aslam')
+
   #
   # Country report: "best" thresholds
   #
   
+  # countries x thresholds matrices
+  abs_F = get_stats_matrix(abs_country_stats, countries, len(abs_thresholds), 'F')
+  abs_threshold_matrix = get_stats_matrix(abs_country_stats, countries, 
+    len(abs_thresholds), 'abs_threshold')
+  rel_F = get_stats_matrix(rel_country_stats, countries, len(rel_thresholds), 'F')
+  rel_threshold_matrix = get_stats_matrix(rel_country_stats, countries, 
+    len(rel_thresholds), 'abs_threshold')
+
+  (has_abs_F, peak_abs_cols) = get_peak_columns(abs_F)
+  (has_rel_F, peak_rel_cols) = get_peak_columns(rel_F)
+
   # iso2 -> eval_summary record
   peak_abs_stats = []
   peak_rel_stats = []
   
-  for iso2 in countries:
-    abs_F_scores = [s['F'] for s in abs_country_stats[iso2] if s['F']!=None]
-    if len(abs_F_scores) > 0:
-      max_abs_F = max(abs_F_scores)
-      max_abs_threshold = min([s['abs_threshold'] for s in abs_country_stats[iso2] if s['F']==max_abs_F])
-
-      all_at_abs_threshold = [[s
-        for s in abs_country_stats[_iso2] 
-        if s['abs_threshold']==max_abs_threshold and s['F']!=None]
-          for _iso2 in abs_country_stats.keys()]
-      F_at_abs_threshold = [s['F'] for sublist in all_at_abs_threshold for s in sublist]
-
+  for (idx, iso2) in enumerate(countries):
+    if has_abs_F[idx]:
+      col = peak_abs_cols[idx]
+      F_at_abs_threshold = get_column_values(abs_F, col)
       peak_abs_stats.append({
         'iso2': iso2,
-        'threshold': max_abs_threshold,
-        'F': max_abs_F,
+        'threshold': abs_thresholds[col],
+        'F': float(abs_F[idx, col]),
         'all_F_at_threshold': F_at_abs_threshold,
         'mean_F_at_threshold': np.mean(F_at_abs_threshold),
         'std_F_at_threshold': np.std(F_at_abs_threshold)
       })
   
-    rel_F_scores = [s['F'] for s in rel_country_stats[iso2] if s['F']!=None]
-    if len(rel_F_scores) > 0:
-      max_rel_F = max(rel_F_scores)
-      max_rel_percentile = min([s['filter_param'] for s in rel_country_stats[iso2] if s['F']==max_rel_F])
-      max_rel_threshold = min([s['abs_threshold'] for s in rel_country_stats[iso2] if s['F']==max_rel_F])
-
-      all_at_rel_threshold = [[s
-        for s in rel_country_stats[_iso2] 
-        if s['filter_param']==max_rel_percentile and s['F']!=None]
-          for _iso2 in rel_country_stats.keys()]
-      F_at_rel_threshold = [s['F'] for sublist in all_at_rel_threshold for s in sublist]
-
+    if has_rel_F[idx]:
+      col = peak_rel_cols[idx]
+      is_peak = (rel_F[idx]==rel_F[idx, col])
+      F_at_rel_threshold = get_column_values(rel_F, col)
       peak_rel_stats.append({
         'iso2': iso2,
-        'percentile': max_rel_percentile,
-        'threshold': max_rel_threshold,
-        'F': max_rel_F,
+        'percentile': rel_thresholds[col],
+        'threshold': float(np.min(rel_threshold_matrix[idx][is_peak])),
+        'F': float(rel_F[idx, col]),
         'all_F_at_threshold': F_at_rel_threshold,
         'mean_F_at_threshold': np.mean(F_at_rel_threshold),
         'std_F_at_threshold': np.std(F_at_rel_threshold)
@@ -380,18 +505,12 @@ if __name__ == "__main__":
   peak_rel_thresholds = [s['threshold'] for s in peak_rel_stats]
   peak_rel_percentiles = [s['percentile'] for s in peak_rel_stats]
 
-  F_at_peak_rel_threshold = [s 
-    for sublist in peak_rel_stats 
-    for s in sublist['all_F_at_threshold']]
-
   # Apply the "best" thresholds to all countries and get F-scores
-  F_at_peak_abs_threshold = [s 
-    for sublist in peak_abs_stats 
-    for s in sublist['all_F_at_threshold']]
+  F_at_peak_abs_threshold = np.concatenate([[]] + 
+    [s['all_F_at_threshold'] for s in peak_abs_stats])
 
-  F_at_peak_rel_threshold = [s 
-    for sublist in peak_rel_stats 
-    for s in sublist['all_F_at_threshold']]
+  F_at_peak_rel_threshold = np.concatenate([[]] + 
+    [s['all_F_at_threshold'] for s in peak_rel_stats])
   
   # Report
   var_stats = []
@@ -419,6 +538,66 @@ if __name__ == "__main__":
       'mean_peak_threshold', 'std_peak_threshold'], 
     args.outdir, 'countries_variance')
 
+  #
+  # Leave-one-country-out validation
+  #
+  
+  if len(countries) > 1:
+    loo_abs_cols = get_leave_one_out_columns(abs_F)
+    loo_rel_cols = get_leave_one_out_columns(rel_F)
+    
+    loo_abs_stats = []
+    loo_rel_stats = []
+    for (idx, iso2) in enumerate(countries):
+      col = loo_abs_cols[idx]
+      loo_abs_stats.append({
+        'iso2': iso2,
+        'threshold': abs_thresholds[col],
+        'F': float(np.nan_to_num(abs_F[idx, col])),
+        'peak_F': float(np.max(np.nan_to_num(abs_F[idx])))
+      })
+      col = loo_rel_cols[idx]
+      loo_rel_stats.append({
+        'iso2': iso2,
+        'percentile': rel_thresholds[col],
+        'threshold': float(rel_threshold_matrix[idx, col]),
+        'F': float(np.nan_to_num(rel_F[idx, col])),
+        'peak_F': float(np.max(np.nan_to_num(rel_F[idx])))
+      })
+
+    eval_report(loo_abs_stats, 
+      ['iso2', 'threshold', 'F', 'peak_F'], 
+      args.outdir, 'countries_absolute_loo')
+
+    eval_report(loo_rel_stats, 
+      ['iso2', 'percentile', 'threshold', 'F', 'peak_F'], 
+      args.outdir, 'countries_relative_loo')
+
+    print "Leave-one-country-out mean F: absolute %.4f, relative %.4f" % (
+      np.mean([s['F'] for s in loo_abs_stats]), 
+      np.mean([s['F'] for s in loo_rel_stats]))
+
+  #
+  # Adaptive search: best absolute thresholds over all distinct edit totals
+  #
+
+  if args.adaptive:
+    adaptive_stats = []
+    for (cohort, labelled_uids, cohort_countries) in \
+      [('global', all_users, None)] + \
+      [(iso2, users_by_country[iso2], [iso2]) for iso2 in countries]:
+
+      (rec, num_evaluations) = adaptive_eval_summary(cohort, labelled_uids, 
+        edit_counts, countries=cohort_countries)
+      if rec!=None:
+        rec['num_evaluations'] = num_evaluations
+        adaptive_stats.append(rec)
+        print "%s: best threshold %d (F=%.4f), %d evaluations" % (
+          cohort, rec['abs_threshold'], rec['F'], num_evaluations)
+
+    eval_report(adaptive_stats, colnames + ['num_evaluations'], 
+      args.outdir, 'countries_adaptive_best')
+
   #
   # Global evaluation plots
   #
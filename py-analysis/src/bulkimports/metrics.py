@@ -0,0 +1,166 @@
+#
+# Retrieval metrics for bulk import detection, shared by the bulk import tools.
+#
+# Users are encoded as sorted uid arrays with integer label codes, so that
+# confusion counts for many thresholds can be computed at once with cumulative sums.
+#
+
+from __future__ import division # non-truncating division in Python 2.x
+
+import numpy as np
+from scipy.stats import binom
+
+# ==========
+# = Labels =
+# ==========
+
+NO_LABEL = -1
+NON_BULKIMPORT = 0
+BULKIMPORT = 1
+UNKNOWN = 2
+
+LABEL_CODES = {
+  'non-bulkimport': NON_BULKIMPORT,
+  'bulkimport': BULKIMPORT,
+  'unknown': UNKNOWN
+}
+
+# labelled_uids: dict of label type -> set of uids
+# If a uid has multiple labels, 'bulkimport' takes precedence over 'unknown',
+# which takes precedence over 'non-bulkimport'.
+# Returns a tuple of numpy arrays: (uids in ascending order, label codes)
+def encode_labels(labelled_uids):
+  uids = []
+  codes = []
+  for label in ['non-bulkimport', 'unknown', 'bulkimport']:
+    uids += list(labelled_uids[label])
+    codes += [LABEL_CODES[label]] * len(labelled_uids[label])
+  uids = np.array(uids, dtype=np.int64)
+  codes = np.array(codes, dtype=np.int8)
+  # keep the last (highest precedence) label for every uid
+  (label_uids, idx) = np.unique(uids[::-1], return_index=True)
+  return (label_uids, codes[::-1][idx])
+
+# uids: numpy array of uids to look up
+# label_uids, label_codes: result of encode_labels(...)
+# Returns a numpy array of label codes, NO_LABEL for unlabelled users.
+def get_label_codes(uids, label_uids, label_codes):
+  codes = np.zeros(len(uids), dtype=np.int8) + NO_LABEL
+  if len(label_uids)==0:
+    return codes
+  idx = np.minimum(np.searchsorted(label_uids, uids), len(label_uids)-1)
+  found = (label_uids[idx]==uids)
+  codes[found] = label_codes[idx[found]]
+  return codes
+
+# ====================
+# = Confusion counts =
+# ====================
+
+# Confusion counts for many thresholds at once.
+# scores: numpy array of per-user scores, e.g. edit totals
+# labels: numpy array of label codes, same size
+# thresholds: list of thresholds; a user is retrieved if score>=threshold
+# exclude: label codes that are removed from the population before counting
+# weights: optional per-user weights, e.g. inverse inclusion probabilities
+# Returns a dict of numpy arrays, one entry per threshold:
+#   num_retrieved, num_relevant_retrieved, num_relevant
+def confusion_counts(scores, labels, thresholds, exclude=[UNKNOWN], weights=None):
+  keep = ~np.in1d(labels, exclude)
+  scores = np.asarray(scores)[keep]
+  is_relevant = (np.asarray(labels)[keep]==BULKIMPORT)
+  if weights is None:
+    weights = np.ones(len(scores), dtype=np.int64)
+  else:
+    weights = np.asarray(weights)[keep]
+
+  # descending by score: the users retrieved at any threshold are a prefix
+  order = np.argsort(-scores, kind='mergesort')
+  cum_retrieved = np.concatenate([[0], np.cumsum(weights[order])])
+  cum_relevant = np.concatenate([[0], np.cumsum(weights[order] * is_relevant[order])])
+  num_above = len(scores) - np.searchsorted(np.sort(scores), thresholds, side='left')
+
+  return {
+    'num_retrieved': cum_retrieved[num_above],
+    'num_relevant_retrieved': cum_relevant[num_above],
+    'num_relevant': np.zeros(len(num_above), dtype=cum_relevant.dtype) + cum_relevant[-1]
+  }
+
+# ===========
+# = Metrics =
+# ===========
+
+def f_score(precision, recall, beta=1):
+  return (1 + beta*beta) * (precision*recall) / (beta*beta*precision + recall)
+
+# counts: result of confusion_counts(...)
+# Returns a dict of numpy arrays: precision, recall, F. Values are NaN where
+# nothing relevant was retrieved.
+def precision_recall_f(counts, beta=1):
+  num_relevant_retrieved = np.asarray(counts['num_relevant_retrieved'], dtype=float)
+  defined = (num_relevant_retrieved > 0)
+  precision = np.zeros(len(num_relevant_retrieved)) + np.nan
+  recall = np.zeros(len(num_relevant_retrieved)) + np.nan
+  precision[defined] = num_relevant_retrieved[defined] / counts['num_retrieved'][defined]
+  recall[defined] = num_relevant_retrieved[defined] / counts['num_relevant'][defined]
+  return {
+    'precision': precision,
+    'recall': recall,
+    'F': f_score(precision, recall, beta)
+  }
+
+# F-beta curves for several beta values.
+# Returns a dict of beta -> numpy array of F-scores, one per threshold.
+def f_beta_curves(counts, betas=[0.5, 1, 2]):
+  measures = precision_recall_f(counts)
+  return dict([(beta, f_score(measures['precision'], measures['recall'], beta))
+    for beta in betas])
+
+# Area under the precision/recall curve (average precision), evaluated at
+# every distinct score.
+# Returns a float, or None if there are no relevant users.
+def pr_auc(scores, labels, exclude=[UNKNOWN], weights=None):
+  thresholds = np.unique(np.asarray(scores))[::-1]
+  counts = confusion_counts(scores, labels, thresholds, exclude=exclude, weights=weights)
+  if len(thresholds)==0 or counts['num_relevant'][0]==0:
+    return None
+  measures = precision_recall_f(counts)
+  recall = np.nan_to_num(measures['recall'])
+  precision = np.nan_to_num(measures['precision'])
+  return float(np.sum(np.diff(np.concatenate([[0], recall])) * precision))
+
+# ==================
+# = Aslam sampling =
+# ==================
+
+# The probability that an item in each bucket of an Aslam sample is sampled.
+# Every one of the count draws picks a bucket uniformly, and a bucket yields at
+# most its size in samples.
+# bucket_sizes: numpy array of bucket sizes
+# count: number of draws
+# Returns a numpy array of probabilities, one per bucket.
+def aslam_inclusion_probabilities(bucket_sizes, count):
+  num_draws = np.arange(count + 1)
+  pmf = binom.pmf(num_draws, count, 1.0 / len(bucket_sizes))
+  return np.array([np.sum(pmf * np.minimum(num_draws, size)) / size
+    for size in bucket_sizes])
+
+# Population estimates from a labelled Aslam sample, weighting every sampled
+# user by its inverse inclusion probability.
+# scores, labels, inclusion_probs: numpy arrays for the sampled users
+# thresholds: list of thresholds; a user is retrieved if score>=threshold
+# num_retrieved: optional exact retrieval counts per threshold for the full
+#   population; these are estimated from the sample otherwise.
+# exclude: label codes to ignore; by default, unknown and unlabelled users.
+# Returns a dict of numpy arrays: the estimated confusion counts, and
+#   precision, recall, F
+def aslam_estimates(scores, labels, inclusion_probs, thresholds,
+  num_retrieved=None, beta=1, exclude=[UNKNOWN, NO_LABEL]):
+
+  counts = confusion_counts(scores, labels, thresholds, exclude=exclude,
+    weights=1.0 / np.asarray(inclusion_probs, dtype=float))
+  if num_retrieved is not None:
+    counts['num_retrieved'] = np.asarray(num_retrieved)
+  estimates = dict(counts)
+  estimates.update(precision_recall_f(counts, beta))
+  return estimates
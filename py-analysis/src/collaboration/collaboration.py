@@ -10,7 +10,6 @@ matplotlib.use('Agg')
 import argparse
 from collections import defaultdict
 import decimal
-import gc
 import sys
 
 import matplotlib.pyplot as plt
@@ -54,77 +53,72 @@ def report(data, col1name, col2name, metrics, outdir, filename_base):
 # = Plots =
 # =========
 
-# data: country -> is_poweruser -> metric -> list of values
-# kwargs is passed on to plt.boxplot(...).
+# data: country -> is_poweruser -> metric -> list of values, or a dict of box 
+#   plot statistics (see app.plotting.boxplot_stats)
+# kwargs is passed on to draw_boxplots(...).
 def items_boxplot(data, columns, rows, outdir, filename_base, show_minmax=False, **kwargs):
-  for (column, row, ax1) in plot_matrix(columns, rows, shared_yscale=True):
-    celldata = []
-    minv = []
-    maxv = []
-    for segment in sorted(data[column].keys()):
-      values = [v for v in data[column][segment][row] if v!=None]
-      celldata.append(values)
-      if len(values) > 0:
-        minv.append(min(values))
-        maxv.append(max(values))
+  with FigureSession(filename_base):
+    for (column, row, ax1) in plot_matrix(columns, rows, shared_yscale=True):
+      celldata = []
+      for segment in sorted(data[column].keys()):
+        values = data[column][segment][row]
+        if not isinstance(values, dict):
+          values = [v for v in values if v!=None]
+        celldata.append(values)
     
-    ax1.boxplot(celldata, positions=range(len(data[column].keys())), **kwargs)
-
-    if show_minmax and len(minv)>0 and len(maxv)>0:
-      for idx in range(len(minv)):
-        w = 0.1
-        ax1.plot([idx-w, idx+w], [minv[idx]]*2, 'k-')
-        ax1.plot([idx-w, idx+w], [maxv[idx]]*2, 'k-')
+      (stats, artists) = draw_boxplots(ax1, celldata, 
+        positions=range(len(data[column].keys())), **kwargs)
+
+      if show_minmax:
+        minmax = [(cell['min'], cell['max']) for cell in stats if cell['count'] > 0]
+        for idx in range(len(minmax)):
+          w = 0.1
+          ax1.plot([idx-w, idx+w], [minmax[idx][0]]*2, 'k-')
+          ax1.plot([idx-w, idx+w], [minmax[idx][1]]*2, 'k-')
     
-    ax1.margins(0.1, 0.1)
-    ax1.get_xaxis().set_visible(False)
-    ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
-    ax1.tick_params(axis='y', which='major', labelsize='x-small')
-    ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
+      ax1.margins(0.1, 0.1)
+      ax1.get_xaxis().set_visible(False)
+      ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
+      ax1.tick_params(axis='y', which='major', labelsize='x-small')
+      ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
-  
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    save_figure(outdir, filename_base)
 
 # data: country -> is_poweruser -> metric -> list of values
+# density: draw density rasters instead of points? None: decide per segment, 
+# based on the number of points
 # kwargs is passed on to plt.scatter(...).
 def items_scatterplot(data, anchor_row, columns, rows, outdir, filename_base, 
-  colors=QUALITATIVE_DARK, scale='log',**kwargs):
-  
-  for (column, row, ax1) in plot_matrix(columns, rows):
-    seg_x = defaultdict(list)
-    seg_y = defaultdict(list)
-
-    for segment in sorted(data[column].keys()):
-      for idx in range(len(data[column][segment][anchor_row])):
-        x = data[column][segment][anchor_row][idx]
-        y = data[column][segment][row][idx]
-        if x!=None and y!=None:
-          seg_x[segment].append(x)
-          seg_y[segment].append(y)
-      #  if (x>0 and y>0): # we're using log scale...
-      #    seg_x[segment].append(x)
-      #    seg_y[segment].append(y)
-
-    colgen = looping_generator(colors)
-    for segment in sorted(seg_x.keys()):
-      ax1.scatter(seg_x[segment], seg_y[segment], color=next(colgen), **kwargs)
-
-    ax1.margins(0.1, 0.1)
-    ax1.set_xscale(scale)
-    ax1.set_yscale(scale)
-    ax1.tick_params(axis='both', which='major', labelsize='x-small')
-    ax1.tick_params(axis='both', which='minor', labelsize='xx-small')
+  colors=QUALITATIVE_DARK, scale='log', density=None, **kwargs):
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+  with FigureSession(filename_base):
+    for (column, row, ax1) in plot_matrix(columns, rows):
+      seg_x = defaultdict(list)
+      seg_y = defaultdict(list)
+
+      for segment in sorted(data[column].keys()):
+        for idx in range(len(data[column][segment][anchor_row])):
+          x = data[column][segment][anchor_row][idx]
+          y = data[column][segment][row][idx]
+          if x!=None and y!=None:
+            seg_x[segment].append(x)
+            seg_y[segment].append(y)
+        #  if (x>0 and y>0): # we're using log scale...
+        #    seg_x[segment].append(x)
+        #    seg_y[segment].append(y)
+
+      colgen = looping_generator(colors)
+      for segment in sorted(seg_x.keys()):
+        scatter_points(ax1, seg_x[segment], seg_y[segment], density=density, 
+          scale=scale, color=next(colgen), **kwargs)
+
+      ax1.margins(0.1, 0.1)
+      ax1.set_xscale(scale)
+      ax1.set_yscale(scale)
+      ax1.tick_params(axis='both', which='major', labelsize='x-small')
+      ax1.tick_params(axis='both', which='minor', labelsize='xx-small')
   
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    save_figure(outdir, filename_base)
 
 # ========
 # = Main =
@@ -10,7 +10,6 @@ matplotlib.use('Agg')
 import argparse
 from collections import defaultdict
 import decimal
-import gc
 import sys
 
 import matplotlib.pyplot as plt
@@ -41,77 +40,59 @@ def report(data, colnames, outdir, filename_base):
 # kwargs is passed on to plt.scatter(...).
 def scatterplot(x, y, outdir, filename_base, scale='linear', **kwargs):
   
-  fig = plt.figure(figsize=(4, 3))
-  fig.patch.set_facecolor('white')
-  plt.scatter(x, y, edgecolors='none', **kwargs)
-  plt.margins(0.1, 0.1)
-  plt.tick_params(axis='both', which='major', labelsize='x-small')
-  plt.tick_params(axis='both', which='minor', labelsize='xx-small')
-  plt.xscale(scale)
-  plt.yscale(scale)
+  with FigureSession(filename_base):
+    fig = plt.figure(figsize=(4, 3))
+    fig.patch.set_facecolor('white')
+    plt.scatter(x, y, edgecolors='none', **kwargs)
+    plt.margins(0.1, 0.1)
+    plt.tick_params(axis='both', which='major', labelsize='x-small')
+    plt.tick_params(axis='both', which='minor', labelsize='xx-small')
+    plt.xscale(scale)
+    plt.yscale(scale)
 
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
-  
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    save_figure(outdir, filename_base)
 
 # kwargs is passed on to plt.scatter(...).
 def hist2dplot(x, y, outdir, filename_base, scale='linear', **kwargs):
   
-  fig = plt.figure(figsize=(4, 3))
-  fig.patch.set_facecolor('white')
-  plt.hist2d(x, y, **kwargs)
-  plt.margins(0.1, 0.1)
-  plt.tick_params(axis='both', which='major', labelsize='x-small')
-  plt.tick_params(axis='both', which='minor', labelsize='xx-small')
-  plt.xscale(scale)
-  plt.yscale(scale)
+  with FigureSession(filename_base):
+    fig = plt.figure(figsize=(4, 3))
+    fig.patch.set_facecolor('white')
+    plt.hist2d(x, y, **kwargs)
+    plt.margins(0.1, 0.1)
+    plt.tick_params(axis='both', which='major', labelsize='x-small')
+    plt.tick_params(axis='both', which='minor', labelsize='xx-small')
+    plt.xscale(scale)
+    plt.yscale(scale)
 
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
-  
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    save_figure(outdir, filename_base)
 
-# data: { segment -> list of values }
-# kwargs is passed on to plt.boxplot(...).
+# data: { segment -> list of values, or a dict of box plot statistics }
+# kwargs is passed on to draw_boxplots(...).
 def boxplot(data, segments, outdir, filename_base, show_minmax=False, **kwargs):
   
-  fig = plt.figure(figsize=(2.5, 3))
-  fig.patch.set_facecolor('white')
-  celldata = []
-  minv = []
-  maxv = []
-  for segment in segments:
-    celldata.append(data[segment])
-    if len(data[segment]) > 0:
-      minv.append(min(data[segment]))
-      maxv.append(max(data[segment]))
-
-  plt.boxplot(celldata, positions=range(len(segments)), **kwargs)
-
-  if show_minmax and len(minv)>0 and len(maxv)>0:
-    for idx in range(len(minv)):
-      w = 0.1
-      plt.plot([idx-w, idx+w], [minv[idx]]*2, 'k-')
-      plt.plot([idx-w, idx+w], [maxv[idx]]*2, 'k-')
+  with FigureSession(filename_base):
+    fig = plt.figure(figsize=(2.5, 3))
+    fig.patch.set_facecolor('white')
+    celldata = [data[segment] for segment in segments]
+    (stats, artists) = draw_boxplots(plt.gca(), celldata, 
+      positions=range(len(segments)), **kwargs)
+
+    if show_minmax:
+      minmax = [(cell['min'], cell['max']) for cell in stats if cell['count'] > 0]
+      for idx in range(len(minmax)):
+        w = 0.1
+        plt.plot([idx-w, idx+w], [minmax[idx][0]]*2, 'k-')
+        plt.plot([idx-w, idx+w], [minmax[idx][1]]*2, 'k-')
     
-  plt.margins(0.1, 0.1)
-  ax = plt.gca()
-  ax.get_xaxis().set_visible(False)
-  ax.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
-  plt.tick_params(axis='y', which='major', labelsize='x-small')
-  plt.tick_params(axis='y', which='minor', labelsize='xx-small')
-  
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
-  
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    plt.margins(0.1, 0.1)
+    ax = plt.gca()
+    ax.get_xaxis().set_visible(False)
+    ax.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
+    plt.tick_params(axis='y', which='major', labelsize='x-small')
+    plt.tick_params(axis='y', which='minor', labelsize='xx-small')
+  
+    save_figure(outdir, filename_base)
 
 # ========
 # = Main =
@@ -10,7 +10,6 @@ matplotlib.use('Agg')
 import argparse
 from collections import defaultdict
 import decimal
-import gc
 import sys
 
 import matplotlib.cm as cm
@@ -47,38 +46,38 @@ def report(data, key1name, key2name, colnames, outdir, filename_base):
 # corr: metric1 -> metric2 -> measure -> value
 def corrmatrix(metrics1, metrics2, corr, measure, outdir, filename_base, cmap=cm.gray, **kwargs):
 
-  # TODO: OR: plt.matshow, plt.pcolor, ...
+  with FigureSession(filename_base):
+    # TODO: OR: plt.matshow, plt.pcolor, ...
 
-  ncols = len(metrics1)
-  nrows = len(metrics2)
+    ncols = len(metrics1)
+    nrows = len(metrics2)
 
-  fig = plt.figure(figsize=(1*ncols, 0.75*nrows))
-  plt.subplots_adjust(hspace=0, wspace=0)
-  fig.patch.set_facecolor('white')
+    fig = plt.figure(figsize=(1*ncols, 0.75*nrows))
+    plt.subplots_adjust(hspace=0, wspace=0)
+    fig.patch.set_facecolor('white')
 
-  for a in range(len(metrics1)):
-    for b in range(len(metrics2)):
+    for a in range(len(metrics1)):
+      for b in range(len(metrics2)):
 
-      scores = corr[metrics1[a]][metrics2[b]]
-      val = scores[measure]
+        scores = corr[metrics1[a]][metrics2[b]]
+        val = scores[measure]
 
-      # Plot
-      n = a + len(metrics1) * b + 1
-      ax1 = plt.subplot(nrows, ncols, n)
+        # Plot
+        n = a + len(metrics1) * b + 1
+        ax1 = plt.subplot(nrows, ncols, n)
       
-      if b == len(metrics2)-1: # last row
-        plt.xlabel(metrics1[a], rotation=90)
+        if b == len(metrics2)-1: # last row
+          plt.xlabel(metrics1[a], rotation=90)
 
-      if (a == 0): # first column
-        plt.ylabel(metrics2[b], rotation=0)
+        if (a == 0): # first column
+          plt.ylabel(metrics2[b], rotation=0)
       
-      ax1.bar(0, 1, 1, 0, color=cmap(val), **kwargs)
+        ax1.bar(0, 1, 1, 0, color=cmap(val), **kwargs)
 
-      ax1.get_xaxis().set_ticks([])
-      ax1.get_yaxis().set_ticks([])
+        ax1.get_xaxis().set_ticks([])
+        ax1.get_yaxis().set_ticks([])
   
-  plt.savefig("%s/%s.pdf" % (args.outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (args.outdir, filename_base), bbox_inches='tight')
+    save_figure(args.outdir, filename_base)
 
 # ========
 # = Main =
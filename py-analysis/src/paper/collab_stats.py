@@ -98,31 +98,27 @@ def theil(x):
 # = Main =
 # ========
 
-if __name__ == "__main__":
+def get_parser():
   parser = argparse.ArgumentParser(description='Statistics relating to collaborative editing practices.')
   parser.add_argument('datafile', help='TSV of user data')
   parser.add_argument('outdir', help='directory for output files')
   parser.add_argument('groupcol', help='column name used to group population subsets')
   parser.add_argument('--topuser-percentile', help='work percentile threshold for highly engaged users', dest='topuser_percentile', action='store', type=decimal.Decimal, default=80.0)
-  args = parser.parse_args()
+  return parser
+
+# data: a GroupedProfiles instance with the user profiles, or None to load them 
+# from args.datafile
+def run(args, data=None):
 
   #
   # Get data and transform it
   #
   
-  df = pandas.read_csv(args.datafile, sep="\t")
-  metrics = df.columns.tolist()
-  metrics.remove(args.groupcol)
-  
-  # iso2 -> list of user dicts
-  data = defaultdict(list)
-  
-  for idx, row in df.iterrows():
-    iso2 = row[args.groupcol]
-    rec = dict()
-    for metric in metrics:
-      rec[metric] = row[metric]
-    data[iso2].append(rec)
+  # grouped columns: iso2 -> measure -> values
+  if data==None or data.groupcol!=args.groupcol:
+    data = load_profiles(args.datafile, args.groupcol, 
+      measures=['num_edits', 'num_tag_add', 'num_tag_update', 'num_tag_remove', 
+        'num_coll_edits', 'num_coll_tag_add', 'num_coll_tag_update', 'num_coll_tag_remove'])
 
   #
   # Per country: share of collab editors
@@ -132,16 +128,16 @@ if __name__ == "__main__":
   stats = defaultdict(dict)
   for iso2 in data.keys():
     rec = dict()
-    num_users = len(data[iso2])
-
-    edits = [d['num_edits'] for d in data[iso2]]
-    tag_adds = [d['num_tag_add'] for d in data[iso2]]
-    tag_updates = [d['num_tag_update'] for d in data[iso2]]
-    tag_removes = [d['num_tag_remove'] for d in data[iso2]]
-    coll_edits = [d['num_coll_edits'] for d in data[iso2]]
-    coll_tag_adds = [d['num_coll_tag_add'] for d in data[iso2]]
-    coll_tag_updates = [d['num_coll_tag_update'] for d in data[iso2]]
-    coll_tag_removes = [d['num_coll_tag_remove'] for d in data[iso2]]
+    num_users = data.size(iso2)
+
+    edits = data.value_list(iso2, 'num_edits')
+    tag_adds = data.value_list(iso2, 'num_tag_add')
+    tag_updates = data.value_list(iso2, 'num_tag_update')
+    tag_removes = data.value_list(iso2, 'num_tag_remove')
+    coll_edits = data.value_list(iso2, 'num_coll_edits')
+    coll_tag_adds = data.value_list(iso2, 'num_coll_tag_add')
+    coll_tag_updates = data.value_list(iso2, 'num_coll_tag_update')
+    coll_tag_removes = data.value_list(iso2, 'num_coll_tag_remove')
     
     # "population"
     rec['num_users'] = num_users
@@ -151,7 +147,8 @@ if __name__ == "__main__":
 
     rec['coll_users_gini'] = gini(coll_edits)
     
-    norm_coll_edits = coll_edits / Decimal(sum(coll_edits))
+    # floats rather than Decimals: H(...) takes np.log of each share
+    norm_coll_edits = np.array(coll_edits, dtype=np.float64) / sum(coll_edits)
     redundancy, inequality = theil(norm_coll_edits)
     # rec['coll_users_theil_r'] = redundancy
     rec['coll_users_theil'] = inequality
@@ -217,3 +214,6 @@ if __name__ == "__main__":
     ['p_coll_edits', 
     'p_coll_tag_add', 'p_coll_tag_update', 'p_coll_tag_remove'], 
     args.outdir, 'country_profiles_edits')
+
+if __name__ == "__main__":
+  run(get_parser().parse_args())
@@ -23,6 +23,51 @@ import numpy as np
 from app import *
 from shared import *
 
+# ==========
+# = Totals =
+# ==========
+
+# Per-group population sizes and metric totals of a TSV file of user data.
+# chunksize: number of rows to read at a time, or None to read the whole file
+# Returns a pandas DataFrame indexed by group, with a 'pop' column and one
+# column per metric. Metric totals share a common dtype, e.g. they are all 
+# floats if any of the metrics are floats.
+def get_group_totals(filename, groupcol, metrics, chunksize=None):
+  usecols = [groupcol] + metrics
+  if chunksize==None:
+    chunks = [read_tsv(filename, usecols=usecols)]
+  else:
+    chunks = pandas.read_csv(filename, sep="\t", usecols=usecols, chunksize=chunksize)
+
+  totals = []
+  for chunk in chunks:
+    chunk = chunk[usecols]
+    chunk.insert(1, 'pop', 1)
+    totals.append(chunk.groupby(groupcol).sum())
+  totals = pandas.concat(totals).groupby(level=0).sum()
+
+  dtype = np.find_common_type([totals[metric].dtype for metric in metrics], [])
+  return totals.astype(dict([(metric, dtype) for metric in metrics]))
+
+# Joins pre- and post-filter group totals, and computes the share of each
+# total that was removed by the filter. Groups without any post-filter 
+# records have post-filter totals of 0.
+# Returns a pandas DataFrame indexed by group, with columns <total>_pre, 
+# <total>_post, p_<total>_removed.
+def get_filter_stats(pre_totals, post_totals):
+  stats = pre_totals.join(post_totals, how='outer', lsuffix='_pre', rsuffix='_post')
+
+  dtypes = dict()
+  for column in pre_totals.columns:
+    dtypes['%s_pre' % column] = pre_totals[column].dtype
+    dtypes['%s_post' % column] = post_totals[column].dtype
+  stats = stats.fillna(0).astype(dtypes)
+
+  for column in pre_totals.columns:
+    stats['p_%s_removed' % column] = \
+      1 - 1.0 * stats['%s_post' % column] / stats['%s_pre' % column]
+  return stats
+
 # ========
 # = Main =
 # ========
@@ -34,40 +79,28 @@ if __name__ == "__main__":
   parser.add_argument('outdir', help='directory for output files')
   parser.add_argument('groupcol', help='column name used to group population subsets')
   parser.add_argument('metrics', nargs='+', help='column names for aggregate statistics per segment')
+  parser.add_argument('--chunksize', help='read the input files in chunks of this many rows, for inputs that do not fit in memory', dest='chunksize', action='store', type=int, default=None)
   args = parser.parse_args()
 
   #
   # Read and process data
   #
   
-  pre_data = pandas.read_csv(args.pre_data, sep="\t")
-  pre_data = pre_data[[args.groupcol] + args.metrics]
-  pre_groups = pre_data.groupby(args.groupcol)
-  pre_len = pre_groups[args.groupcol].count()
-  pre_stats = pre_groups.sum()
-
-  post_data = pandas.read_csv(args.post_data, sep="\t")
-  post_data = post_data[[args.groupcol] + args.metrics]
-  post_groups = post_data.groupby(args.groupcol)
-  post_len = post_groups[args.groupcol].count()
-  post_stats = post_groups.sum()
+  pre_totals = get_group_totals(args.pre_data, args.groupcol, args.metrics, 
+    chunksize=args.chunksize)
+  post_totals = get_group_totals(args.post_data, args.groupcol, args.metrics, 
+    chunksize=args.chunksize)
 
-  # group -> metric -> value
-  stats = defaultdict(dict)
+  unknown_groups = post_totals.index.difference(pre_totals.index)
+  if len(unknown_groups) > 0:
+    print "Ignoring %d groups that are missing from the pre-filter data: %s" % (
+      len(unknown_groups), ", ".join([str(group) for group in unknown_groups]))
+    post_totals = post_totals.drop(unknown_groups)
 
-  for group in pre_data[args.groupcol].unique():
-    rec = dict()
-  
-    rec['pop_pre'] = pre_len[group]
-    rec['pop_post'] = post_len[group]
-    rec['p_pop_removed'] = 1 - 1.0 * post_len[group] / pre_len[group]
-  
-    for metric in args.metrics:
-      rec['%s_pre' % metric] = pre_stats.ix[group][metric]
-      rec['%s_post' % metric] = post_stats.ix[group][metric]
-      rec['p_%s_removed' % metric] = 1 - 1.0 * post_stats.ix[group][metric] / pre_stats.ix[group][metric]
-  
-    stats[group] = rec
+  filter_stats = get_filter_stats(pre_totals, post_totals)
+
+  # group -> metric -> value
+  stats = filter_stats.to_dict(orient='index')
   
   #
   # Report
@@ -87,6 +120,7 @@ if __name__ == "__main__":
     args.outdir, 'bulkimport_filter_stats')
   
   # Groups are ranked by population size, descending
+  pre_len = filter_stats['pop_pre']
   groups = sorted(pre_len.keys(), key=lambda group: pre_len[group], reverse=True)
 
   group_share_plot(stats, groups, graph_measures, 
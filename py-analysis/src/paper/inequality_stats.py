@@ -11,7 +11,6 @@ import argparse
 from collections import defaultdict
 import copy
 from decimal import Decimal
-import gc
 import sys
 
 import pandas
@@ -34,34 +33,30 @@ from shared import *
 def group_plot(data, groups, measures, outdir, filename_base, 
   xgroups=None, colors=QUALITATIVE_MEDIUM, **kwargs):
 
-  for (measure, iso2, ax1) in plot_matrix(measures, groups, cellwidth=3, 
-    cellheight=0.5, shared_xscale=True, xgroups=xgroups,
-    hspace=0.05, wspace=0.05):
-
-    if data[iso2][measure] == None:
-      ax1.set_axis_bgcolor('#eeeeee')
-      plt.setp(ax1.spines.values(), color='none')
-    else:
-      value = data[iso2][measure]
-      ax1.barh(0, value, 1, left=0, 
-        color=colors[0], edgecolor='none',
-        **kwargs)
-      ax1.set_frame_on(False)
-
-    ax1.margins(0.05, 0.05)
-    # ax1.get_xaxis().set_major_formatter(ticker.FuncFormatter(to_even_percent))
-    ax1.get_xaxis().set_ticks([])
-    ax1.get_yaxis().set_ticks([])
+  with FigureSession(filename_base):
+    for (measure, iso2, ax1) in plot_matrix(measures, groups, cellwidth=3, 
+      cellheight=0.5, shared_xscale=True, xgroups=xgroups,
+      hspace=0.05, wspace=0.05):
+
+      if data[iso2][measure] == None:
+        ax1.set_facecolor('#eeeeee')
+        plt.setp(ax1.spines.values(), color='none')
+      else:
+        value = data[iso2][measure]
+        ax1.barh(0, value, 1, left=0, 
+          color=colors[0], edgecolor='none',
+          **kwargs)
+        ax1.set_frame_on(False)
+
+      ax1.margins(0.05, 0.05)
+      # ax1.get_xaxis().set_major_formatter(ticker.FuncFormatter(to_even_percent))
+      ax1.get_xaxis().set_ticks([])
+      ax1.get_yaxis().set_ticks([])
     
-    # ax1.patch.set_visible(False)
-    # ax1.axis('off')
+      # ax1.patch.set_visible(False)
+      # ax1.axis('off')
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
-
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    save_figure(outdir, filename_base)
 
 # data:
 # groups:
@@ -78,39 +73,35 @@ def group_plot(data, groups, measures, outdir, filename_base,
 def scatter_grid(data, groups, col_measures, row_measures, outdir, filename_base, 
   scale='linear', colors=QUALITATIVE_MEDIUM, size=20, sizemap=None, **kwargs):
   
-  for (col, row, ax1) in plot_matrix(col_measures, row_measures):
-    x = [data[group][col] for group in groups]
-    y = [data[group][row] for group in groups]
-
-    s = size
-    if sizemap!=None:
-      s = [sizemap[group] * size for group in groups]
-
-    ax1.scatter(x, y, s=s, edgecolors='none', color=colors[0], **kwargs)
-
-    # # Workaround: won't autoscale for very small values
-    # ax1.set_xlim(min(x), max(x))
-    # ax1.set_ylim(min(y), max(y))
-
-    ax1.margins(0.2, 0.2)
-    ax1.set_xscale(scale)
-    ax1.set_yscale(scale)
-    ax1.get_xaxis().set_ticks([])
-    ax1.get_yaxis().set_ticks([])
+  with FigureSession(filename_base):
+    for (col, row, ax1) in plot_matrix(col_measures, row_measures):
+      x = [data[group][col] for group in groups]
+      y = [data[group][row] for group in groups]
+
+      s = size
+      if sizemap!=None:
+        s = [sizemap[group] * size for group in groups]
+
+      ax1.scatter(x, y, s=s, edgecolors='none', color=colors[0], **kwargs)
+
+      # # Workaround: won't autoscale for very small values
+      # ax1.set_xlim(min(x), max(x))
+      # ax1.set_ylim(min(y), max(y))
+
+      ax1.margins(0.2, 0.2)
+      ax1.set_xscale(scale)
+      ax1.set_yscale(scale)
+      ax1.get_xaxis().set_ticks([])
+      ax1.get_yaxis().set_ticks([])
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
-
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    save_figure(outdir, filename_base)
   
 
 # ========
 # = Main =
 # ========
 
-if __name__ == "__main__":
+def get_parser():
   parser = argparse.ArgumentParser(description='Statistics relating to collaborative editing practices.')
   parser.add_argument('datafile', help='TSV of user data')
   parser.add_argument('outdir', help='directory for output files')
@@ -120,7 +111,13 @@ if __name__ == "__main__":
   parser.add_argument('--topuser-percentiles', help='percentile thresholds for highly engaged users', dest='topuser_percentiles', nargs='+', action='store', type=Decimal, default=[Decimal(10), Decimal(1), Decimal('0.1')])
   parser.add_argument('--rop-percentiles', help='percentile thresholds for "ratio of percentiles" scores', dest='rop_percentiles', nargs='+', action='store', type=Decimal, default=[Decimal(10), Decimal(20), Decimal(50), Decimal(80), Decimal(90), Decimal(95)])
   parser.add_argument('--num-groups', help='The number of groups to analyse (ranked by size)', dest='num_groups', action='store', type=int, default=None)
-  args = parser.parse_args()
+  parser.add_argument('--force', help='regenerate all outputs, including those whose inputs have not changed since the last run', dest='force', action='store_true', default=False)
+  parser.add_argument('--plot-workers', help='The number of processes used to render figures. Default: number of CPUs', dest='plot_workers', action='store', type=int, default=None)
+  return parser
+
+# data: a GroupedProfiles instance with the user profiles, or None to load them 
+# from args.datafile
+def run(args, data=None):
   
   # #
   # # Debugging
@@ -143,18 +140,9 @@ if __name__ == "__main__":
   # Get data and transform it
   #
   
-  df = pandas.read_csv(args.datafile, sep="\t")
-  metrics = df.columns.tolist()
-  metrics.remove(args.groupcol)
-  
-  # dict: group -> list of user dicts
-  data = defaultdict(list)
-  for idx, row in df.iterrows():
-    group = row[args.groupcol]
-    rec = dict()
-    for metric in metrics:
-      rec[metric] = row[metric]
-    data[group].append(rec)
+  # grouped columns: group -> measure -> values
+  if data==None or data.groupcol!=args.groupcol:
+    data = load_profiles(args.datafile, args.groupcol, measures=args.measures)
 
   #
   # Filter according to options, if needed
@@ -163,7 +151,7 @@ if __name__ == "__main__":
   # Groups are ranked by population size, descending
   print "Group column: %s" % args.groupcol
   
-  groups = sorted(data.keys(), key=lambda group: len(data[group]), reverse=True)
+  groups = sorted(data.keys(), key=lambda group: data.size(group), reverse=True)
 
   if args.num_groups:
     print "Limiting to %d groups (from %d)" % (args.num_groups, len(data.keys()))
@@ -183,9 +171,10 @@ if __name__ == "__main__":
   for group in groups:
     rec = dict()
     for measure in args.measures:
-      rec[measure] = [d[measure] for d in data[group] \
-        if (args.only_nonzero==False or \
-        d[measure] != 0)]
+      values = data.values(group, measure)
+      if args.only_nonzero:
+        values = values[values != 0]
+      rec[measure] = values.tolist()
     pop[group] = rec
   
   #
@@ -264,38 +253,40 @@ if __name__ == "__main__":
   #
   
   mkdir_p(args.outdir)
+  manifest = OutputManifest(args.outdir, force=args.force)
+  figures = FigureQueue(args.plot_workers, manifest=manifest)
 
   for measure in args.measures:
 
-    groupstat_report(stats[measure], args.groupcol, stats_types, 
+    manifest.run(groupstat_report, stats[measure], args.groupcol, stats_types, 
       args.outdir, 'stats_%s' % measure) 
     
     # Bar plots
-    group_plot(stats[measure], groups, basic_scores, 
+    figures.submit(group_plot, stats[measure], groups, basic_scores, 
       args.outdir, '%s_inequality_1_normalised' % measure)
     
-    group_plot(stats[measure], groups, basic_scores, 
+    figures.submit(group_plot, stats[measure], groups, basic_scores, 
       args.outdir, '%s_inequality_1' % measure,
       xgroups=basic_scores) 
     
-    group_plot(stats[measure], groups, top_scores, 
+    figures.submit(group_plot, stats[measure], groups, top_scores, 
       args.outdir, '%s_inequality_2_normalised' % measure)
     
-    group_plot(stats[measure], groups, top_scores, 
+    figures.submit(group_plot, stats[measure], groups, top_scores, 
       args.outdir, '%s_inequality_2' % measure,
       xgroups=[top_scores]) 
     
-    group_plot(stats[measure], groups, rop_scores, 
+    figures.submit(group_plot, stats[measure], groups, rop_scores, 
       args.outdir, '%s_inequality_3_normalised' % measure)
     
-    group_plot(stats[measure], groups, rop_scores, 
+    figures.submit(group_plot, stats[measure], groups, rop_scores, 
       args.outdir, '%s_inequality_3' % measure,
       xgroups=[rop_scores]) 
     
-    group_plot(stats[measure], groups, qom_scores, 
+    figures.submit(group_plot, stats[measure], groups, qom_scores, 
       args.outdir, '%s_inequality_4_normalised' % measure)
     
-    group_plot(stats[measure], groups, qom_scores, 
+    figures.submit(group_plot, stats[measure], groups, qom_scores, 
       args.outdir, '%s_inequality_4' % measure,
       xgroups=[qom_scores]) 
 
@@ -305,31 +296,31 @@ if __name__ == "__main__":
     norm = {group: 1.0 * pop[group] / max_pop for group in groups}
     sizemap = {group: norm[group] + 0.2 for group in groups}
 
-    scatter_grid(stats[measure], groups, 
+    figures.submit(scatter_grid, stats[measure], groups, 
       ['20_20', 'palma', 'top_10%', 'rop_95', 'qom_3'], 
       ['pop', 'total', 'gini', 'top_10%', 'rop_95', 'qom_3'], 
       args.outdir, '%s_scatter_complements' % measure,
       size=100, sizemap=sizemap, alpha=0.8)
 
-    scatter_grid(stats[measure], groups, 
+    figures.submit(scatter_grid, stats[measure], groups, 
       ['gini', 'palma', 'top_10%'], 
       ['pop', 'total'], 
       args.outdir, '%s_scatter_scale' % measure,
       size=100, sizemap=sizemap, alpha=0.8)
 
-    scatter_grid(stats[measure], groups, 
+    figures.submit(scatter_grid, stats[measure], groups, 
       top_scores, 
       top_scores, 
       args.outdir, '%s_scatter_topx' % measure,
       size=100, sizemap=sizemap, alpha=0.8)
 
-    scatter_grid(stats[measure], groups, 
+    figures.submit(scatter_grid, stats[measure], groups, 
       rop_scores, 
       rop_scores, 
       args.outdir, '%s_scatter_rop' % measure,
       size=100, sizemap=sizemap, alpha=0.8)
 
-    scatter_grid(stats[measure], groups, 
+    figures.submit(scatter_grid, stats[measure], groups, 
       qom_scores, 
       qom_scores, 
       args.outdir, '%s_scatter_qom' % measure,
@@ -340,4 +331,10 @@ if __name__ == "__main__":
     #   rop_scores, 
     #   args.outdir, '%s_scatter_top_rop' % measure,
     #   size=100, sizemap=sizemap, alpha=0.8)
-    #   
\ No newline at end of file
+    #   
+
+  figures.join()
+  write_figure_memory(args.outdir)
+
+if __name__ == "__main__":
+  run(get_parser().parse_args())
@@ -25,7 +25,7 @@ from shared import *
 # = Main =
 # ========
 
-if __name__ == "__main__":
+def get_parser():
   parser = argparse.ArgumentParser(description='Statistics relating to collaborative editing practices.')
   parser.add_argument('datafile', help='TSV of user data')
   parser.add_argument('outdir', help='Directory for output files')
@@ -33,26 +33,25 @@ if __name__ == "__main__":
   parser.add_argument('measures', help='Column names of population measures', nargs='+')
   parser.add_argument('--num-groups', help='The number of groups to analyse (ranked by size)', dest='num_groups', action='store', type=int, default=None)
   parser.add_argument('--num-bands', help='Number of population bands', dest='num_bands', action='store', type=int, default=5)
-  args = parser.parse_args()
+  return parser
+
+# data: a GroupedProfiles instance with the user profiles, or None to load them 
+# from args.datafile
+def run(args, data=None):
 
   #
   # Get data and transform it
   #
   
-  df = pandas.read_csv(args.datafile, sep="\t")
-  
-  # measure -> group -> list of values
-  data = defaultdict(lambda: defaultdict(list))
-  
-  for idx, row in df.iterrows():
-    group = row[args.groupcol]
-    for measure in args.measures:
-      data[measure][group].append(row[measure])
+  # grouped columns: group -> measure -> values
+  if data==None or data.groupcol!=args.groupcol:
+    data = load_profiles(args.datafile, args.groupcol, measures=args.measures)
 
   #
   # Filter according to options, if needed
   #
-  groups = top_keys(data[args.measures[0]], args.num_groups)
+  groups = top_keys(data.sizes(), args.num_groups, 
+    summarise=lambda data,key: data[key])
 
   print "Group column: %s" % args.groupcol
   print "Found %d groups" % len(groups)
@@ -64,33 +63,31 @@ if __name__ == "__main__":
   
   # dict: measure -> group -> stats_name -> value
   group_bands = defaultdict(lambda: defaultdict(dict))
-  group_band_colnames = set()
 
   # dict: measure -> band -> value
   band_cv = defaultdict(dict)
-  band_names = set()
+  band_names = ['band_%d' % band for band in range(args.num_bands)]
 
   for measure in args.measures:
-    for segmin, segmax in zip(range(args.num_bands), range(1, args.num_bands+1)):
-
-      band = 'band_%d' % segmin
-      band_names.add(band)
-      min_perc = Decimal(segmin) / args.num_bands * 100
-      max_perc = Decimal(segmax) / args.num_bands * 100
-      
-      for group in groups:
-        all_values = [val for val in data[measure][group] if val>0]
-        band_values = percentile_range(all_values, min_perc, max_perc)
-
-        group_bands[measure][group]['%s_pop' % band] = len(band_values)
-        group_band_colnames.add('%s_pop' % band)
-
-        group_bands[measure][group]['%s_share' % band] = \
-          float(sum(band_values)) / sum(all_values)
-        group_band_colnames.add('%s_share' % band)
-      
-      band_shares = [group_bands[measure][group]['%s_share' % band] for group in groups]
-      band_cv[measure][band] = np.std(band_shares) / np.mean(band_shares)
+    # matrix: group x band
+    shares = np.zeros((len(groups), args.num_bands))
+    for (idx, group) in enumerate(groups):
+      all_values = data.values(group, measure)
+      (band_pops, shares[idx]) = percentile_band_shares(all_values[all_values>0], 
+        args.num_bands)
+
+      for (band, band_pop, band_share) in zip(band_names, band_pops.tolist(), 
+        shares[idx].tolist()):
+        group_bands[measure][group]['%s_pop' % band] = band_pop
+        group_bands[measure][group]['%s_share' % band] = band_share
+    
+    # one row per band, for row-wise reductions
+    shares = np.ascontiguousarray(shares.T)
+    cv = np.std(shares, axis=1) / np.mean(shares, axis=1)
+    band_cv[measure] = dict(zip(band_names, cv.tolist()))
+
+  group_band_colnames = ['%s_%s' % (band, stat) 
+    for band in band_names for stat in ['pop', 'share']]
       
   #
   # Report: country profiles
@@ -124,3 +121,6 @@ if __name__ == "__main__":
   #   ['p_coll_edits', 
   #   'p_coll_tag_add', 'p_coll_tag_update', 'p_coll_tag_remove'], 
   #   args.outdir, 'country_profiles_edits')
+
+if __name__ == "__main__":
+  run(get_parser().parse_args())
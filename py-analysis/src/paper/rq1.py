@@ -29,15 +29,15 @@ from shared import *
 def lorenz_matrix_plot(data, groups, measures, steps, outdir, filename_base, 
   colors=QUALITATIVE_MEDIUM, **kwargs):
   
-  for (measure, group, ax1) in plot_matrix(measures, groups, cellwidth=4, cellheight=4):
-    colgen = looping_generator(colors)
-    y = [ranked_percentile_share(data[group][measure], perc) for perc in steps]
-    ax1.fill(steps, y, color=colgen.next(), **kwargs)
+  with FigureSession(filename_base):
+    for (measure, group, ax1) in plot_matrix(measures, groups, cellwidth=4, cellheight=4):
+      colgen = looping_generator(colors)
+      y = [ranked_percentile_share(data[group][measure], perc) for perc in steps]
+      ax1.fill(steps, y, color=colgen.next(), **kwargs)
 
-    ax1.margins(0.1, 0.1)
+      ax1.margins(0.1, 0.1)
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # data: group -> measure -> list of values
 # steps: the percentages for which cumulative "income" is computed
@@ -46,31 +46,35 @@ def lorenz_matrix_plot(data, groups, measures, steps, outdir, filename_base,
 def combined_lorenz_plot(data, groups, measure, steps, outdir, filename_base, 
   colors=QUALITATIVE_MEDIUM, alpha=0.4, **kwargs):
   
-  fig = plt.figure(figsize=(4, 4))
-  fig.patch.set_facecolor('white')
-  plt.margins(0.1, 0.1)
+  with FigureSession(filename_base):
+    fig = plt.figure(figsize=(4, 4))
+    fig.patch.set_facecolor('white')
+    plt.margins(0.1, 0.1)
   
-  colgen = looping_generator(colors)
-  color = colgen.next()
+    colgen = looping_generator(colors)
+    color = colgen.next()
   
-  for group in groups:
-    y = [ranked_percentile_share(data[group][measure], perc) for perc in steps]
-    plt.plot(steps, y, color=color, alpha=alpha, **kwargs)
+    for group in groups:
+      y = [ranked_percentile_share(data[group][measure], perc) for perc in steps]
+      plt.plot(steps, y, color=color, alpha=alpha, **kwargs)
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # ========
 # = Main =
 # ========
 
-if __name__ == "__main__":
+def get_parser():
   parser = argparse.ArgumentParser(description='Statistics relating to collaborative editing practices.')
   parser.add_argument('datafile', help='TSV of user data')
   parser.add_argument('outdir', help='directory for output files')
   parser.add_argument('--lorenz-steps', help='Lorenz curve population percentage thresholds', dest='lorenz_steps', nargs='+', action='store', type=Decimal, default=[Decimal(v) for v in range(0,102,2)])
   parser.add_argument('--num-groups', help='The number of groups to analyse (ranked by size)', dest='num_groups', action='store', type=int, default=None)
-  args = parser.parse_args()
+  return parser
+
+# data: a GroupedProfiles instance with the user profiles, or None to load them 
+# from args.datafile
+def run(args, data=None):
   
   #
   # Defaults
@@ -86,24 +90,16 @@ if __name__ == "__main__":
   # = Load data & transform it =
   # ============================
 
-  df = pandas.read_csv(args.datafile, sep="\t")
-  metrics = df.columns.tolist()
-  metrics.remove(groupcol)
-  
-  # dict: group -> list of user dicts
-  data = defaultdict(list)
-  for idx, row in df.iterrows():
-    group = row[groupcol]
-    rec = dict()
-    for metric in metrics:
-      rec[metric] = row[metric]
-    data[group].append(rec)
+  # grouped columns: group -> measure -> values
+  if data==None or data.groupcol!=groupcol:
+    data = load_profiles(args.datafile, groupcol, measures=measures)
 
   #
   # Filter according to options, if needed
   #
 
-  groups = top_keys(data, args.num_groups)
+  groups = top_keys(data.sizes(), args.num_groups, 
+    summarise=lambda data,key: data[key])
   
   print "Found %d groups" % len(groups)
   print "Computing population statistics for measures: %s" % ", ".join(measures)
@@ -119,9 +115,8 @@ if __name__ == "__main__":
   # dict: group -> cohort -> list of values
   pop = { 
     group: { 
-      to_cohort_name(measure): [
-        d[measure] for d in data[group]
-      ] for measure in measures 
+      to_cohort_name(measure): data.value_list(group, measure)
+        for measure in measures 
     } for group in groups 
   }
   
@@ -211,3 +206,6 @@ if __name__ == "__main__":
   for cohort in cohorts:
     combined_lorenz_plot(pop, groups, cohort, args.lorenz_steps,
       args.outdir, 'lorenz_%s' % cohort)
+
+if __name__ == "__main__":
+  run(get_parser().parse_args())
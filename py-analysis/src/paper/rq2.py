@@ -18,18 +18,61 @@ import numpy as np
 from app import *
 from shared import *
 
+# ============
+# = Segments =
+# ============
+
+# Segment thresholds: powers of the threshold base.
+# Returns a list of segment upper bounds, excluding the open-ended top segment.
+def get_segments(threshold_base, num_segments):
+  return [threshold_base**p for p in range(num_segments-1)]
+
+def threshold_label(n1, n2):
+  if (n1 and n2):
+    return '%d<e<=%d' % (n1, n2)
+  elif (not n2):
+    return 'e>%s' % n1
+  return 'e=%d' % n2
+
+def get_threshold_labels(segments):
+  return [threshold_label(min1, max1) 
+    for (min1, max1) in zip([None] + segments, segments + [None])]
+
+# Assigns every user to a segment, with min1 < num_edits <= max1.
+# Returns a numpy array of segment indices, in range [0..len(segments)].
+def get_segment_index(edits, segments):
+  if len(segments)==0:
+    return np.zeros(len(edits), dtype=int)
+  return np.digitize(edits, segments, right=True)
+
+# Per-segment sums of a measure, keeping the measure's dtype.
+# Returns a list of Python scalars, one per segment.
+def segment_sums(values, seg_idx, num_segments):
+  sums = np.zeros(num_segments, dtype=values.dtype)
+  np.add.at(sums, seg_idx, values)
+  return sums.tolist()
+
+# Per-segment counts of users with a positive measure.
+# Returns a list of ints, one per segment.
+def segment_counts(values, seg_idx, num_segments):
+  return np.bincount(seg_idx[values>0], minlength=num_segments).tolist()
+
 # ========
 # = Main =
 # ========
 
-if __name__ == "__main__":
+def get_parser():
   parser = argparse.ArgumentParser(description='Statistics relating to collaborative editing practices.')
   parser.add_argument('datafile', help='TSV of user data')
-  parser.add_argument('outdir', help='directory for output files')
+  parser.add_argument('outdir', help='directory for output files. Segmentation sweeps are written to one subdirectory per segmentation')
   parser.add_argument('--num-groups', help='The number of groups to analyse (ranked by size)', dest='num_groups', action='store', type=int, default=None)
-  parser.add_argument('--num-segments', help='The number of segments per group', dest='num_segments', action='store', type=int, default=4)
-  parser.add_argument('--threshold-base', help='The "power of x" base when calculating segment thresholds', dest='threshold_base', action='store', type=int, default=10)
-  args = parser.parse_args()
+  parser.add_argument('--num-segments', help='The number of segments per group. Multiple values are evaluated as a sweep', dest='num_segments', nargs='+', action='store', type=int, default=[4])
+  parser.add_argument('--threshold-base', help='The "power of x" base when calculating segment thresholds. Multiple values are evaluated as a sweep', dest='threshold_base', nargs='+', action='store', type=int, default=[10])
+  return parser
+
+# data: a GroupedProfiles instance with the user profiles, or None to load them 
+# from args.datafile
+def run(args, data=None):
   
   #
   # Defaults
@@ -37,17 +80,11 @@ if __name__ == "__main__":
   
   groupcol = 'country'
   
-  # segmentation: powers of ten
-  segments = [args.threshold_base**p for p in range(args.num_segments-1)]
-  # segments = [2**p for p in range(5)]
-  # segments = [5**p for p in range(4)]
-  # segments = [10**p for p in range(4)]
-  thresholds = zip([None] + segments, segments + [None])
-  threshold_label = lambda n1, n2: \
-    '%d<e<=%d' % (n1, n2) if (n1 and n2) else \
-    'e>%s' % n1 if (not n2) else \
-    'e=%d' % n2
-  threshold_labels = [threshold_label(min1, max1) for (min1, max1) in thresholds]
+  # segmentation: powers of the threshold base, e.g. powers of ten.
+  # list of (threshold base, num segments)
+  segmentations = [(threshold_base, num_segments) 
+    for threshold_base in args.threshold_base
+    for num_segments in args.num_segments]
 
   measures = ['num_coll_edits']
   # to_cohort_name = lambda measure: measure.replace('num_', '', 1)
@@ -57,24 +94,16 @@ if __name__ == "__main__":
   # = Load data & transform it =
   # ============================
 
-  df = pandas.read_csv(args.datafile, sep="\t")
-  metrics = df.columns.tolist()
-  metrics.remove(groupcol)
-  
-  # dict: group -> list of user dicts
-  data = defaultdict(list)
-  for idx, row in df.iterrows():
-    group = row[groupcol]
-    rec = dict()
-    for metric in metrics:
-      rec[metric] = row[metric]
-    data[group].append(rec)
+  # grouped columns: group -> measure -> values
+  if data==None or data.groupcol!=groupcol:
+    data = load_profiles(args.datafile, groupcol, measures=['num_edits'] + measures)
 
   #
   # Filter according to options, if needed
   #
 
-  groups = top_keys(data, args.num_groups)
+  groups = top_keys(data.sizes(), args.num_groups, 
+    summarise=lambda data,key: data[key])
   print "Found %d groups" % len(groups)
 
   # =================
@@ -88,105 +117,105 @@ if __name__ == "__main__":
   # dict: group -> metric -> value
   group_stats = defaultdict(dict)
   for group in groups:
-    edits = [d['num_edits'] for d in data[group] if d['num_edits']>0]
-    group_stats[group]['pop'] = len(edits)
-    group_stats[group]['edits'] = sum(edits)
-  
-  #
-  # Segment users
-  # 
-
-  # dict: group -> segment -> measure -> list of values
-  pop = { 
-    group: { 
-      threshold_label(min1, max1): {
-        measure: [
-          d[measure] for d in data[group]
-            if (min1==None or d['num_edits']>min1)
-            and (max1==None or d['num_edits']<=max1)
-        ] for measure in measures
-      } for (min1, max1) in thresholds
-    } for group in groups
-  }
-  
-  # dict: measure -> group -> segment -> value
-  measure_segment_sizes = {
-    measure: {
-      group: {
-        label: 
-          len([v for v in pop[group][label][measure] if v>0])
-        for label in threshold_labels
-      } for group in groups
-    } for measure in measures
-  }
-  
-  #
-  # Per segment: compute summary stats
-  # 
-
-  # dict: stat -> group -> segment -> value
-  stats = defaultdict(lambda: defaultdict(dict))
-  for group in groups:
-    for label in threshold_labels:
+    edits = data.values(group, 'num_edits')
+    group_stats[group]['pop'] = int(np.count_nonzero(edits>0))
+    group_stats[group]['edits'] = edits[edits>0].sum().tolist()
+
+  for (threshold_base, num_segments) in segmentations:
+    outdir = args.outdir
+    if len(segmentations) > 1:
+      outdir = os.path.join(args.outdir, 'base%d_segments%d' % (threshold_base, num_segments))
+      print "Segmentation: base %d, %d segments" % (threshold_base, num_segments)
+
+    segments = get_segments(threshold_base, num_segments)
+    threshold_labels = get_threshold_labels(segments)
+
+    #
+    # Segment users
+    # 
+
+    # dict: measure -> group -> segment -> value
+    measure_segment_sizes = defaultdict(dict)
+    # dict: measure -> group -> segment -> value
+    measure_segment_sums = defaultdict(dict)
+    for group in groups:
+      seg_idx = get_segment_index(data.values(group, 'num_edits'), segments)
+      for measure in measures:
+        values = data.values(group, measure)
+        measure_segment_sizes[measure][group] = dict(zip(threshold_labels, 
+          segment_counts(values, seg_idx, len(threshold_labels))))
+        measure_segment_sums[measure][group] = dict(zip(threshold_labels, 
+          segment_sums(values, seg_idx, len(threshold_labels))))
+
+    #
+    # Per segment: compute summary stats
+    # 
+
+    # dict: stat -> group -> segment -> value
+    stats = defaultdict(lambda: defaultdict(dict))
+    for group in groups:
       total_users = Decimal(group_stats[group]['pop'])
       total_edits = Decimal(group_stats[group]['edits'])
+      for label in threshold_labels:
+        stats['P_coll'][group][label] = \
+          measure_segment_sizes['num_coll_edits'][group][label] / total_users
+        stats['W_coll'][group][label] = \
+          measure_segment_sums['num_coll_edits'][group][label] / total_edits
+
+    #
+    # Segment variances across groups
+    #
+    
+    stat_names = ['P_coll', 'W_coll']
+    
+    # dict: stat -> segment -> list of values
+    seg_stats = { 
+      stat_name: {
+        label: 
+          [float(stats[stat_name][group][label]) for group in groups] 
+        for label in threshold_labels 
+      } for stat_name in stat_names 
+    }
+    
+    # dict: segment -> stat -> value
+    cov_seg_stats = { 
+      label: { 
+        stat_name: 
+          np.std(seg_stats[stat_name][label]) / np.mean(seg_stats[stat_name][label]) 
+        for stat_name in stat_names 
+      } for label in threshold_labels 
+    }
+    
+    # ====================
+    # = Reports & charts =
+    # ====================
+    
+    mkdir_p(outdir)
+    
+    #
+    # Summary stats
+    #
+    
+    for measure in measures:
+      groupstat_report(measure_segment_sizes[measure], groupcol, threshold_labels, 
+        outdir, 'segment_sizes_%s' % measure)
+
+    for stat_name in stat_names:
+      groupstat_report(stats[stat_name], groupcol, threshold_labels,
+        outdir, 'stats_%s' % stat_name)
+        
+      groupstat_plot(stats[stat_name], groups, threshold_labels, 
+        outdir, 'stats_%s' % stat_name,
+        xgroups=[threshold_labels])
+    
+    boxplot_matrix(seg_stats, stat_names, threshold_labels,
+      outdir, 'boxplots')
+
+    groupstat_report(cov_seg_stats, 'CoV(x)', stat_names,
+      outdir, 'cov')
+    
+    groupstat_plot(cov_seg_stats, threshold_labels, stat_names, 
+      outdir, 'cov')
 
-      values = pop[group][label]['num_coll_edits']
-      stats['P_coll'][group][label] = len([v for v in values if v>0]) / total_users
-      stats['W_coll'][group][label] = sum(values) / total_edits
-
-  #
-  # Segment variances across groups
-  #
-  
-  stat_names = ['P_coll', 'W_coll']
-  
-  # dict: segment -> stat -> list of values
-  seg_stats = { 
-    stat_name: {
-      label: 
-        [float(stats[stat_name][group][label]) for group in groups] 
-      for label in threshold_labels 
-    } for stat_name in stat_names 
-  }
-  
-  # dict: stat -> segment -> value
-  cov_seg_stats = { 
-    stat_name: { 
-      label: 
-        np.std(seg_stats[stat_name][label]) / np.mean(seg_stats[stat_name][label]) 
-      for label in threshold_labels 
-    } for stat_name in stat_names 
-  }
-  
-  # ====================
-  # = Reports & charts =
-  # ====================
-  
-  mkdir_p(args.outdir)
-  
-  #
-  # Summary stats
-  #
-  
-  for measure in measures:
-    groupstat_report(measure_segment_sizes[measure], groupcol, threshold_labels, 
-      args.outdir, 'segment_sizes_%s' % measure)
-
-  for stat_name in stat_names:
-    groupstat_report(stats[stat_name], groupcol, threshold_labels,
-      args.outdir, 'stats_%s' % stat_name)
-      
-    groupstat_plot(stats[stat_name], groups, threshold_labels, 
-      args.outdir, 'stats_%s' % stat_name,
-      xgroups=[threshold_labels])
-  
-  boxplot_matrix(seg_stats, stat_names, threshold_labels,
-    args.outdir, 'boxplots')
-
-  groupstat_report(cov_seg_stats, 'CoV(x)', stat_names,
-    args.outdir, 'cov')
-  
-  groupstat_plot(cov_seg_stats, threshold_labels, stat_names, 
-    args.outdir, 'cov')
-
+if __name__ == "__main__":
+  run(get_parser().parse_args())
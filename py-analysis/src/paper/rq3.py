@@ -20,12 +20,16 @@ from shared import *
 # = Main =
 # ========
 
-if __name__ == "__main__":
+def get_parser():
   parser = argparse.ArgumentParser(description='Statistics relating to collaborative editing practices.')
   parser.add_argument('datafile', help='TSV of user data')
   parser.add_argument('outdir', help='directory for output files')
   parser.add_argument('--num-groups', help='The number of groups to analyse (ranked by size)', dest='num_groups', action='store', type=int, default=None)
-  args = parser.parse_args()
+  return parser
+
+# data: a GroupedProfiles instance with the user profiles, or None to load them 
+# from args.datafile
+def run(args, data=None):
   
   #
   # Defaults
@@ -45,24 +49,16 @@ if __name__ == "__main__":
   # = Load data & transform it =
   # ============================
 
-  df = pandas.read_csv(args.datafile, sep="\t")
-  metrics = df.columns.tolist()
-  metrics.remove(groupcol)
-  
-  # dict: group -> list of user dicts
-  data = defaultdict(list)
-  for idx, row in df.iterrows():
-    group = row[groupcol]
-    rec = dict()
-    for metric in metrics:
-      rec[metric] = row[metric]
-    data[group].append(rec)
+  # grouped columns: group -> measure -> values
+  if data==None or data.groupcol!=groupcol:
+    data = load_profiles(args.datafile, groupcol, measures=['num_edits'] + measures)
 
   #
   # Filter according to options, if needed
   #
 
-  groups = top_keys(data, args.num_groups)
+  groups = top_keys(data.sizes(), args.num_groups, 
+    summarise=lambda data,key: data[key])
   print "Found %d groups" % len(groups)
 
   # =================
@@ -76,7 +72,8 @@ if __name__ == "__main__":
   # dict: group -> metric -> value
   group_stats = defaultdict(dict)
   for group in groups:
-    edits = [d['num_edits'] for d in data[group] if d['num_edits']>0]
+    edits = data.values(group, 'num_edits')
+    edits = edits[edits>0].tolist()
     group_stats[group]['pop'] = len(edits)
     group_stats[group]['edits'] = sum(edits)
   
@@ -87,7 +84,7 @@ if __name__ == "__main__":
   # dict: group -> measure -> list of values
   pop = { 
     group: { 
-      measure: [ d[measure] for d in data[group] ] for measure in measures
+      measure: data.value_list(group, measure) for measure in measures
     } for group in groups
   }
   
@@ -163,3 +160,5 @@ if __name__ == "__main__":
     args.outdir, 'ineq_stats',
     xgroups=[ineq_stat_names])
 
+if __name__ == "__main__":
+  run(get_parser().parse_args())
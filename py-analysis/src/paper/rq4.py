@@ -14,7 +14,6 @@ import os.path
 
 import matplotlib.pyplot as plt
 import pandas
-from scipy.spatial import distance
 
 from app import *
 from shared import *
@@ -41,35 +40,90 @@ def multi_scatter_matrix(data, row_keys, col_keys, groups, x_stat, y_stat,
   outdir, filename_base,  scale='linear', colors=QUALITATIVE_MEDIUM, size=20, 
   sizemap=None, **kwargs):
   
-  for (col, row, ax1) in plot_matrix(col_keys, row_keys):
-    x = [data[row][col][group][x_stat] for group in groups]
-    y = [data[row][col][group][y_stat] for group in groups]
-
-    s = size
-    if sizemap!=None:
-      s = [sizemap[group] * size for group in groups]
-
-    ax1.scatter(x, y, s=s, edgecolors='none', color=colors[0], **kwargs)
-
-    ax1.margins(0.2, 0.2)
-    ax1.set_xscale(scale)
-    ax1.set_yscale(scale)
-    ax1.get_xaxis().set_ticks([])
-    ax1.get_yaxis().set_ticks([])
+  with FigureSession(filename_base):
+    for (col, row, ax1) in plot_matrix(col_keys, row_keys):
+      x = [data[row][col][group][x_stat] for group in groups]
+      y = [data[row][col][group][y_stat] for group in groups]
+
+      s = size
+      if sizemap!=None:
+        s = [sizemap[group] * size for group in groups]
+
+      ax1.scatter(x, y, s=s, edgecolors='none', color=colors[0], **kwargs)
+
+      ax1.margins(0.2, 0.2)
+      ax1.set_xscale(scale)
+      ax1.set_yscale(scale)
+      ax1.get_xaxis().set_ticks([])
+      ax1.get_yaxis().set_ticks([])
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
-
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    save_figure(outdir, filename_base)
+
+# ====================
+# = Feature matrices =
+# ====================
+
+# Dense group x POI type matrices of profile measures.
+# profiles: a GroupedProfiles instance
+# kind_codes: numpy array of POI type indices, one per profile record
+# num_kinds: the number of POI types
+# measures: the measures to load
+# Returns a tuple: (dict of measure -> numpy matrix, boolean numpy matrix of
+# group/POI type combinations that have a record). Rows are in the order of
+# profiles.keys(). Values are 0 for combinations without a record.
+def get_feature_matrices(profiles, kind_codes, num_kinds, measures):
+  shape = (len(profiles.keys()), num_kinds)
+  present = np.zeros(shape, dtype=bool)
+  present[profiles.codes, kind_codes] = True
+  features = dict()
+  for measure in measures:
+    features[measure] = np.zeros(shape, dtype=profiles.columns[measure].dtype)
+    features[measure][profiles.codes, kind_codes] = profiles.columns[measure]
+  return (features, present)
+
+# Returns a dict: kind -> measure -> value, for a single matrix row. Values are 
+# 0.0 for POI types without a record in this row.
+def get_row_features(features, present, row, kinds, measures):
+  values = dict([(measure, features[measure][row].tolist()) for measure in measures])
+  is_present = present[row].tolist()
+  return {
+    kind: {
+      measure: values[measure][idx] if is_present[idx] else 0.0 
+        for measure in measures
+    } for (idx, kind) in enumerate(kinds)
+  }
 
+# =============
+# = Distances =
+# =============
+
+# Cosine distances between the paired rows of two matrices, computed as in
+# scipy.spatial.distance.cosine. Rows without any non-zero values have 
+# distance NaN. The row sums are accumulated in POI type order rather than in
+# the former dict order, so results can differ in the last digits.
+# Returns a numpy array of distances, one per row.
+def paired_cosine_distances(a, b):
+  a = np.ascontiguousarray(a, dtype=float)
+  b = np.ascontiguousarray(b, dtype=float)
+  uv = np.mean(a * b, axis=1)
+  uu = np.mean(np.square(a), axis=1)
+  vv = np.mean(np.square(b), axis=1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return 1.0 - uv / np.sqrt(uu * vv)
+
+# features: dict of measure -> numpy matrix, with one feature vector per row
+# Returns a list of dicts: stat_name -> value, one per row.
+def get_distance_stats(features):
+  delta_pop = paired_cosine_distances(features['%pop'], features['%coll_pop'])
+  delta_edits = paired_cosine_distances(features['%edits'], features['%coll_edits'])
+  return [{ 'delta-%pop': d1, 'delta-%edits': d2 } 
+    for (d1, d2) in zip(delta_pop.tolist(), delta_edits.tolist())]
 
 # ========
 # = Main =
 # ========
 
-if __name__ == "__main__":
+def get_parser():
   parser = argparse.ArgumentParser(description='Statistics relating to collaborative editing practices.')
   parser.add_argument('datafile', help='TSV of user data')
   parser.add_argument('outdir', help='directory for output files')
@@ -79,7 +133,11 @@ if __name__ == "__main__":
   parser.add_argument('--min-poi-edits', help='The minimum number of edits per POI type in each country, POI types below this threshold will not be considered', dest='min_poi_edits', action='store', type=int, default=None)
   parser.add_argument('--num-top-poi', help='The number of top POI to analyse (ranked by popularity)', dest='num_top_poi', action='store', type=int, default=20)
   parser.add_argument('--num-top-poi-scatter', help='The number of top POI to show in scatter plots (ranked by popularity)', dest='num_top_poi_scatter', action='store', type=int, default=20)
-  args = parser.parse_args()
+  return parser
+
+# profiles: a GroupedProfiles instance with the POI type profiles, or None to load them 
+# from args.datafile
+def run(args, profiles=None):
   
   #
   # Defaults
@@ -92,26 +150,33 @@ if __name__ == "__main__":
   # = Load data & transform it =
   # ============================
 
-  df = pandas.read_csv(args.datafile, sep="\t", encoding='utf-8')
+  if profiles==None or profiles.groupcol!=args.groupcol:
+    profiles = load_profiles(args.datafile, args.groupcol, 
+      measures=[args.poitypecol] + measures + aux_measures, encoding='utf-8')
   
-  # dict: group -> poi-type -> dict of measures
-  data = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: 0.0)))
-  for idx, row in df.iterrows():
-    group = row[args.groupcol]
-    kind = row[args.poitypecol]
-    data[group][kind] = {
-      measure: row[measure] for measure in measures + aux_measures
-    }
+  # index maps: POI type -> column, group -> row
+  (kinds, kind_codes) = np.unique(profiles.columns[args.poitypecol], return_inverse=True)
+  kinds = kinds.tolist()
+  kind_index = dict([(kind, idx) for (idx, kind) in enumerate(kinds)])
+  group_index = profiles.index
+
+  # dict: measure -> group x poi-type matrix of values
+  (features, present) = get_feature_matrices(profiles, kind_codes, len(kinds), 
+    measures + aux_measures)
 
   #
   # Filter according to options, if needed
   #
-  group_size = lambda data, group: sum([ poidict['num_users'] for poidict in data[group].values() ])
+
+  # dict: group -> number of users across POI types
+  group_sizes = dict(zip(profiles.keys(), features['num_users'].sum(axis=1).tolist()))
   
   if args.num_groups:
-    groups = top_keys(data, args.num_groups, summarise=group_size)
+    groups = top_keys(group_sizes, args.num_groups, 
+      summarise=lambda data,key: data[key])
   else:
-    groups = data.keys()
+    groups = profiles.keys()
+  group_rows = [group_index[group] for group in groups]
   
   print "Found %d groups: %s" % (len(groups), ", ".join(groups))
   print "Computing POI statistics for measures: %s" % ", ".join(measures)
@@ -120,30 +185,23 @@ if __name__ == "__main__":
   # Most popular POI
   #
   
-  all_kinds = sorted({ 
-      kind for groupdict in data.values() 
-            for kind in groupdict.keys() })
+  all_kinds = kinds
 
   if args.min_poi_edits:
-    # dict: kind -> num countries below minimum edit threshold
-    low_edit_kind = {
-      kind: sum([
-        1 for group in groups if data[group][kind]['num_edits'] < args.min_poi_edits
-      ]) for kind in all_kinds
-    }
-    skip_kinds = [ kind for kind in low_edit_kind.keys() if low_edit_kind[kind] > 0 ]
-    print "Ignoring %d POI types out of %d which fall below minimum edit threshold (%d)" % (len(skip_kinds), len(all_kinds), args.min_poi_edits)
-    all_kinds = [kind for kind in all_kinds if kind not in skip_kinds]
+    # kinds with at least one country below minimum edit threshold
+    is_low_edit_kind = (features['num_edits'][group_rows] < args.min_poi_edits).any(axis=0)
+    print "Ignoring %d POI types out of %d which fall below minimum edit threshold (%d)" % (np.count_nonzero(is_low_edit_kind), len(all_kinds), args.min_poi_edits)
+    all_kinds = [kind for (kind, is_low) in zip(all_kinds, is_low_edit_kind) if not is_low]
     print "Number of remaining POI types: %d" % len(all_kinds)
+  all_cols = [kind_index[kind] for kind in all_kinds]
   
   # dict: kind -> sum of user counts across countries
-  all_counts = {
-    kind: sum([ data[group][kind]['num_users'] for group in groups ])
-      for kind in all_kinds
-  }
+  all_counts = dict(zip(all_kinds, 
+    features['num_users'][group_rows][:, all_cols].sum(axis=0).tolist()))
   
   top_kinds = top_keys(all_counts, args.num_top_poi, 
     summarise=lambda data,key: data[key])
+  top_cols = [kind_index[kind] for kind in top_kinds]
 
   top_kinds_scatter = top_keys(all_counts, args.num_top_poi_scatter, 
     summarise=lambda data,key: data[key])
@@ -154,56 +212,35 @@ if __name__ == "__main__":
   # = Feature vectors =
   # ===================
   
-  # dict: group -> measure -> ordered vector of values, one per kind
+  # dict: measure -> matrix with one row per group, one column per kind
   country_features_all = {
-    group: {
-      measure: [
-        data[group][kind][measure] for kind in all_kinds
-      ] for measure in measures
-    } for group in groups
+    measure: features[measure][group_rows][:, all_cols] for measure in measures
   }
 
   country_features_top = {
-    group: {
-      measure: [
-        data[group][kind][measure] for kind in top_kinds
-      ] for measure in measures
-    } for group in groups
+    measure: features[measure][group_rows][:, top_cols] for measure in measures
   }
   
-  # dict: kind -> measure -> ordered vector of values, one per group
-  poi_features = {
-    kind: {
-      measure: [
-        data[group][kind][measure] for group in groups
-      ] for measure in measures
-    } for kind in all_kinds
+  # dict: measure -> matrix with one row per kind, one column per group
+  poi_features_all = { 
+    measure: country_features_all[measure].T for measure in measures
+  }
+  
+  poi_features_top = { 
+    measure: country_features_top[measure].T for measure in measures
   }
   
   # =================
   # = Compute stats =
   # =================
   
-  make_stats = lambda stats_dict: {
-    'delta-%pop': distance.cosine(stats_dict['%pop'], stats_dict['%coll_pop']),
-    'delta-%edits': distance.cosine(stats_dict['%edits'], stats_dict['%coll_edits'])
-  }
-  
   # dict: group -> stat_name -> value
-  country_all_poi_stats = {
-    group: make_stats(country_features_all[group]) for group in groups
-  }
-  country_top_poi_stats = {
-    group: make_stats(country_features_top[group]) for group in groups
-  }
+  country_all_poi_stats = dict(zip(groups, get_distance_stats(country_features_all)))
+  country_top_poi_stats = dict(zip(groups, get_distance_stats(country_features_top)))
   
   # dict: kind -> stat_name -> value
-  all_poi_country_stats = {
-    kind: make_stats(poi_features[kind]) for kind in all_kinds
-  }
-  top_poi_country_stats = {
-    kind: make_stats(poi_features[kind]) for kind in top_kinds
-  }
+  all_poi_country_stats = dict(zip(all_kinds, get_distance_stats(poi_features_all)))
+  top_poi_country_stats = dict(zip(top_kinds, get_distance_stats(poi_features_top)))
 
   # ====================
   # = Reports & charts =
@@ -244,6 +281,12 @@ if __name__ == "__main__":
   features_dir = os.path.join(args.outdir, 'features')
   mkdir_p(features_dir)
   
+  # dict: group -> poi-type -> dict of measures
+  data = {
+    group: get_row_features(features, present, group_index[group], kinds, 
+      measures + aux_measures) for group in groups
+  }
+  
   for group in groups:
 
     # all kinds
@@ -255,9 +298,7 @@ if __name__ == "__main__":
 
     # top kinds
     top_poi_features = {
-      kind: {
-        measure: data[group][kind][measure] for measure in (measures + aux_measures)
-      } for kind in top_kinds
+      kind: data[group][kind] for kind in top_kinds
     }
 
     groupstat_report(top_poi_features, args.poitypecol, measures, 
@@ -271,7 +312,7 @@ if __name__ == "__main__":
   # =================
 
   # dict: group -> rel_scale_multiplier
-  sizemap = { group: group_size(data, group) for group in groups }
+  sizemap = { group: group_sizes[group] for group in groups }
   mean_size = np.mean(sizemap.values())
   sizemap = { group: min(max(0.5, sizemap[group] / mean_size), 5) for group in groups }
 
@@ -291,4 +332,7 @@ if __name__ == "__main__":
     'all', 'coll',
     args.outdir, 'all_vs_coll_scatter',
     sizemap=sizemap)
-  
\ No newline at end of file
+  
+
+if __name__ == "__main__":
+  run(get_parser().parse_args())
@@ -0,0 +1,182 @@
+#
+# Run several paper reports on the same user profile data in one process.
+#
+# The profile data is loaded once. Reports then run in a pool of forked worker
+# processes, which share the parent's data arrays copy-on-write.
+#
+
+from __future__ import division # non-truncating division in Python 2.x
+
+import matplotlib
+matplotlib.use('Agg')
+
+import argparse
+import importlib
+import multiprocessing
+import sys
+import time
+import traceback
+
+from app import *
+from shared import *
+
+# ===========
+# = Reports =
+# ===========
+
+# report name -> function(args) that returns the report's command-line arguments,
+# after the datafile and outdir arguments.
+USER_PROFILE_REPORTS = {
+  'rq1': lambda args: num_groups_args(args),
+  'rq2': lambda args: num_groups_args(args),
+  'rq3': lambda args: num_groups_args(args),
+  'inequality_stats': lambda args: [args.groupcol] + args.measures + num_groups_args(args),
+  'pop_band_variance': lambda args: [args.groupcol] + args.measures + num_groups_args(args),
+  'collab_stats': lambda args: [args.groupcol],
+}
+
+# Reports on the POI type profiles (--poi-datafile).
+POI_PROFILE_REPORTS = {
+  'rq4': lambda args: ['--group-column', args.groupcol, 
+    '--poi-type-column', args.poitypecol] + num_groups_args(args),
+}
+
+DEFAULT_REPORTS = ['rq1', 'rq2', 'rq3', 'inequality_stats', 'pop_band_variance',
+  'collab_stats', 'rq4']
+
+def num_groups_args(args):
+  if args.num_groups:
+    return ['--num-groups', str(args.num_groups)]
+  return []
+
+# ===========
+# = Workers =
+# ===========
+
+# Loaded before the worker pool is created, so forked workers inherit it.
+shared_data = dict()
+
+# Runs a single report against the shared data.
+# Returns a dict with the report name, status, elapsed time, the peak RSS 
+# while the report ran, its growth over the RSS at the start, and the 
+# FIGURE_MEMORY records of the report's figures, labelled "<report>/<figure>".
+def run_report(job):
+  (name, datafile, outdir, report_args) = job
+  start = time.time()
+  num_figures = len(FIGURE_MEMORY)
+  peak = PeakRSS().start()
+  status = 'ok'
+  error = None
+  try:
+    module = importlib.import_module(name)
+    args = module.get_parser().parse_args([datafile, outdir] + report_args)
+    module.run(args, shared_data[datafile])
+  except Exception as e:
+    status = 'failed'
+    error = traceback.format_exc()
+  peak.stop()
+  figures = pop_figure_memory(num_figures)
+  for rec in figures:
+    rec['label'] = "%s/%s" % (name, rec['label'])
+  return {
+    'report': name,
+    'status': status,
+    'error': error,
+    'seconds': time.time() - start,
+    'peak_rss_mb': peak.peak_mb,
+    'rss_growth_mb': peak.growth_mb(),
+    'figures': figures
+  }
+
+# ========
+# = Main =
+# ========
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Run several paper reports on the same user profile data.')
+  parser.add_argument('datafile', help='TSV of user data')
+  parser.add_argument('outdir', help='directory for output files, with one subdirectory per report')
+  parser.add_argument('--reports', help='reports to run. Default: all reports that have input data', dest='reports', nargs='+', action='store', default=None, choices=DEFAULT_REPORTS)
+  parser.add_argument('--poi-datafile', help='TSV of POI type data, for rq4', dest='poi_datafile', action='store', default=None)
+  parser.add_argument('--poi-type-column', help='The column name used for POI type IDs, for rq4', dest='poitypecol', action='store', default='kind')
+  parser.add_argument('--groupcol', help='column name used to group population subsets', dest='groupcol', action='store', default='country')
+  parser.add_argument('--measures', help='column names of population measures, for inequality_stats and pop_band_variance', dest='measures', nargs='+', action='store', default=['num_edits', 'num_coll_edits'])
+  parser.add_argument('--num-groups', help='The number of groups to analyse (ranked by size)', dest='num_groups', action='store', type=int, default=None)
+  parser.add_argument('--workers', help='number of worker processes. Default: number of CPUs', dest='workers', action='store', type=int, default=multiprocessing.cpu_count())
+  args = parser.parse_args()
+
+  reports = args.reports or [name for name in DEFAULT_REPORTS
+    if name in USER_PROFILE_REPORTS or args.poi_datafile]
+
+  #
+  # Load data
+  #
+
+  timings = []
+  start = time.time()
+  peak = PeakRSS().start()
+  shared_data[args.datafile] = load_profiles(args.datafile, args.groupcol)
+  if args.poi_datafile and len(set(reports).intersection(POI_PROFILE_REPORTS.keys())) > 0:
+    shared_data[args.poi_datafile] = load_profiles(args.poi_datafile, args.groupcol,
+      encoding='utf-8')
+  peak.stop()
+  start_rss_mb = peak.rss_mb
+  timings.append({'report': 'load', 'status': 'ok', 'seconds': time.time() - start, 
+    'peak_rss_mb': peak.peak_mb, 'rss_growth_mb': peak.growth_mb()})
+
+  #
+  # Run reports
+  #
+
+  jobs = []
+  for name in reports:
+    if name in USER_PROFILE_REPORTS:
+      jobs.append((name, args.datafile, os.path.join(args.outdir, name),
+        USER_PROFILE_REPORTS[name](args)))
+    elif args.poi_datafile:
+      jobs.append((name, args.poi_datafile, os.path.join(args.outdir, name),
+        POI_PROFILE_REPORTS[name](args)))
+    else:
+      print "Skipping %s: no --poi-datafile" % name
+
+  start = time.time()
+  if args.workers > 1:
+    # one fresh worker per report, so that workers don't carry over the 
+    # memory of earlier reports
+    pool = multiprocessing.Pool(min(args.workers, len(jobs)), maxtasksperchild=1)
+    results = pool.map(run_report, jobs, chunksize=1)
+    pool.close()
+    pool.join()
+  else:
+    results = [run_report(job) for job in jobs]
+  total = time.time() - start
+
+  for result in results:
+    FIGURE_MEMORY.extend(result['figures'])
+    if result['error']:
+      print "Error in %s:" % result['report']
+      print result['error']
+  timings += results
+  # the largest peak of the parent and any worker, over the RSS before loading
+  peak_rss_mb = max([rec['peak_rss_mb'] for rec in timings])
+  timings.append({'report': 'total', 'status': 'ok', 'seconds': total,
+    'peak_rss_mb': peak_rss_mb, 'rss_growth_mb': peak_rss_mb - start_rss_mb})
+
+  #
+  # Timing summary
+  #
+
+  print
+  print "%-20s %-8s %10s %12s %14s" % ('stage', 'status', 'seconds', 'peak RSS MB', 
+    'RSS growth MB')
+  for rec in timings:
+    print "%-20s %-8s %10.1f %12.0f %14.0f" % (rec['report'], rec['status'],
+      rec['seconds'], rec['peak_rss_mb'], rec['rss_growth_mb'])
+
+  mkdir_p(args.outdir)
+  groupstat_report(dict([(rec['report'], rec) for rec in timings]), 'stage',
+    ['status', 'seconds', 'peak_rss_mb', 'rss_growth_mb'], args.outdir, 'report_timings')
+  write_figure_memory(args.outdir)
+
+  if len([rec for rec in results if rec['status']!='ok']) > 0:
+    sys.exit(1)
@@ -24,6 +24,79 @@ def get_unknown_countries(session, iso2_codes):
     WHERE w.iso2 IN ('%s')""" % ("', '".join(iso2_codes)))
   found = set([rec['iso2'] for rec in result])
   return [iso2 for iso2 in iso2_codes if iso2 not in found]
+
+# Computes per-country bulk import thresholds and filter stats in the DB, and
+# streams the user records to the unfiltered and filtered profile reports.
+# Thresholds are interpolated percentiles of num_edits (like np.percentile),
+# rounded to the nearest integer.
+#
+# percentile: percentile threshold, range [0..100]
+# select_filter: SQL filter expression, as in the main query
+# Returns a dict: iso2 -> dict of threshold and pre/post filter totals.
+def stream_bulk_filter(session, stats_table, user_fields, select_filter, 
+  percentile, outdir):
+
+  query = """WITH users AS (
+    SELECT w.iso2, w.name, %s
+    FROM %s ue
+    JOIN world_borders w ON (ue.country_gid=w.gid)
+    WHERE TRUE %s
+  ), thresholds AS (
+    SELECT iso2, 
+      round((percentile_cont(%r) WITHIN GROUP (ORDER BY num_edits))::numeric) AS threshold
+    FROM users
+    GROUP BY iso2
+  ), flagged AS (
+    SELECT u.*, t.threshold, (u.num_edits < t.threshold) AS is_kept
+    FROM users u JOIN thresholds t ON (u.iso2=t.iso2)
+  )
+  SELECT %s, iso2, threshold, is_kept,
+    count(*) OVER c AS num_users_pre,
+    sum(CASE WHEN is_kept THEN 1 ELSE 0 END) OVER c AS num_users_post,
+    (sum(num_edits) OVER c)::bigint AS num_edits_pre,
+    (sum(CASE WHEN is_kept THEN num_edits ELSE 0 END) OVER c)::bigint AS num_edits_post,
+    (sum(num_coll_edits) OVER c)::bigint AS num_coll_edits_pre,
+    (sum(CASE WHEN is_kept THEN num_coll_edits ELSE 0 END) OVER c)::bigint AS num_coll_edits_post
+  FROM flagged
+  WINDOW c AS (PARTITION BY iso2)
+  ORDER BY iso2 COLLATE "C", name, uid""" % (
+    ", ".join(user_fields), stats_table, select_filter, 
+    percentile / 100.0, ", ".join(user_fields))
+
+  result = session.connection().execution_options(stream_results=True).execute(query)
+
+  unfiltered_file = open("%s/%s.txt" % (outdir, "user_profiles_unfiltered"), 'wb')
+  unfiltered_csv = csv.writer(unfiltered_file, dialect='excel-tab')
+  filtered_file = open("%s/%s.txt" % (outdir, "user_profiles"), 'wb')
+  filtered_csv = csv.writer(filtered_file, dialect='excel-tab')
+  for outcsv in [unfiltered_csv, filtered_csv]:
+    outcsv.writerow(encode(['country'] + user_fields))
+
+  # iso2 -> metric -> value
+  filter_stats = dict()
+  num_records = 0
+  for row in result:
+    iso2 = row['iso2']
+    if iso2 not in filter_stats:
+      filter_stats[iso2] = {
+        'threshold': float(row['threshold']),
+        'num_users_pre': int(row['num_users_pre']),
+        'num_users_post': int(row['num_users_post']),
+        'num_edits_pre': int(row['num_edits_pre']),
+        'num_edits_post': int(row['num_edits_post']),
+        'num_coll_edits_pre': int(row['num_coll_edits_pre']),
+        'num_coll_edits_post': int(row['num_coll_edits_post'])
+      }
+    record = encode([iso2] + [row[field] for field in user_fields])
+    unfiltered_csv.writerow(record)
+    if row['is_kept']:
+      filtered_csv.writerow(record)
+    num_records += 1
+  print "Loaded %d records." % (num_records)
+
+  unfiltered_file.close()
+  filtered_file.close()
+  return filter_stats
  
 # ========
 # = Main =
@@ -36,6 +109,7 @@ if __name__ == "__main__":
   parser.add_argument('--min-edits', help='minimum number of edits per user and region', dest='min_edits', action='store', type=int, default=None)
   parser.add_argument('--max-edits', help='maximum number of edits per user and region', dest='max_edits', action='store', type=int, default=None)
   parser.add_argument('--bulk-percentile', help='percentile threshold for bulk import users, range [0..100]', dest='bulk_percentile', type=float, action='store', default=None)
+  parser.add_argument('--sql-percentile', help='compute bulk import thresholds and filter stats in the DB, and stream user records to the reports', dest='sql_percentile', action='store_true', default=False)
   parser.add_argument('--stats-table', help='table name with user edit stats', dest='stats_table', action='store', default='user_edit_stats')
   args = parser.parse_args()
 
@@ -69,93 +143,99 @@ if __name__ == "__main__":
   if args.max_edits:
     select_filter += " AND ue.num_edits<%d " % (args.max_edits)
   
-  session = getSession()
-  result = session.execute("""SELECT w.iso2, %s
-  FROM %s ue
-  JOIN world_borders w ON (ue.country_gid=w.gid)
-  WHERE TRUE %s
-  ORDER BY w.name, uid""" % (", ".join(user_fields), args.stats_table, select_filter))
-  
-  # dict: iso2 -> list of user records
-  raw_data = defaultdict(list)
-  num_records = 0
-  for row in result:
-    record = dict()
-    for field in user_fields:
-      record[field] = row[field]
-    raw_data[row['iso2']].append(record)
-    num_records += 1
-  print "Loaded %d records." % (num_records)
-  
-  
-  #
-  # No filter? Store and exit
-  #
-  
   mkdir_p(args.outdir)
 
-  if args.bulk_percentile==None:
-    profiledata_report(raw_data, 'country', user_fields, args.outdir, "user_profiles")
-    sys.exit(0)
-  
-  #
-  # Filter bulk imports
-  #
-  
-  # dict: iso2 -> list of user records
-  data = defaultdict(list)
-  bulk_thresholds = defaultdict(None)
+  if args.bulk_percentile!=None and args.sql_percentile:
 
-  print "Filtering bulk imports based on percentile threshold: %.4f" % args.bulk_percentile
-  for iso2 in raw_data.keys():
-    all_num_edits = [r['num_edits'] for r in raw_data[iso2]]
-    bulk_thresholds[iso2] = round(np.percentile(sorted(all_num_edits), args.bulk_percentile))
-    data[iso2] = [r for r in raw_data[iso2] if r['num_edits'] < bulk_thresholds[iso2]]
+    #
+    # Filter bulk imports in the DB, stream records to the reports
+    #
 
-  for iso2 in sorted(data.keys()):
+    print "Filtering bulk imports based on percentile threshold: %.4f" % args.bulk_percentile
+    filter_stats = stream_bulk_filter(session, args.stats_table, user_fields, 
+      select_filter, args.bulk_percentile, args.outdir)
+  
+  else:
+
+    session = getSession()
+    result = session.execute("""SELECT w.iso2, %s
+    FROM %s ue
+    JOIN world_borders w ON (ue.country_gid=w.gid)
+    WHERE TRUE %s
+    ORDER BY w.name, uid""" % (", ".join(user_fields), args.stats_table, select_filter))
+    
+    # dict: iso2 -> list of user records
+    raw_data = defaultdict(list)
+    num_records = 0
+    for row in result:
+      record = dict()
+      for field in user_fields:
+        record[field] = row[field]
+      raw_data[row['iso2']].append(record)
+      num_records += 1
+    print "Loaded %d records." % (num_records)
+    
+    #
+    # No filter? Store and exit
+    #
+    
+    if args.bulk_percentile==None:
+      profiledata_report(raw_data, 'country', user_fields, args.outdir, "user_profiles")
+      sys.exit(0)
+    
+    #
+    # Filter bulk imports
+    #
+    
+    # dict: iso2 -> list of user records
+    data = defaultdict(list)
+    bulk_thresholds = defaultdict(None)
+
+    print "Filtering bulk imports based on percentile threshold: %.4f" % args.bulk_percentile
+    for iso2 in raw_data.keys():
+      all_num_edits = [r['num_edits'] for r in raw_data[iso2]]
+      bulk_thresholds[iso2] = round(np.percentile(sorted(all_num_edits), args.bulk_percentile))
+      data[iso2] = [r for r in raw_data[iso2] if r['num_edits'] < bulk_thresholds[iso2]]
+
+    # iso2 -> metric -> value
+    filter_stats = defaultdict(dict)
+
+    for iso2 in data.keys():
+      rec = dict()
+      rec['threshold'] = bulk_thresholds[iso2]
+      rec['num_users_pre'] = len(raw_data[iso2])
+      rec['num_users_post'] = len(data[iso2])
+      rec['num_edits_pre'] = sum([d['num_edits'] for d in raw_data[iso2]])
+      rec['num_edits_post'] = sum([d['num_edits'] for d in data[iso2]])
+      rec['num_coll_edits_pre'] = sum([d['num_coll_edits'] for d in raw_data[iso2]])
+      rec['num_coll_edits_post'] = sum([d['num_coll_edits'] for d in data[iso2]])
+      filter_stats[iso2] = rec
+
+    profiledata_report(raw_data, 'country', user_fields, args.outdir, "user_profiles_unfiltered")
+    profiledata_report(data, 'country', user_fields, args.outdir, "user_profiles")
+
+  for iso2 in sorted(filter_stats.keys()):
     print "%s: %d raw, %d filtered (max %d edits)" % (
-      iso2, len(raw_data[iso2]), len(data[iso2]), bulk_thresholds[iso2])
+      iso2, filter_stats[iso2]['num_users_pre'], 
+      filter_stats[iso2]['num_users_post'], filter_stats[iso2]['threshold'])
 
   #
   # Filter stats: impact of bulk import filter
   #
   
-  # iso2 -> metric -> value
-  filter_stats = defaultdict(dict)
-
-  for iso2 in data.keys():
-    rec = dict()
-
-    rec['threshold'] = bulk_thresholds[iso2]
-
-    rec['num_users_pre'] = len(raw_data[iso2])
-    rec['num_users_post'] = len(data[iso2])
+  for iso2 in filter_stats.keys():
+    rec = filter_stats[iso2]
     rec['p_users_removed'] = Decimal(1.0) - \
       Decimal(rec['num_users_post']) / rec['num_users_pre']
-
-    raw_edits = [d['num_edits'] for d in raw_data[iso2]]
-    edits = [d['num_edits'] for d in data[iso2]]
-    rec['num_edits_pre'] = sum(raw_edits)
-    rec['num_edits_post'] = sum(edits)
     rec['p_edits_removed'] = Decimal(1.0) - \
       Decimal(rec['num_edits_post']) / rec['num_edits_pre']
-
-    raw_coll_edits = [d['num_coll_edits'] for d in raw_data[iso2]]
-    coll_edits = [d['num_coll_edits'] for d in data[iso2]]
-    rec['num_coll_edits_pre'] = sum(raw_coll_edits)
-    rec['num_coll_edits_post'] = sum(coll_edits)
     rec['p_coll_edits_removed'] = Decimal(1.0) - \
       Decimal(rec['num_coll_edits_post']) / rec['num_coll_edits_pre']
-    
-    filter_stats[iso2] = rec
   
   #
-  # Basic user report, impact of bulk import filter
+  # Report: impact of bulk import filter
   #
   
-  profiledata_report(raw_data, 'country', user_fields, args.outdir, "user_profiles_unfiltered")
-  profiledata_report(data, 'country', user_fields, args.outdir, "user_profiles")
-
   groupstat_report(filter_stats, 'country', 
     ['threshold', 
       'num_users_pre', 'num_users_post', 'p_users_removed',
@@ -164,7 +244,8 @@ if __name__ == "__main__":
     args.outdir, 'bulkimport_filter_stats')
   
   # Countries are ranked by number of users, descending
-  iso2s = sorted(data.keys(), key=lambda iso2: len(data[iso2]), reverse=True)
+  iso2s = sorted(filter_stats.keys(), 
+    key=lambda iso2: filter_stats[iso2]['num_users_post'], reverse=True)
   
   group_share_plot(filter_stats, iso2s, 
     ['p_users_removed', 'p_edits_removed', 'p_coll_edits_removed'], 
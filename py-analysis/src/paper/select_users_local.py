@@ -0,0 +1,82 @@
+#
+# Produce the user_profiles report of select_users.py from TSV partitions,
+# without a Postgres DB. Uses the in-process backend in app.localdb.
+#
+
+from __future__ import division # non-truncating division in Python 2.x
+
+import argparse
+from collections import defaultdict
+import sys
+
+import numpy as np
+
+from app import *
+from shared import *
+
+# ========
+# = Main =
+# ========
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Produce user profiles from TSV partitions, without a Postgres DB.')
+  parser.add_argument('datadir', help='TSV data directory with poi, poi_tag_edit_action, [shared_poi] partitions')
+  parser.add_argument('regions', help='regions file with bounding boxes, as in etl/data/regions')
+  parser.add_argument('outdir', help='directory for output files')
+  parser.add_argument('--iso2-codes', help='list of region names', dest='iso2_codes', nargs='+', action='store', type=str, default=None)
+  parser.add_argument('--min-edits', help='minimum number of edits per user and region', dest='min_edits', action='store', type=int, default=None)
+  parser.add_argument('--max-edits', help='maximum number of edits per user and region', dest='max_edits', action='store', type=int, default=None)
+  parser.add_argument('--no-cache', help='do not store parsed partitions as memory-mapped columns', dest='use_cache', action='store_false', default=True)
+  args = parser.parse_args()
+
+  #
+  # Get data
+  #
+
+  user_fields = ['uid', 'num_poi',
+    'num_edits',  'num_tag_add', 'num_tag_update', 'num_tag_remove',
+    'num_coll_edits',  'num_coll_tag_add', 'num_coll_tag_update', 'num_coll_tag_remove',
+    'p_coll_edit', 'p_coll_tag_add', 'p_coll_tag_update', 'p_coll_tag_remove',
+    'num_tag_keys', 'days_active', 'activity_period_days']
+
+  db = build_local_db(args.datadir, args.regions, use_cache=args.use_cache)
+  ues = db['user_edit_stats']
+  world_borders = db['world_borders']
+
+  # gid -> iso2
+  iso2_by_gid = dict(zip(world_borders['gid'], world_borders['iso2']))
+
+  # filters
+  mask = np.ones(len(ues['uid']), dtype=bool)
+
+  if args.iso2_codes and len(args.iso2_codes)>0:
+    print "Limiting to countries: " + ", ".join(args.iso2_codes)
+    missing = [iso2 for iso2 in args.iso2_codes if iso2 not in world_borders['iso2']]
+    if len(missing) > 0:
+      print "Could not recognise all country codes. Unknown: %s" % (', '.join(missing))
+      sys.exit(1)
+    gids = [gid for gid in iso2_by_gid.keys() if iso2_by_gid[gid] in args.iso2_codes]
+    mask &= np.in1d(ues['country_gid'], gids)
+
+  if args.min_edits:
+    mask &= ues['num_edits']>=args.min_edits
+  if args.max_edits:
+    mask &= ues['num_edits']<args.max_edits
+
+  # dict: iso2 -> list of user records, ordered by uid
+  raw_data = defaultdict(list)
+  rows = np.flatnonzero(mask)
+  rows = rows[np.lexsort((ues['uid'][rows], ues['country_gid'][rows]))]
+  columns = [ues[field][rows].tolist() for field in user_fields]
+  gids = ues['country_gid'][rows].tolist()
+  for idx in range(len(rows)):
+    raw_data[iso2_by_gid[gids[idx]]].append(
+      dict(zip(user_fields, [col[idx] for col in columns])))
+  print "Loaded %d records." % (len(rows))
+
+  #
+  # Store
+  #
+
+  mkdir_p(args.outdir)
+  profiledata_report(raw_data, 'country', user_fields, args.outdir, "user_profiles")
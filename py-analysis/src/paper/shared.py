@@ -1,8 +1,8 @@
 # Some functions shared by several scripts.
 
 from decimal import Decimal
-import gc
 import math
+import time
 
 import matplotlib.pyplot as plt
 from matplotlib import ticker
@@ -10,6 +10,83 @@ import numpy as np
 
 from app import *
 
+# ================
+# = Data loading =
+# ================
+
+# Member profiles that are segmented into groups, stored by column.
+# Rows are ordered by group (and in file order within each group), so the
+# members of a group are a contiguous slice of every column.
+#
+# groups: sorted list of group names
+# offsets: numpy array of len(groups)+1 row offsets
+# codes: numpy array of group indices, one per row
+# columns: dict of column name -> numpy array
+class GroupedProfiles(object):
+  def __init__(self, groupcol, groups, offsets, codes, columns):
+    self.groupcol = groupcol
+    self.groups = groups
+    self.offsets = offsets
+    self.codes = codes
+    self.columns = columns
+    self.index = dict([(group, idx) for (idx, group) in enumerate(groups)])
+
+  def __len__(self):
+    return len(self.codes)
+
+  def keys(self):
+    return list(self.groups)
+
+  def measures(self):
+    return self.columns.keys()
+
+  # Returns a dict: group -> number of members
+  def sizes(self):
+    return dict(zip(self.groups, np.diff(self.offsets).tolist()))
+
+  def size(self, group):
+    idx = self.index[group]
+    return int(self.offsets[idx+1] - self.offsets[idx])
+
+  # Returns a numpy array of the group's values for a measure (a view, not a copy).
+  def values(self, group, measure):
+    idx = self.index[group]
+    return self.columns[measure][self.offsets[idx]:self.offsets[idx+1]]
+
+  # Returns a list of the group's values for a measure, as Python scalars.
+  def value_list(self, group, measure, mask=None):
+    values = self.values(group, measure)
+    if mask is not None:
+      values = values[mask]
+    return values.tolist()
+
+# Loads a TSV file of member profiles, e.g. a user_profiles report.
+# groupcol: the column with group names
+# measures: the columns to load, or None for all
+# kwargs is passed on to read_tsv(...).
+# Returns a GroupedProfiles instance.
+def load_profiles(filename, groupcol, measures=None, **kwargs):
+  start = time.time()
+  usecols = None
+  if measures!=None:
+    usecols = [groupcol] + [m for m in measures if m!=groupcol]
+  df = read_tsv(filename, usecols=usecols, **kwargs)
+
+  (groups, codes) = np.unique(df[groupcol].values, return_inverse=True)
+  order = np.argsort(codes, kind='mergesort') # stable: keeps file order within groups
+  codes = codes[order]
+  offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(groups)))])
+
+  columns = dict()
+  for measure in df.columns:
+    if measure!=groupcol:
+      columns[measure] = df[measure].values[order]
+
+  profiles = GroupedProfiles(groupcol, groups.tolist(), offsets, codes, columns)
+  print "Loaded %d records in %d groups (%.1fs, peak RSS %.0f MB)" % (
+    len(profiles), len(groups), time.time() - start, get_peak_rss_mb())
+  return profiles
+
 # =============
 # = Filtering =
 # =============
@@ -73,34 +150,31 @@ def groupstat_report(data, groupcolname, statcolnames, outdir, filename_base):
 # groups: the list of groups to plot, in order (top to bottom)
 # measures: the metrics to plot, in order (left to right)
 # xgroups: a nested list of measures that share the same horizontal scale.
+# rasterized: render cells as bitmaps in PDF output, for very large matrices
 # kwargs is passed on to plt.barh(...).
 def groupstat_plot(data, groups, measures, outdir, filename_base, 
-  xgroups=None, colors=QUALITATIVE_MEDIUM, **kwargs):
-
-  for (measure, group, ax1) in plot_matrix(measures, groups, cellwidth=4, 
-    cellheight=0.5, shared_xscale=True, xgroups=xgroups,
-    hspace=0.05, wspace=0.05):
-
-    if data[group][measure]==None or math.isnan(data[group][measure]):
-      ax1.set_axis_bgcolor('#eeeeee')
-      plt.setp(ax1.spines.values(), color='none')
-    else:
-      value = data[group][measure]
-      ax1.barh(0, value, 1, left=0, 
-        color=colors[0], edgecolor='none',
-        **kwargs)
-      ax1.set_frame_on(False)
-
-    ax1.margins(0.05, 0.05)
-    ax1.get_xaxis().set_ticks([])
-    ax1.get_yaxis().set_ticks([])
-  
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+  xgroups=None, colors=QUALITATIVE_MEDIUM, rasterized=False, **kwargs):
+
+  with FigureSession(filename_base):
+    for (measure, group, ax1) in plot_matrix(measures, groups, cellwidth=4, 
+      cellheight=0.5, shared_xscale=True, xgroups=xgroups,
+      hspace=0.05, wspace=0.05, rasterized=rasterized):
 
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+      if data[group][measure]==None or math.isnan(data[group][measure]):
+        ax1.set_facecolor('#eeeeee')
+        plt.setp(ax1.spines.values(), color='none')
+      else:
+        value = data[group][measure]
+        ax1.barh(0, value, 1, left=0, 
+          color=colors[0], edgecolor='none',
+          **kwargs)
+        ax1.set_frame_on(False)
+
+      ax1.margins(0.05, 0.05)
+      ax1.get_xaxis().set_ticks([])
+      ax1.get_yaxis().set_ticks([])
+  
+    save_figure(outdir, filename_base)
 
 
 # TODO: deprecate this, in favour of groupstat_plot
@@ -110,49 +184,51 @@ def groupstat_plot(data, groups, measures, outdir, filename_base,
 def group_share_plot(data, iso2s, measures, outdir, filename_base, 
   colors=QUALITATIVE_MEDIUM, scale=100, **kwargs):
 
-  for (measure, iso2, ax1) in plot_matrix(measures, iso2s, cellwidth=4, cellheight=0.5):
-    if data[iso2][measure] != None:
-      colgen = looping_generator(colors)
-      value = data[iso2][measure] * scale
-      ax1.barh(0, value, 1, left=0, color=next(colgen), **kwargs)
-      ax1.barh(0, scale-value, 1, left=value, color=next(colgen), **kwargs)
-
-    ax1.margins(0, 0)
-    # ax1.get_xaxis().set_major_formatter(ticker.FuncFormatter(to_even_percent))
-    ax1.get_xaxis().set_ticks([])
-    ax1.get_yaxis().set_ticks([])
+  with FigureSession(filename_base):
+    for (measure, iso2, ax1) in plot_matrix(measures, iso2s, cellwidth=4, cellheight=0.5):
+      if data[iso2][measure] != None:
+        colgen = looping_generator(colors)
+        value = data[iso2][measure] * scale
+        ax1.barh(0, value, 1, left=0, color=next(colgen), **kwargs)
+        ax1.barh(0, scale-value, 1, left=value, color=next(colgen), **kwargs)
+
+      ax1.margins(0, 0)
+      # ax1.get_xaxis().set_major_formatter(ticker.FuncFormatter(to_even_percent))
+      ax1.get_xaxis().set_ticks([])
+      ax1.get_yaxis().set_ticks([])
     
-    ax1.patch.set_visible(False)
+      ax1.patch.set_visible(False)
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
-# data: row -> column -> list of values
-# kwargs is passed on to plt.boxplot(...).
+# data: row -> column -> list of values, or a dict of box plot statistics
+#   (see app.plotting.boxplot_stats)
+# kwargs is passed on to draw_boxplots(...).
 def boxplot_matrix(data, rows, columns, outdir, filename_base, min_values=5,
    shared_yscale=True, show_minmax=True, **kwargs):
 
-  for (column, row, ax1) in plot_matrix(columns, rows, shared_yscale=shared_yscale):
-    values = data[row][column]
-    if len(values) < min_values:
-      ax1.set_axis_bgcolor('#eeeeee')
-      plt.setp(ax1.spines.values(), color='none')
-    else:
-      ax1.boxplot(values, **kwargs)
+  with FigureSession(filename_base):
+    for (column, row, ax1) in plot_matrix(columns, rows, shared_yscale=shared_yscale):
+      values = data[row][column]
+      num_values = values['count'] if isinstance(values, dict) else len(values)
+      if num_values < min_values:
+        ax1.set_facecolor('#eeeeee')
+        plt.setp(ax1.spines.values(), color='none')
+      else:
+        (stats, artists) = draw_boxplots(ax1, [values], **kwargs)
       
-      if show_minmax:
-        w = 0.1
-        plt.plot([-w, w], [min(values)]*2, 'k-')
-        plt.plot([-w, w], [max(values)]*2, 'k-')
-
-    ax1.margins(0.1, 0.1)
-    ax1.get_xaxis().set_visible(False)
-    # ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
-    ax1.tick_params(axis='y', which='major', labelsize='x-small')
-    ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
+        if show_minmax:
+          w = 0.1
+          plt.plot([-w, w], [stats[0]['min']]*2, 'k-')
+          plt.plot([-w, w], [stats[0]['max']]*2, 'k-')
+
+      ax1.margins(0.1, 0.1)
+      ax1.get_xaxis().set_visible(False)
+      # ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
+      ax1.tick_params(axis='y', which='major', labelsize='x-small')
+      ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # data_cols: group -> metric -> value
 # data_rows: group -> metric -> value
@@ -171,29 +247,25 @@ def scatter_matrix(data_rows, data_cols, groups, row_measures, col_measures,
   outdir, filename_base,  scale='linear', colors=QUALITATIVE_MEDIUM, size=20, 
   sizemap=None, **kwargs):
   
-  for (col, row, ax1) in plot_matrix(col_measures, row_measures):
-    x = [data_cols[group][col] for group in groups]
-    y = [data_rows[group][row] for group in groups]
+  with FigureSession(filename_base):
+    for (col, row, ax1) in plot_matrix(col_measures, row_measures):
+      x = [data_cols[group][col] for group in groups]
+      y = [data_rows[group][row] for group in groups]
 
-    s = size
-    if sizemap!=None:
-      s = [sizemap[group] * size for group in groups]
+      s = size
+      if sizemap!=None:
+        s = [sizemap[group] * size for group in groups]
 
-    ax1.scatter(x, y, s=s, edgecolors='none', color=colors[0], **kwargs)
+      ax1.scatter(x, y, s=s, edgecolors='none', color=colors[0], **kwargs)
 
-    # # Workaround: won't autoscale for very small values
-    # ax1.set_xlim(min(x), max(x))
-    # ax1.set_ylim(min(y), max(y))
+      # # Workaround: won't autoscale for very small values
+      # ax1.set_xlim(min(x), max(x))
+      # ax1.set_ylim(min(y), max(y))
 
-    ax1.margins(0.2, 0.2)
-    ax1.set_xscale(scale)
-    ax1.set_yscale(scale)
-    ax1.get_xaxis().set_ticks([])
-    ax1.get_yaxis().set_ticks([])
+      ax1.margins(0.2, 0.2)
+      ax1.set_xscale(scale)
+      ax1.set_yscale(scale)
+      ax1.get_xaxis().set_ticks([])
+      ax1.get_yaxis().set_ticks([])
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
-
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    save_figure(outdir, filename_base)
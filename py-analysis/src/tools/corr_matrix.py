@@ -10,7 +10,6 @@ matplotlib.use('Agg')
 import argparse
 from collections import defaultdict
 import decimal
-import gc
 import sys
 
 import matplotlib.cm as cm
@@ -46,41 +45,41 @@ def report(data, key1name, key2name, colnames, outdir, filename_base):
 def corrmatrix(metrics1, metrics2, corr, measure, outdir, filename_base, 
   cmap=cm.gray, norm=None, **kwargs):
 
-  ncols = len(metrics1)
-  nrows = len(metrics2)
+  with FigureSession(filename_base):
+    ncols = len(metrics1)
+    nrows = len(metrics2)
 
-  fig = plt.figure(figsize=(1*ncols, 0.75*nrows))
-  plt.subplots_adjust(hspace=0, wspace=0)
-  fig.patch.set_facecolor('white')
+    fig = plt.figure(figsize=(1*ncols, 0.75*nrows))
+    plt.subplots_adjust(hspace=0, wspace=0)
+    fig.patch.set_facecolor('white')
 
-  for a in range(len(metrics1)):
-    for b in range(len(metrics2)):
+    for a in range(len(metrics1)):
+      for b in range(len(metrics2)):
 
-      scores = corr[metrics1[a]][metrics2[b]]
-      if len(scores) > 0:
-        val = scores[measure]
+        scores = corr[metrics1[a]][metrics2[b]]
+        if len(scores) > 0:
+          val = scores[measure]
 
-        # Plot
-        n = a + len(metrics1) * b + 1
-        ax1 = plt.subplot(nrows, ncols, n)
+          # Plot
+          n = a + len(metrics1) * b + 1
+          ax1 = plt.subplot(nrows, ncols, n)
       
-        if b == len(metrics2)-1: # last row
-          plt.xlabel(metrics1[a], rotation=90)
+          if b == len(metrics2)-1: # last row
+            plt.xlabel(metrics1[a], rotation=90)
 
-        if (a == 0): # first column
-          plt.ylabel(metrics2[b], rotation=0)
+          if (a == 0): # first column
+            plt.ylabel(metrics2[b], rotation=0)
       
-        if norm:
-          color=cmap(norm(val))
-        else:
-          color=cmap(val)
-        ax1.bar(0, 1, 1, 0, color=color, **kwargs)
-
-        ax1.get_xaxis().set_ticks([])
-        ax1.get_yaxis().set_ticks([])
+          if norm:
+            color=cmap(norm(val))
+          else:
+            color=cmap(val)
+          ax1.bar(0, 1, 1, 0, color=color, **kwargs)
+
+          ax1.get_xaxis().set_ticks([])
+          ax1.get_yaxis().set_ticks([])
   
-  plt.savefig("%s/%s.pdf" % (args.outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (args.outdir, filename_base), bbox_inches='tight')
+    save_figure(args.outdir, filename_base)
 
 # ========
 # = Main =
@@ -100,9 +99,9 @@ if __name__ == "__main__":
   #
   
   # data_a = pd.DataFrame.from_csv(args.tsv_a, sep='\t')
-  data_a = pd.read_table(args.tsv_a, index_col=0)
+  data_a = read_tsv(args.tsv_a, index_col=0)
   if args.tsv_b:
-    data_b = pd.read_table(args.tsv_b, index_col=0)
+    data_b = read_tsv(args.tsv_b, index_col=0)
     self_corr = False
   else:
     data_b = data_a
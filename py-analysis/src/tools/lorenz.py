@@ -27,15 +27,15 @@ from app import *
 def lorenz_plot(data, groups, measures, steps, outdir, filename_base, 
   colors=QUALITATIVE_MEDIUM, **kwargs):
   
-  for (measure, group, ax1) in plot_matrix(measures, groups, cellwidth=4, cellheight=4):
-    colgen = looping_generator(colors)
-    y = [ranked_percentile_share(data[group][measure], perc) for perc in steps]
-    ax1.fill(steps, y, color=colgen.next(), **kwargs)
+  with FigureSession(filename_base):
+    for (measure, group, ax1) in plot_matrix(measures, groups, cellwidth=4, cellheight=4):
+      colgen = looping_generator(colors)
+      y = [ranked_percentile_share(data[group][measure], perc) for perc in steps]
+      ax1.fill(steps, y, color=colgen.next(), **kwargs)
 
-    ax1.margins(0.1, 0.1)
+      ax1.margins(0.1, 0.1)
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # data: group -> measure -> list of values
 # steps: the percentages for which cumulative "income" is computed
@@ -45,22 +45,22 @@ def lorenz_plot(data, groups, measures, steps, outdir, filename_base,
 def combined_lorenz_plot(data, groups, measure, steps, outdir, filename_base, 
   colors=QUALITATIVE_MEDIUM, alpha=0.4, with_gini=False, **kwargs):
   
-  fig = plt.figure(figsize=(4, 4))
-  fig.patch.set_facecolor('white')
-  plt.margins(0.1, 0.1)
+  with FigureSession(filename_base):
+    fig = plt.figure(figsize=(4, 4))
+    fig.patch.set_facecolor('white')
+    plt.margins(0.1, 0.1)
   
-  colgen = looping_generator(colors)
-  color = colgen.next()
+    colgen = looping_generator(colors)
+    color = colgen.next()
   
-  for group in groups:
-    y = [ranked_percentile_share(data[group][measure], perc) for perc in steps]
-    if with_gini:
-      g = gini(data[group][measure])
-      color = "%.3f" % (1 - g**5)
-    plt.plot(steps, y, color=color, alpha=alpha, **kwargs)
+    for group in groups:
+      y = [ranked_percentile_share(data[group][measure], perc) for perc in steps]
+      if with_gini:
+        g = gini(data[group][measure])
+        color = "%.3f" % (1 - g**5)
+      plt.plot(steps, y, color=color, alpha=alpha, **kwargs)
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # ========
 # = Main =
@@ -80,7 +80,7 @@ if __name__ == "__main__":
   # Get data
   #
   
-  df = pd.read_csv(args.tsvfile, sep="\t")
+  df = read_tsv(args.tsvfile)
   groupcol = args.groupcol or df.columns.tolist()[0]
   measures = sorted(args.measures) or sorted(df.columns.tolist())
   if groupcol in measures:
@@ -10,7 +10,6 @@ matplotlib.use('Agg')
 import argparse
 from collections import defaultdict
 import decimal
-import gc
 import sys
 
 import matplotlib.cm as cm
@@ -42,32 +41,28 @@ def scatter_grid(data_cols, data_rows, groups, col_measures, row_measures,
   outdir, filename_base,  scale='linear', colors=QUALITATIVE_MEDIUM, size=20, 
   sizemap=None, **kwargs):
   
-  for (col, row, ax1) in plot_matrix(col_measures, row_measures):
-    x = [data_cols[group][col] for group in groups]
-    y = [data_rows[group][row] for group in groups]
-
-    s = size
-    if sizemap!=None:
-      s = [sizemap[group] * size for group in groups]
-
-    ax1.scatter(x, y, s=s, edgecolors='none', color=colors[0], **kwargs)
-
-    # # Workaround: won't autoscale for very small values
-    # ax1.set_xlim(min(x), max(x))
-    # ax1.set_ylim(min(y), max(y))
-
-    ax1.margins(0.2, 0.2)
-    ax1.set_xscale(scale)
-    ax1.set_yscale(scale)
-    ax1.get_xaxis().set_ticks([])
-    ax1.get_yaxis().set_ticks([])
+  with FigureSession(filename_base):
+    for (col, row, ax1) in plot_matrix(col_measures, row_measures):
+      x = [data_cols[group][col] for group in groups]
+      y = [data_rows[group][row] for group in groups]
+
+      s = size
+      if sizemap!=None:
+        s = [sizemap[group] * size for group in groups]
+
+      ax1.scatter(x, y, s=s, edgecolors='none', color=colors[0], **kwargs)
+
+      # # Workaround: won't autoscale for very small values
+      # ax1.set_xlim(min(x), max(x))
+      # ax1.set_ylim(min(y), max(y))
+
+      ax1.margins(0.2, 0.2)
+      ax1.set_xscale(scale)
+      ax1.set_yscale(scale)
+      ax1.get_xaxis().set_ticks([])
+      ax1.get_yaxis().set_ticks([])
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
-
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    save_figure(outdir, filename_base)
 
 # ========
 # = Main =
@@ -89,9 +84,9 @@ if __name__ == "__main__":
   #
   
   # data_a = pd.DataFrame.from_csv(args.tsv_a, sep='\t')
-  data_a = pd.read_table(args.tsv_a, index_col=0)
+  data_a = read_tsv(args.tsv_a, index_col=0)
   if args.tsv_b:
-    data_b = pd.read_table(args.tsv_b, index_col=0)
+    data_b = read_tsv(args.tsv_b, index_col=0)
     self_corr = False
   else:
     data_b = data_a
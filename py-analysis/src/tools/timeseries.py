@@ -11,7 +11,6 @@ import argparse
 import datetime
 import dateutil.parser
 import decimal
-import gc
 import os
 
 import matplotlib.dates
@@ -83,67 +82,63 @@ def datestr2date(d):
 def ts_plot(data, groups, datecol, measures, marker_date, bar_from_date, bar_to_date, 
   outdir, filename_base, default_value=None, **kwargs):
 
-  draw_bar = lambda ax, X, extent: ax.imshow(X, vmin=0, vmax=1, aspect='auto', interpolation='bicubic', cmap=cm.Blues, alpha=0.4, extent=extent)
-  clamp = lambda n, minn, maxn: n if n==None else max(min(maxn, n), minn)
-
-  first_date = data[datecol].min()
-  first_date_f = datestr2num(first_date)
-  last_date = data[datecol].max()
-  last_date_f = datestr2num(last_date)
-
-  bar_from_date_f = clamp(datestr2num(bar_from_date), first_date_f, last_date_f)
-  bar_to_date_f = clamp(datestr2num(bar_to_date), first_date_f, last_date_f)
-  marker_date_f = clamp(datestr2num(marker_date), first_date_f, last_date_f)
-
-  has_data = False
-
-  for (measure, group, ax1) in plot_matrix(measures, groups, cellwidth=10, 
-    cellheight=2, hspace=0.4, wspace=0.1, shared_xscale=True, xgroups=[measures], 
-    autofmt_xdate=False):
-
-    min_value = min(data.ix[group][measure])
-    max_value = max(data.ix[group][measure])
-    bar_step = (max_value - min_value) * 0.1
-    min_bar_y = max_value + bar_step
-    max_bar_y = max_value + 2 * bar_step
-
-    if min_value!=None:
-
-      has_data = True
-
-      #ax1.axvspan(datestr2num(bar_from_date), datestr2num(bar_to_date), color='blue', alpha=0.2)
-      if bar_from_date_f and bar_to_date_f:
-        extent = (bar_from_date_f, bar_to_date_f, min_bar_y, max_bar_y)
-        draw_bar(ax1, [[1, 1], [1, 1]], extent)
-      elif bar_from_date_f and (bar_from_date_f < last_date_f):
-        extent = (bar_from_date_f, last_date_f, min_bar_y, max_bar_y)
-        draw_bar(ax1, [[1, 0], [1, 0]], extent)
-      elif bar_to_date_f and (bar_to_date_f > first_date_f):
-        extent = (first_date_f, bar_to_date_f, min_bar_y, max_bar_y)
-        draw_bar(ax1, [[0, 1], [0, 1]], extent)
+  with FigureSession(filename_base):
+    draw_bar = lambda ax, X, extent: ax.imshow(X, vmin=0, vmax=1, aspect='auto', interpolation='bicubic', cmap=cm.Blues, alpha=0.4, extent=extent)
+    clamp = lambda n, minn, maxn: n if n==None else max(min(maxn, n), minn)
+
+    first_date = data[datecol].min()
+    first_date_f = datestr2num(first_date)
+    last_date = data[datecol].max()
+    last_date_f = datestr2num(last_date)
+
+    bar_from_date_f = clamp(datestr2num(bar_from_date), first_date_f, last_date_f)
+    bar_to_date_f = clamp(datestr2num(bar_to_date), first_date_f, last_date_f)
+    marker_date_f = clamp(datestr2num(marker_date), first_date_f, last_date_f)
+
+    has_data = False
+
+    for (measure, group, ax1) in plot_matrix(measures, groups, cellwidth=10, 
+      cellheight=2, hspace=0.4, wspace=0.1, shared_xscale=True, xgroups=[measures], 
+      autofmt_xdate=False):
+
+      min_value = min(data.ix[group][measure])
+      max_value = max(data.ix[group][measure])
+      bar_step = (max_value - min_value) * 0.1
+      min_bar_y = max_value + bar_step
+      max_bar_y = max_value + 2 * bar_step
+
+      if min_value!=None:
+
+        has_data = True
+
+        #ax1.axvspan(datestr2num(bar_from_date), datestr2num(bar_to_date), color='blue', alpha=0.2)
+        if bar_from_date_f and bar_to_date_f:
+          extent = (bar_from_date_f, bar_to_date_f, min_bar_y, max_bar_y)
+          draw_bar(ax1, [[1, 1], [1, 1]], extent)
+        elif bar_from_date_f and (bar_from_date_f < last_date_f):
+          extent = (bar_from_date_f, last_date_f, min_bar_y, max_bar_y)
+          draw_bar(ax1, [[1, 0], [1, 0]], extent)
+        elif bar_to_date_f and (bar_to_date_f > first_date_f):
+          extent = (first_date_f, bar_to_date_f, min_bar_y, max_bar_y)
+          draw_bar(ax1, [[0, 1], [0, 1]], extent)
   
-      if marker_date:
-        ax1.axvline(marker_date_f, color=QUALITATIVE_DARK[2])
+        if marker_date:
+          ax1.axvline(marker_date_f, color=QUALITATIVE_DARK[2])
   
-      x = [datestr2num(d) for d in data.ix[group][datecol]]
-      #if default_value:
-      #  x = [v if v else default_value for v in x]
-      y = data.ix[group][measure]
+        x = [datestr2num(d) for d in data.ix[group][datecol]]
+        #if default_value:
+        #  x = [v if v else default_value for v in x]
+        y = data.ix[group][measure]
   
-      ax1.plot_date(x, y, color=QUALITATIVE_DARK[1], **kwargs)
+        ax1.plot_date(x, y, color=QUALITATIVE_DARK[1], **kwargs)
 
-    ax1.xaxis_date()
-    # ax1.margins(0.2, 0.2)
+      ax1.xaxis_date()
+      # ax1.margins(0.2, 0.2)
   
-  if has_data:
-    plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-    plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
-  else:
-    print "No data to plot, skipping."
-
-  # free memory
-  plt.close() # closes current figure
-  gc.collect()
+    if has_data:
+      save_figure(outdir, filename_base)
+    else:
+      print "No data to plot, skipping."
 
 # ========
 # = Main =
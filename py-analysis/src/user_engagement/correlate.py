@@ -8,14 +8,16 @@ matplotlib.use('Agg')
 import argparse
 from collections import defaultdict
 import decimal
+import multiprocessing
 import sys
+import traceback
 
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import numpy
-import scipy.stats.stats as stats
 
 from app import *
+from correlation import *
 
 # =========
 # = tools =
@@ -28,128 +30,179 @@ def float_f(f):
 # = Plots =
 # =========
 
-# data: list of dict(metric -> value)
-# assumes that all records have all metrics
-def qqplot(data, metrics, outdir, filename_base, **kwargs):
+# data: metric matrix, one column per metric (see correlation.metric_matrix)
+# num_quantiles: the approximate number of quantiles to plot, with more detail 
+#   in the tails; None to plot every observation. See app.plotting.qq_positions
+def qqplot(data, metrics, outdir, filename_base, num_quantiles=QQ_QUANTILES, **kwargs):
 
-  ncols = len(metrics)
-  nrows = len(metrics)
+  with FigureSession(filename_base):
+    ncols = len(metrics)
+    nrows = len(metrics)
 
-  fig = plt.figure(figsize=(4*ncols, 3*nrows))
-  plt.subplots_adjust(hspace=.2, wspace=0.2)
-  fig.patch.set_facecolor('white')
+    fig = plt.figure(figsize=(4*ncols, 3*nrows))
+    plt.subplots_adjust(hspace=.2, wspace=0.2)
+    fig.patch.set_facecolor('white')
 
-  for a in range(len(metrics)):
-    for b in range(a):
-      # correlation
-      data_a = sorted([record[metrics[a]] for record in data])
-      data_b = sorted([record[metrics[b]] for record in data])
+    (probs, quantiles) = qq_quantiles(data, num_quantiles)
+
+    for a in range(len(metrics)):
+      for b in range(a):
+        data_a = quantiles[:,a]
+        data_b = quantiles[:,b]
 
-      minval = min([data_a[0], data_b[0]])
-      maxval = max([data_a[-1], data_b[-1]])
+        minval = min([data_a[0], data_b[0]])
+        maxval = max([data_a[-1], data_b[-1]])
 
-      # Plot
-      n = a * len(metrics) + b + 1
+        # Plot
+        n = a * len(metrics) + b + 1
       
-      if a == b+1: # first row
-        ax1 = plt.subplot(nrows, ncols, n, title=metrics[b])
-      else:
-        ax1 = plt.subplot(nrows, ncols, n)
+        if a == b+1: # first row
+          ax1 = plt.subplot(nrows, ncols, n, title=metrics[b])
+        else:
+          ax1 = plt.subplot(nrows, ncols, n)
     
-      if (b == 0): # first column
-        plt.ylabel(metrics[a])
+        if (b == 0): # first column
+          plt.ylabel(metrics[a])
       
-      ax1.scatter(data_b, data_a, **kwargs)
-      ax1.plot([minval, maxval], [minval, maxval], 'r--')
+        ax1.scatter(data_b, data_a, **kwargs)
+        ax1.plot([minval, maxval], [minval, maxval], 'r--')
 
-      ax1.tick_params(axis='both', which='major', labelsize='x-small')
-      ax1.tick_params(axis='both', which='minor', labelsize='xx-small')
+        ax1.tick_params(axis='both', which='major', labelsize='x-small')
+        ax1.tick_params(axis='both', which='minor', labelsize='xx-small')
 
-  plt.savefig("%s/%s.pdf" % (args.outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (args.outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 
-# data: list of dict(metric -> value)
-# corr: metric1 -> metric2 -> measure -> value
-def scatterplot(data, metrics, corr, outdir, filename_base, **kwargs):
+# data: metric matrix, one column per metric (see correlation.metric_matrix)
+# corr: measure -> matrix of pairwise scores (see correlation.correlation_matrices)
+# density: draw density rasters instead of points? None: decide based on the 
+# number of points
+def scatterplot(data, metrics, corr, outdir, filename_base, density=None, **kwargs):
 
-  ncols = len(metrics)
-  nrows = len(metrics)
+  with FigureSession(filename_base):
+    ncols = len(metrics)
+    nrows = len(metrics)
 
-  fig = plt.figure(figsize=(4*ncols, 3*nrows))
-  plt.subplots_adjust(hspace=.2, wspace=0.2)
-  fig.patch.set_facecolor('white')
+    fig = plt.figure(figsize=(4*ncols, 3*nrows))
+    plt.subplots_adjust(hspace=.2, wspace=0.2)
+    fig.patch.set_facecolor('white')
 
-  for a in range(len(metrics)):
-    for b in range(a):
-      # correlation
-      data_a = [record[metrics[a]] for record in data]
-      data_b = [record[metrics[b]] for record in data]
+    for a in range(len(metrics)):
+      for b in range(a):
+        data_a = data[:,a]
+        data_b = data[:,b]
 
-      # Plot
-      n = a * len(metrics) + b + 1
+        # Plot
+        n = a * len(metrics) + b + 1
       
-      if a == b+1: # first row
-        ax1 = plt.subplot(nrows, ncols, n, title=metrics[b])
-      else:
-        ax1 = plt.subplot(nrows, ncols, n)
+        if a == b+1: # first row
+          ax1 = plt.subplot(nrows, ncols, n, title=metrics[b])
+        else:
+          ax1 = plt.subplot(nrows, ncols, n)
     
-      if (b == 0): # first column
-        plt.ylabel(metrics[a])
+        if (b == 0): # first column
+          plt.ylabel(metrics[a])
       
-      ax1.scatter(data_b, data_a, **kwargs)
+        scatter_points(ax1, data_b, data_a, density=density, **kwargs)
 
-      ax1.tick_params(axis='both', which='major', labelsize='x-small')
-      ax1.tick_params(axis='both', which='minor', labelsize='xx-small')
+        ax1.tick_params(axis='both', which='major', labelsize='x-small')
+        ax1.tick_params(axis='both', which='minor', labelsize='xx-small')
       
-      # Correlation coefficients
-      scores = corr[metrics[a]][metrics[b]]
-
-      plt.text(0.05, 0.95, "PCC=%.3f\np=%.3f" % (scores['pcc'], scores['p_pcc']),
-        transform=ax1.transAxes, color='b', ha='left', va='top', size='small')
-      plt.text(0.95, 0.05, "\nSCC=%.3f\np=%.3f" % (scores['scc'], scores['p_scc']), 
-        transform=ax1.transAxes, color='r', ha='right', va='bottom', size='small')
+        # Correlation coefficients
+        plt.text(0.05, 0.95, "PCC=%.3f\np=%.3f" % (corr['pcc'][a,b], corr['p_pcc'][a,b]),
+          transform=ax1.transAxes, color='b', ha='left', va='top', size='small')
+        plt.text(0.95, 0.05, "\nSCC=%.3f\np=%.3f" % (corr['scc'][a,b], corr['p_scc'][a,b]), 
+          transform=ax1.transAxes, color='r', ha='right', va='bottom', size='small')
   
-  plt.savefig("%s/%s.pdf" % (args.outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (args.outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 
-# corr: metric1 -> metric2 -> measure -> value
+# corr: measure -> matrix of pairwise scores (see correlation.correlation_matrices)
 def corrmatrix(metrics, corr, measure, outdir, filename_base, cmap=cm.gray, **kwargs):
 
-  # TODO: OR: plt.matshow, plt.pcolor, ...
+  with FigureSession(filename_base):
+    # TODO: OR: plt.matshow, plt.pcolor, ...
 
-  ncols = len(metrics)
-  nrows = len(metrics)
+    ncols = len(metrics)
+    nrows = len(metrics)
 
-  fig = plt.figure(figsize=(1*ncols, 0.75*nrows))
-  plt.subplots_adjust(hspace=0, wspace=0)
-  fig.patch.set_facecolor('white')
+    fig = plt.figure(figsize=(1*ncols, 0.75*nrows))
+    plt.subplots_adjust(hspace=0, wspace=0)
+    fig.patch.set_facecolor('white')
 
-  for a in range(len(metrics)):
-    for b in range(a):
+    for a in range(len(metrics)):
+      for b in range(a):
 
-      scores = corr[metrics[a]][metrics[b]]
-      val = scores[measure]
+        val = corr[measure][a,b]
 
-      # Plot
-      n = a * len(metrics) + b + 1
-      ax1 = plt.subplot(nrows, ncols, n)
+        # Plot
+        n = a * len(metrics) + b + 1
+        ax1 = plt.subplot(nrows, ncols, n)
       
-      if a == len(metrics)-1: # last row
-        plt.xlabel(metrics[b], rotation=90)
+        if a == len(metrics)-1: # last row
+          plt.xlabel(metrics[b], rotation=90)
 
-      if (b == 0): # first column
-        plt.ylabel(metrics[a], rotation=0)
+        if (b == 0): # first column
+          plt.ylabel(metrics[a], rotation=0)
       
-      ax1.bar(0, 1, 1, 0, color=cmap(val), **kwargs)
+        ax1.bar(0, 1, 1, 0, color=cmap(val), **kwargs)
 
-      ax1.get_xaxis().set_ticks([])
-      ax1.get_yaxis().set_ticks([])
+        ax1.get_xaxis().set_ticks([])
+        ax1.get_yaxis().set_ticks([])
   
-  plt.savefig("%s/%s.pdf" % (args.outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (args.outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
+
+
+# ===========
+# = Regions =
+# ===========
+
+# Computes the correlations of a region, and submits its figures to a FigureQueue.
+# data: metric matrix of the region
+# Returns a dict of measure -> matrix of pairwise scores
+def correlate_region(region, data, metrics, outdir, figures):
+  corr = correlation_matrices(data)
+  figures.submit(qqplot, data, metrics, outdir, "%s_qq-plot" % (region))
+  figures.submit(scatterplot, data, metrics, corr, outdir, "%s_scatter" % (region))
+  figures.submit(corrmatrix, metrics, corr, 'pcc', outdir, "%s_corr_pcc" % (region), cmap=cm.Blues)
+  figures.submit(corrmatrix, metrics, corr, 'scc', outdir, "%s_corr_scc" % (region), cmap=cm.Blues)
+  return corr
+
+# Writes <outdir>/<region>_corr.txt
+# corr: measure -> matrix of pairwise scores
+def write_corr(region, metrics, corr, outdir):
+  outfile = open("%s/%s_corr.txt" % (outdir, region), 'wb')
+  outcsv = csv.writer(outfile, dialect='excel-tab')
+  outcsv.writerow(['metric_a', 'metric_b'] + MEASURES)
 
+  for a in range(len(metrics)):
+    for b in range(a):
+      outcsv.writerow([metrics[a], metrics[b]] + 
+        [float_f(corr[measure][a,b]) for measure in MEASURES])
+
+  outfile.close()
+
+# Computes and plots the correlations of a single region, in a worker process.
+# Figures are recorded in a worker-local manifest, which the parent merges.
+# job: a tuple (region, metric matrix, metrics, outdir, force)
+# Returns a dict with keys: region, corr (None on failure), manifest (the 
+# updated manifest entries), figures (FIGURE_MEMORY records of the region's 
+# figures), error (None on success)
+def region_worker(job):
+  (region, data, metrics, outdir, force) = job
+  result = {'region': region, 'corr': None, 'manifest': dict(), 'figures': [],
+    'error': None}
+  num_figures = len(FIGURE_MEMORY)
+  manifest = OutputManifest(outdir, force=force, autosave=False)
+  try:
+    figures = FigureQueue(1, manifest=manifest)
+    result['corr'] = correlate_region(region, data, metrics, outdir, figures)
+    figures.join()
+  except Exception:
+    result['error'] = traceback.format_exc()
+  result['manifest'] = manifest.updated
+  result['figures'] = pop_figure_memory(num_figures)
+  return result
 
 # ========
 # = Main =
@@ -163,6 +216,14 @@ if __name__ == "__main__":
       action='store', help='list of region names')
   parser.add_argument('--scheme', dest='scheme_name', type=str, default=None, 
       action='store', help='name of the segmentation scheme')
+  parser.add_argument('--pooled', dest='pooled', action='store_true', default=False, 
+      help='also compute correlations across all regions, reported as region \'%s\'' % POOLED_REGION)
+  parser.add_argument('--force', dest='force', action='store_true', default=False, 
+      help='regenerate all figures, including those whose inputs have not changed since the last run')
+  parser.add_argument('--workers', dest='workers', type=int, default=1, 
+      action='store', help='number of processes that compute and plot regions in parallel. Default: 1 (use --plot-workers to render figures in parallel)')
+  parser.add_argument('--plot-workers', dest='plot_workers', type=int, default=None, 
+      action='store', help='number of processes used to render figures. Default: number of CPUs')
   parser.add_argument('outdir', help='directory for output files')
   args = parser.parse_args()
 
@@ -176,7 +237,7 @@ if __name__ == "__main__":
     'num_tag_keys', 'num_tag_add', 'num_tag_update', 'num_tag_remove',
     'days_active', 'lifespan_days']
   
-  data = defaultdict(list) # region -> list of user edit stats
+  records = defaultdict(list) # region -> list of user edit stats
   
   # getDb().echo = True    
   session = getSession()
@@ -205,16 +266,22 @@ if __name__ == "__main__":
 
   num_records = 0
   for row in result:
-    region = row['region']
-    data[region].append(dict(row.items()))
-    # for metric in metrics:
-      # data[region][metric].append(row[metric])
-    
+    records[row['region']].append(row)
     num_records += 1
 
   print "Loaded %d records." % (num_records)
 
-  regions = sorted(data.keys())
+  regions = sorted(records.keys())
+
+  # region -> metric matrix, one column per metric
+  data = dict()
+  for region in regions:
+    data[region] = metric_matrix(records[region], metrics)
+  del records
+
+  if args.pooled and len(regions) > 0:
+    data[POOLED_REGION] = pooled_matrix(data, regions)
+    regions.append(POOLED_REGION)
 
   # Prep
   mkdir_p(args.outdir)
@@ -236,49 +303,44 @@ if __name__ == "__main__":
   # Correlation
   #
 
-  # region -> metric1 -> metric2 -> measure -> value
+  # region -> measure -> matrix of pairwise scores
   corr = dict()
-  
-  for region in regions:
-    corr[region] = defaultdict(dict)
-
-    outfile = open("%s/%s_corr.txt" % (args.outdir, region), 'wb')
-    outcsv = csv.writer(outfile, dialect='excel-tab')
-    outcsv.writerow(['metric_a', 'metric_b', 'pcc', 'p_pcc', 'scc', 'p_scc'])
-
-    for a in range(len(metrics)):
-      for b in range(a):
-      
-        data_a = [record[metrics[a]] for record in data[region]]
-        data_b = [record[metrics[b]] for record in data[region]]
-
-        # Correlation coefficients
-        (pcc, p_pcc) = stats.pearsonr(data_a, data_b)
-        (scc, p_scc) = stats.spearmanr(data_a, data_b)
-
-        scores = dict()
-        scores['pcc'] = pcc
-        scores['p_pcc'] = p_pcc
-        scores['scc'] = scc
-        scores['p_scc'] = p_scc
-      
-        corr[region][metrics[a]][metrics[b]] = scores
-        corr[region][metrics[b]][metrics[a]] = scores # Symmetry
-  
-        outcsv.writerow([metrics[a], metrics[b], 
-          float_f(scores['pcc']), 
-          float_f(scores['p_pcc']), 
-          float_f(scores['scc']), 
-          float_f(scores['p_scc'])])
-
-    outfile.close()
-
-  #
-  # Plots 
-  #
-  
-  for region in regions:
-    qqplot(data[region], metrics, args.outdir, "%s_qq-plot" % (region))
-    scatterplot(data[region], metrics, corr[region], args.outdir, "%s_scatter" % (region))
-    corrmatrix(metrics, corr[region], 'pcc', args.outdir, "%s_corr_pcc" % (region), cmap=cm.Blues)
-    corrmatrix(metrics, corr[region], 'scc', args.outdir, "%s_corr_scc" % (region), cmap=cm.Blues)
+  manifest = OutputManifest(args.outdir, force=args.force)
+
+  # without regions, the serial path below writes nothing
+  if args.workers > 1 and len(regions) > 0:
+    # largest regions first, for an even load across workers
+    jobs = [(region, data[region], metrics, args.outdir, args.force) 
+      for region in sorted(regions, key=lambda region: -len(data[region]))]
+    pool = multiprocessing.Pool(min(args.workers, len(jobs)))
+    results = pool.map(region_worker, jobs, chunksize=1)
+    pool.close()
+    pool.join()
+
+    # collect in region order
+    results = dict([(result['region'], result) for result in results])
+    errors = []
+    for region in regions:
+      result = results[region]
+      manifest.update(result['manifest'])
+      FIGURE_MEMORY.extend(result['figures'])
+      if result['corr']!=None:
+        corr[region] = result['corr']
+        write_corr(region, metrics, corr[region], args.outdir)
+      if result['error']!=None:
+        errors.append(region)
+        print "Error in region %s:" % region
+        print result['error']
+    if len(errors) > 0:
+      raise Exception("Failed to process %d regions: %s" % (
+        len(errors), ", ".join(errors)))
+
+  else:
+    figures = FigureQueue(args.plot_workers, manifest=manifest)
+    for region in regions:
+      corr[region] = correlate_region(region, data[region], metrics, 
+        args.outdir, figures)
+      write_corr(region, metrics, corr[region], args.outdir)
+    figures.join()
+
+  write_figure_memory(args.outdir)
@@ -0,0 +1,124 @@
+#
+# Pearson/Spearman correlation matrices for user engagement metrics.
+#
+# Metrics are stacked into a matrix with one column per metric, so that the
+# coefficients of all metric pairs can be computed with a single matrix product,
+# and every column only needs to be ranked once.
+#
+
+from __future__ import division # non-truncating division in Python 2.x
+
+import numpy as np
+from scipy.stats import rankdata, t as t_dist
+
+# Correlation measures computed by correlation_matrices(...)
+MEASURES = ['pcc', 'p_pcc', 'scc', 'p_scc']
+
+# The region name used for correlations across all regions.
+POOLED_REGION = 'all'
+
+# ============
+# = Matrices =
+# ============
+
+# records: a sequence of rows, e.g. database result rows or tuples
+# columns: the column names or indices of the metrics, in order
+# Returns a float numpy array with one row per record, one column per metric.
+def metric_matrix(records, columns):
+  return np.array([[record[col] for col in columns] for record in records],
+    dtype=np.float64).reshape(-1, len(columns))
+
+# Combines the metric matrices of several regions.
+# data: region -> metric matrix
+def pooled_matrix(data, regions):
+  return np.vstack([data[region] for region in regions])
+
+# Ranks every column of a matrix, with average ranks for ties (as in
+# scipy.stats.spearmanr).
+def rank_columns(X):
+  R = np.empty(X.shape, dtype=np.float64)
+  for col in range(X.shape[1]):
+    R[:,col] = rankdata(X[:,col])
+  return R
+
+# =====================
+# = Correlation tests =
+# =====================
+
+# Pearson correlation coefficients of all pairs of columns.
+# Columns with zero variance have NaN coefficients.
+def pearson_matrix(X):
+  Z = X - X.mean(axis=0)
+  norm = np.sqrt((Z * Z).sum(axis=0))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    Z = Z / norm
+  r = np.dot(Z.T, Z)
+  np.clip(r, -1.0, 1.0, out=r)
+  return r
+
+# Two-sided p-values of correlation coefficients for n observations, based on
+# a t distribution with n-2 degrees of freedom. These are the p-values reported
+# by scipy.stats.spearmanr (scipy 1.2): NaN for NaN coefficients, and for n<3.
+def correlation_pvalues(r, n):
+  if n < 3:
+    return np.ones(r.shape) * np.nan
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t = r * np.sqrt((n - 2) / ((1.0 - r) * (1.0 + r)))
+  p = 2 * t_dist.sf(np.abs(t), n - 2)
+  p[np.abs(r)==1.0] = 0.0
+  return p
+
+# The p-values reported by scipy.stats.pearsonr (scipy 1.2), which differ from
+# correlation_pvalues(...) in edge cases: for n=2, any two distinct points are 
+# perfectly correlated and have p=0 (the coefficient may be off 1.0 by a
+# rounding error), and for n>2, a NaN coefficient from a column with zero 
+# variance has p=1.
+def pearson_pvalues(r, n):
+  p = correlation_pvalues(r, n)
+  if n==2:
+    p[~np.isnan(r)] = 0.0
+  elif n > 2:
+    p[np.isnan(r)] = 1.0
+  return p
+
+# X: a metric matrix, one column per metric
+# Returns a dict of measure -> square matrix of pairwise scores, with measures:
+# pcc, p_pcc (Pearson), scc, p_scc (Spearman).
+def correlation_matrices(X):
+  n = X.shape[0]
+  pcc = pearson_matrix(X)
+  scc = pearson_matrix(rank_columns(X))
+  return {
+    'pcc': pcc,
+    'p_pcc': pearson_pvalues(pcc, n),
+    'scc': scc,
+    'p_scc': correlation_pvalues(scc, n)
+  }
+
+# ==========
+# = Checks =
+# ==========
+
+# Compares correlation_matrices(...) with pairwise scipy.stats.pearsonr and 
+# spearmanr calls, on small random matrices with ties, perfectly correlated 
+# columns, and a column with zero variance. Raises an AssertionError on a 
+# mismatch.
+def check_against_scipy(num_trials=200, seed=0):
+  from scipy.stats import pearsonr, spearmanr
+  rng = np.random.RandomState(seed)
+  for trial in range(num_trials):
+    n = rng.randint(2, 12)
+    X = rng.randint(0, 4, size=(n, 4)).astype(np.float64)
+    X[:,2] = 2 * X[:,1] + 1
+    X[:,3] = 0
+    corr = correlation_matrices(X)
+    for a in range(X.shape[1]):
+      for b in range(a):
+        expected = tuple(pearsonr(X[:,a], X[:,b])) + tuple(spearmanr(X[:,a], X[:,b]))
+        actual = tuple([corr[measure][a,b] for measure in ['pcc', 'p_pcc', 'scc', 'p_scc']])
+        assert np.allclose(actual, expected, rtol=1e-6, atol=1e-6, equal_nan=True), \
+          "n=%d, columns %d/%d: %s != scipy %s" % (n, a, b, actual, expected)
+
+if __name__ == "__main__":
+  check_against_scipy()
+  print "Correlation matrices match scipy.stats.pearsonr/spearmanr."
@@ -3,7 +3,7 @@
 #
 
 import argparse
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import decimal
 import sys
 
@@ -168,6 +168,8 @@ if __name__ == "__main__":
       action='store', help='list of region names')
   parser.add_argument('--overwrite', dest='overwrite', default=False, 
     action='store_true', help='overwrite existing data if the scheme already exists')
+  parser.add_argument('--copy-format', dest='copy_format', type=str, default=None, 
+      choices=['text', 'binary'], action='store', help='assign segments in-process and bulk-load them with COPY in this format, instead of an INSERT ... SELECT per region')
 
   parser.add_argument('--filter-below', dest='filter_below', type=int, default=None, 
       action='store', help='remove records where the metric falls under a lower threshold (exclusive)')
@@ -239,7 +241,7 @@ if __name__ == "__main__":
   # Load data
   #
   
-  query = """SELECT r.name AS region, %s 
+  query = """SELECT r.name AS region, r.id AS region_id, s.uid, %s 
     FROM %s.user_edit_stats s 
     JOIN region r ON s.region_id=r.id""" % (args.metric, args.schema)
   if args.regions!=None:
@@ -250,10 +252,16 @@ if __name__ == "__main__":
   # print result.keys()
 
   data = defaultdict(list)
+  region_ids = dict()
+  uids = defaultdict(list)  # unfiltered, for --copy-format
+  metric_values = defaultdict(list)
   num_records = 0
   for row in result:
     region = row['region']
     data[region].append(row[args.metric])
+    region_ids[region] = row['region_id']
+    uids[region].append(row['uid'])
+    metric_values[region].append(row[args.metric])
     num_records += 1
   
   print "Loaded %d records." % (num_records)
@@ -383,7 +391,35 @@ if __name__ == "__main__":
     if region in filter_max and filter_max[region]:
       query += " AND %s <= %f" % (args.metric, filter_max[region])
 
-    result = session.execute(query)
+    if args.copy_format:
+      # Same band assignment and filters as the query above, on arrays.
+      v = numpy.array(metric_values[region], dtype=float)
+      mask = numpy.ones(len(v), dtype=bool)
+      if min_threshold and min_threshold>=min(values):
+        mask &= v > min_threshold
+      if max_threshold and max_threshold<max(values):
+        mask &= v <= max_threshold
+      if region in filter_min and filter_min[region]:
+        mask &= v >= filter_min[region]
+      if region in filter_max and filter_max[region]:
+        mask &= v <= filter_max[region]
+      v = v[mask]
+      # band idx: low < v <= high
+      band_idx = numpy.searchsorted(numpy.array(thresholds[1:], dtype=float), v, side='left')
+      in_band = (v <= max_threshold)
+      if min_threshold!=None:
+        in_band &= (v > min_threshold)
+      groupids = numpy.array(band_idx + 1, dtype=object)
+      groupids[~in_band] = None # no matching CASE branch
+      num_rows = len(v)
+      bulk_write(session, '%s.region_user_segment' % args.schema, OrderedDict([
+        ('region_id', numpy.repeat(region_ids[region], num_rows)),
+        ('scheme', numpy.repeat(args.scheme_name, num_rows)),
+        ('uid', numpy.array(uids[region])[mask]),
+        ('groupid', groupids)]),
+        format=args.copy_format)
+    else:
+      result = session.execute(query)
   session.commit()
   
   #
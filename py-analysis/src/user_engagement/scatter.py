@@ -30,48 +30,52 @@ def remove_zero_or_less(x, y):
 # = Plots =
 # =========
 
+# density: draw density rasters instead of points? None: decide per cell, based 
+# on the number of points
 # kwargs is passed on to plt.scatter(...).
-def plot_scatter(data, anchor_row, columns, rows, outdir, filename_base, log_scale=False, **kwargs):
-  ncols = len(columns)
-  nrows = len(rows)
-
-  fig = plt.figure(figsize=(4*ncols, 3*nrows))
-  plt.subplots_adjust(hspace=.2, wspace=0.2)
-  fig.patch.set_facecolor('white')
-
-  n = 1
-  for row in rows:
-    for column in columns:
-
-      x = data[anchor_row][column]
-      y = data[row][column]
-
-      if log_scale:
-        (x, y) = remove_zero_or_less(x, y)
-
-      if n <= ncols: # first row
-        ax1 = plt.subplot(nrows, ncols, n, title=column)
-      else:
-        ax1 = plt.subplot(nrows, ncols, n)
+def plot_scatter(data, anchor_row, columns, rows, outdir, filename_base, log_scale=False, 
+  density=None, **kwargs):
+  with FigureSession(filename_base):
+    ncols = len(columns)
+    nrows = len(rows)
+
+    fig = plt.figure(figsize=(4*ncols, 3*nrows))
+    plt.subplots_adjust(hspace=.2, wspace=0.2)
+    fig.patch.set_facecolor('white')
+
+    n = 1
+    for row in rows:
+      for column in columns:
+
+        x = data[anchor_row][column]
+        y = data[row][column]
+
+        if log_scale:
+          (x, y) = remove_zero_or_less(x, y)
+
+        if n <= ncols: # first row
+          ax1 = plt.subplot(nrows, ncols, n, title=column)
+        else:
+          ax1 = plt.subplot(nrows, ncols, n)
       
-      if (n % ncols == 1): # first column
-        plt.ylabel(row)
+        if (n % ncols == 1): # first column
+          plt.ylabel(row)
 
-      plt.scatter(x,y, **kwargs)
+        scatter_points(ax1, x, y, density=density, 
+          scale=('log' if log_scale else 'linear'), **kwargs)
       
-      if log_scale:
-        ax1.set_xscale('log')
-        ax1.set_yscale('log')
-      else:
-        ax1.get_xaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
-        ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
-      ax1.tick_params(axis='both', which='major', labelsize='x-small')
-      ax1.tick_params(axis='both', which='minor', labelsize='xx-small')
-
-      n += 1
+        if log_scale:
+          ax1.set_xscale('log')
+          ax1.set_yscale('log')
+        else:
+          ax1.get_xaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
+          ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
+        ax1.tick_params(axis='both', which='major', labelsize='x-small')
+        ax1.tick_params(axis='both', which='minor', labelsize='xx-small')
+
+        n += 1
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # ========
 # = Main =
@@ -59,26 +59,26 @@ def report_region_segment_weights(data, regions, scores,
 def group_scores_plot(data, columns, rows, outdir, filename_base, 
   colors=QUALITATIVE_MEDIUM, **kwargs):
 
-  for (column, row, ax1) in plot_matrix(columns, rows):
-    celldata = []
-    for segment in sorted(data[column].keys()):
-      celldata.append(data[column][segment][row] + 0.0001) # got some 0 values...
-
-    ax1.bar(range(1, len(celldata)+1), celldata, color=colors, **kwargs)
-
-    ax1.margins(0.1, 0.1)
-    ax1.get_xaxis().set_visible(False)
-    ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
-    ax1.tick_params(axis='y', which='major', labelsize='x-small')
-    ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
+  with FigureSession(filename_base):
+    for (column, row, ax1) in plot_matrix(columns, rows):
+      celldata = []
+      for segment in sorted(data[column].keys()):
+        celldata.append(data[column][segment][row] + 0.0001) # got some 0 values...
+
+      ax1.bar(range(1, len(celldata)+1), celldata, color=colors, **kwargs)
+
+      ax1.margins(0.1, 0.1)
+      ax1.get_xaxis().set_visible(False)
+      ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
+      ax1.tick_params(axis='y', which='major', labelsize='x-small')
+      ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
     
-    minv = min(celldata)
-    maxv = max(celldata)
-    vrange = max(abs(minv), abs(maxv))
-    ax1.set_ylim([-vrange, vrange])
+      minv = min(celldata)
+      maxv = max(celldata)
+      vrange = max(abs(minv), abs(maxv))
+      ax1.set_ylim([-vrange, vrange])
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # ========
 # = Main =
@@ -103,118 +103,121 @@ def report_variances(data, volume_data, scores, outdir, filename_base):
 def group_volume_plot(data, columns, rows, outdir, filename_base, 
   colors=QUALITATIVE_MEDIUM, **kwargs):
   
-  for (column, row, ax1) in plot_matrix(columns, rows, cellwidth=4, cellheight=1.7):
-    left = 0
-    total = sum([data[column][seg][row] for seg in data[column].keys()])
-    colgen = looping_generator(colors)
-    for segment in sorted(data[column].keys()):
-      val = data[column][segment][row] / decimal.Decimal(total)
-      ax1.barh(0, val, 1, left=left, color=next(colgen), **kwargs)
-      left += val
-
-    ax1.get_xaxis().set_major_formatter(ticker.FuncFormatter(to_even_percent))
-    ax1.get_yaxis().set_ticks([])
+  with FigureSession(filename_base):
+    for (column, row, ax1) in plot_matrix(columns, rows, cellwidth=4, cellheight=1.7):
+      left = 0
+      total = sum([data[column][seg][row] for seg in data[column].keys()])
+      colgen = looping_generator(colors)
+      for segment in sorted(data[column].keys()):
+        val = data[column][segment][row] / decimal.Decimal(total)
+        ax1.barh(0, val, 1, left=left, color=next(colgen), **kwargs)
+        left += val
+
+      ax1.get_xaxis().set_major_formatter(ticker.FuncFormatter(to_even_percent))
+      ax1.get_yaxis().set_ticks([])
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # data: column -> segment -> row -> value
 # kwargs is passed on to plt.bar(...).
 def group_scores_plot(data, columns, rows, outdir, filename_base, 
   colors=QUALITATIVE_MEDIUM, **kwargs):
 
-  for (column, row, ax1) in plot_matrix(columns, rows):
-    celldata = []
-    for segment in sorted(data[column].keys()):
-      celldata.append(data[column][segment][row] + 0.0001) # got some 0 values...
+  with FigureSession(filename_base):
+    for (column, row, ax1) in plot_matrix(columns, rows):
+      celldata = []
+      for segment in sorted(data[column].keys()):
+        celldata.append(data[column][segment][row] + 0.0001) # got some 0 values...
 
-    ax1.bar(range(1, len(celldata)+1), celldata, color=colors, **kwargs)
+      ax1.bar(range(1, len(celldata)+1), celldata, color=colors, **kwargs)
 
-    ax1.get_xaxis().set_visible(False)
-    ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
-    ax1.tick_params(axis='y', which='major', labelsize='x-small')
-    ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
+      ax1.get_xaxis().set_visible(False)
+      ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
+      ax1.tick_params(axis='y', which='major', labelsize='x-small')
+      ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # data: column -> segment -> list of records (each a dict or row values)
-# kwargs is passed on to plt.boxplot(...).
+# kwargs is passed on to draw_boxplots(...).
 def item_scores_boxplot(data, columns, rows, outdir, filename_base, **kwargs):
-  for (column, row, ax1) in plot_matrix(columns, rows):
-    celldata = []
-    for segment in sorted(data[column].keys()):
-      nrecs = len(data[column][segment])
-      celldata.append([data[column][segment][idx][row] for idx in range(nrecs)])
-    ax1.boxplot(celldata, **kwargs)
-
-    ax1.margins(0.1, 0.1)
-    ax1.get_xaxis().set_visible(False)
-    ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
-    ax1.tick_params(axis='y', which='major', labelsize='x-small')
-    ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
+  with FigureSession(filename_base):
+    for (column, row, ax1) in plot_matrix(columns, rows):
+      celldata = []
+      for segment in sorted(data[column].keys()):
+        nrecs = len(data[column][segment])
+        celldata.append([data[column][segment][idx][row] for idx in range(nrecs)])
+      draw_boxplots(ax1, celldata, **kwargs)
+
+      ax1.margins(0.1, 0.1)
+      ax1.get_xaxis().set_visible(False)
+      ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
+      ax1.tick_params(axis='y', which='major', labelsize='x-small')
+      ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # data: column -> segment -> list of records (each a dict or row values)
 # kwargs is passed on to plt.step(...).
 def item_rank_plot(data, columns, rows, outdir, filename_base, 
   colors=QUALITATIVE_DARK, x_gap=0.2, **kwargs):
   
-  for (column, row, ax1) in plot_matrix(columns, rows):
-    # horizontal spacing
-    num_items = sum([len(data[column][segment]) for segment in data[column].keys()])
-    num_groups = len(data[column].keys())
-    x_spacing = int(num_items * x_gap / (num_groups-1)) # Python2 round(...) returns a float
-
-    xoffset = 0
-    colgen = looping_generator(colors)
-    for segment in sorted(data[column].keys()):
-      nrecs = len(data[column][segment])
-      values = sorted([data[column][segment][idx][row] for idx in range(nrecs)])
-
-      ax1.step(range(xoffset, xoffset+len(values)), values, 
-        color=next(colgen), linewidth=2, **kwargs)
-      xoffset += len(values) + x_spacing
-
-    ax1.margins(0.1, 0.1)
-    ax1.get_xaxis().set_visible(False)
-    ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
-    ax1.tick_params(axis='y', which='major', labelsize='x-small')
-    ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
+  with FigureSession(filename_base):
+    for (column, row, ax1) in plot_matrix(columns, rows):
+      # horizontal spacing
+      num_items = sum([len(data[column][segment]) for segment in data[column].keys()])
+      num_groups = len(data[column].keys())
+      x_spacing = int(num_items * x_gap / (num_groups-1)) # Python2 round(...) returns a float
+
+      xoffset = 0
+      colgen = looping_generator(colors)
+      for segment in sorted(data[column].keys()):
+        nrecs = len(data[column][segment])
+        values = sorted([data[column][segment][idx][row] for idx in range(nrecs)])
+
+        ax1.step(range(xoffset, xoffset+len(values)), values, 
+          color=next(colgen), linewidth=2, **kwargs)
+        xoffset += len(values) + x_spacing
+
+      ax1.margins(0.1, 0.1)
+      ax1.get_xaxis().set_visible(False)
+      ax1.get_yaxis().set_major_formatter(ticker.FuncFormatter(simplified_SI_format))
+      ax1.tick_params(axis='y', which='major', labelsize='x-small')
+      ax1.tick_params(axis='y', which='minor', labelsize='xx-small')
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # data: column -> segment -> list of records (each a dict or row values)
+# density: draw density rasters instead of points? None: decide per segment, 
+# based on the number of points
 # kwargs is passed on to plt.scatter(...).
 def items_scatterplot(data, anchor_row, columns, rows, outdir, 
-  filename_base, colors=QUALITATIVE_DARK, scale='log', **kwargs):
+  filename_base, colors=QUALITATIVE_DARK, scale='log', density=None, **kwargs):
   
-  for (column, row, ax1) in plot_matrix(columns, rows):
-    seg_x = defaultdict(list)
-    seg_y = defaultdict(list)
-
-    for segment in sorted(data[column].keys()):
-      for rec in data[column][segment]:
-        x = rec[anchor_row]
-        y = rec[row]
-        if (x>0 and y>0): # we're using log scale...
-          seg_x[segment].append(x)
-          seg_y[segment].append(y)
-
-    colgen = looping_generator(colors)
-    for segment in sorted(seg_x.keys()):
-      ax1.scatter(seg_x[segment], seg_y[segment], color=next(colgen), **kwargs)
-
-    ax1.set_xscale(scale)
-    ax1.set_yscale(scale)
-    ax1.tick_params(axis='both', which='major', labelsize='x-small')
-    ax1.tick_params(axis='both', which='minor', labelsize='xx-small')
+  with FigureSession(filename_base):
+    for (column, row, ax1) in plot_matrix(columns, rows):
+      seg_x = defaultdict(list)
+      seg_y = defaultdict(list)
+
+      for segment in sorted(data[column].keys()):
+        for rec in data[column][segment]:
+          x = rec[anchor_row]
+          y = rec[row]
+          if (x>0 and y>0): # we're using log scale...
+            seg_x[segment].append(x)
+            seg_y[segment].append(y)
+
+      colgen = looping_generator(colors)
+      for segment in sorted(seg_x.keys()):
+        scatter_points(ax1, seg_x[segment], seg_y[segment], density=density, 
+          scale=scale, color=next(colgen), **kwargs)
+
+      ax1.set_xscale(scale)
+      ax1.set_yscale(scale)
+      ax1.tick_params(axis='both', which='major', labelsize='x-small')
+      ax1.tick_params(axis='both', which='minor', labelsize='xx-small')
   
-  plt.savefig("%s/%s.pdf" % (outdir, filename_base), bbox_inches='tight')
-  plt.savefig("%s/%s.png" % (outdir, filename_base), bbox_inches='tight')
+    save_figure(outdir, filename_base)
 
 # ========
 # = Main =